@@ -0,0 +1,285 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+File: movement_store.py
+Description: Serves the movements of a simulation to update_environment
+and the demo page.
+The browser polls update_environment several times a second, so nothing is
+parsed per poll. A compressed simulation in the keyframed replay format
+(compressed_storage/{sim_code}/replay, written by compress_sim_storage.py)
+is memory-mapped, and a step is a slice at its indexed offset. For older
+compressed simulations, compressed_storage/{sim_code}/master_movement.json
+is loaded once, and every step's response is serialized into one buffer with
+a per-step offset index. Both are kept until their files change. The
+movement files of storage/{sim_code}/movement are small and are served as
+they are on disk, without being parsed.
+
+Responses are the JSON bytes update_environment returns: the step's movement
+with its "<step>" key, plus, when more than one step is asked for, the steps
+that follow under "<upcoming>" (so a replaying browser needs one request per
+batch of steps rather than one per step).
+"""
+import collections
+import json
+import mmap
+import os
+import threading
+
+import numpy as np
+
+from global_methods import sim_step_file
+
+# The number of compressed simulations we keep loaded.
+STORE_CACHE_SIZE = 8
+# The most steps a single update_environment request can ask for.
+MAX_MOVEMENT_BATCH = 100
+
+
+def add_step_key(movement, step):
+  """
+  Adds the "<step>" key to the serialized movement object <movement>.
+  """
+  head = movement.rstrip()[:-1].rstrip()
+  separator = b"" if head.endswith(b"{") else b", "
+  return head + separator + b'"<step>": ' + str(step).encode() + b"}"
+
+
+class ReplayMovements:
+  """
+  The movements of a compressed simulation, step by step. Subclasses
+  provide <n_steps>, <persona_names> and delta_bytes().
+  """
+  def delta(self, step):
+    """
+    Returns the personas whose record changed at <step>, as a dictionary
+    from persona name to {"movement", "pronunciatio", "description", "chat"}.
+    """
+    movement = json.loads(self.delta_bytes(step))
+    movement.pop("<step>", None)
+    return movement
+
+
+  def state_at(self, step):
+    """
+    Returns the latest record of every persona as of <step>.
+    """
+    state = dict()
+    for curr_step in range(step + 1):
+      state.update(self.delta(curr_step))
+    return state
+
+
+  def get(self, step):
+    """
+    Returns the update_environment response bytes of <step>, or None if
+    there is no such step.
+    """
+    if not 0 <= step < self.n_steps:
+      return None
+    return add_step_key(self.delta_bytes(step), step)
+
+
+class KeyframedMovements(ReplayMovements):
+  def __init__(self, folder, signature):
+    """
+    Opens the keyframed replay format in <folder>.
+
+    ARGS:
+      folder: path to compressed_storage/{sim_code}/replay.
+      signature: the (mtime, size) of its files when we opened them.
+    """
+    self.folder = folder
+    self.signature = signature
+    with open(f"{folder}/format.json") as json_file:
+      replay_format = json.load(json_file)
+    self.keyframe_interval = replay_format["keyframe_interval"]
+    self.n_steps = replay_format["n_steps"]
+    self.persona_names = replay_format["persona_names"]
+    self.delta_offsets = np.fromfile(f"{folder}/deltas.idx", dtype="<u8")
+    self.keyframe_offsets = np.fromfile(f"{folder}/keyframes.idx",
+                                        dtype="<u8")
+    self.deltas = self.map_file(f"{folder}/deltas.jsonl")
+    self.keyframes = self.map_file(f"{folder}/keyframes.jsonl")
+
+
+  @staticmethod
+  def map_file(path):
+    with open(path, "rb") as data_file:
+      if os.fstat(data_file.fileno()).st_size == 0:
+        return b""
+      return mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+  def delta_bytes(self, step):
+    return self.deltas[int(self.delta_offsets[step]):
+                       int(self.delta_offsets[step + 1]) - 1]
+
+
+  def state_at(self, step):
+    keyframe = step // self.keyframe_interval
+    state = json.loads(self.keyframes[int(self.keyframe_offsets[keyframe]):
+                                      int(self.keyframe_offsets[keyframe + 1])])
+    # The deltas after the keyframe are contiguous, so we read them at once.
+    first = keyframe * self.keyframe_interval + 1
+    if first <= step:
+      lines = self.deltas[int(self.delta_offsets[first]):
+                          int(self.delta_offsets[step + 1])]
+      for line in lines.splitlines():
+        state.update(json.loads(line))
+    return state
+
+
+class CompressedMovements(ReplayMovements):
+  def __init__(self, path, signature):
+    """
+    Loads master_movement.json and serializes the response of every step.
+
+    ARGS:
+      path: path to master_movement.json.
+      signature: the (mtime, size) of the file when we started reading it.
+    """
+    self.path = path
+    self.signature = signature
+    with open(path) as json_file:
+      all_movement = json.load(json_file)
+
+    self.n_steps = len(all_movement)
+    self.persona_names = list(all_movement["0"].keys())
+
+    # <offsets> maps a step to the (start, end) of its response in <buffer>.
+    self.offsets = dict()
+    parts = []
+    position = 0
+    for step, movement in all_movement.items():
+      movement = dict(movement)
+      movement["<step>"] = int(step)
+      part = json.dumps(movement).encode("utf-8")
+      self.offsets[int(step)] = (position, position + len(part))
+      parts += [part]
+      position += len(part)
+    self.buffer = b"".join(parts)
+
+
+  def delta_bytes(self, step):
+    span = self.offsets[step]
+    return self.buffer[span[0]:span[1]]
+
+
+  def get(self, step):
+    """
+    Returns the response bytes of <step>, or None if it has no movement.
+    """
+    span = self.offsets.get(step)
+    if span is None:
+      return None
+    return self.buffer[span[0]:span[1]]
+
+
+store_cache = collections.OrderedDict()
+store_lock = threading.Lock()
+
+
+def file_signature(*paths):
+  """
+  Returns the (mtime, size) of every file in <paths>, or None if one of them
+  is missing.
+  """
+  signature = []
+  for path in paths:
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return None
+    signature += [(stat.st_mtime_ns, stat.st_size)]
+  return tuple(signature)
+
+
+def get_compressed_movements(sim_code):
+  """
+  Returns the ReplayMovements of the compressed simulation <sim_code> (in
+  the keyframed replay format if it has one), loading it if it is not
+  cached or its files changed since, or None if the simulation is not
+  compressed.
+  """
+  folder = f"compressed_storage/{sim_code}"
+  replay_folder = f"{folder}/replay"
+  # format.json is written last, so the other files are complete if it is
+  # there.
+  path = f"{replay_folder}/format.json"
+  signature = file_signature(path, f"{replay_folder}/deltas.jsonl")
+  load = lambda: KeyframedMovements(replay_folder, signature)
+  if signature is None:
+    path = f"{folder}/master_movement.json"
+    signature = file_signature(path)
+    load = lambda: CompressedMovements(path, signature)
+    if signature is None:
+      return None
+
+  with store_lock:
+    store = store_cache.get(path)
+    if store is not None and store.signature == signature:
+      store_cache.move_to_end(path)
+      return store
+
+  store = load()
+  with store_lock:
+    store_cache[path] = store
+    store_cache.move_to_end(path)
+    while len(store_cache) > STORE_CACHE_SIZE:
+      store_cache.popitem(last=False)
+  return store
+
+
+def read_movement_file(sim_folder, step):
+  """
+  Returns the response bytes of storage/{sim_code}/movement/{step}.json
+  (which may be in the simulation it was forked from), or None if the file
+  is not there (yet). Reverie writes the file under a temporary name and
+  renames it, so a file that is there is complete.
+  """
+  move_file = sim_step_file(sim_folder, "movement", step)
+  if move_file is None:
+    return None
+  try:
+    with open(move_file, "rb") as data_file:
+      movement = data_file.read()
+  except OSError:
+    return None
+  return add_step_key(movement, step)
+
+
+def movement_response(sim_code, step, count=1):
+  """
+  Returns the update_environment response for <step> of <sim_code>, with up
+  to <count> - 1 upcoming steps, as JSON bytes, or None if <step> has no
+  movement yet.
+
+  ARGS:
+    sim_code: the simulation code.
+    step: the step the browser is about to play.
+    count: the number of steps the browser asks for, starting at <step>.
+  RETURNS:
+    bytes or None
+  """
+  count = max(1, min(count, MAX_MOVEMENT_BATCH))
+  store = get_compressed_movements(sim_code)
+  if store is not None:
+    get = store.get
+  else:
+    sim_folder = f"storage/{sim_code}"
+    get = lambda s: read_movement_file(sim_folder, s)
+
+  response = get(step)
+  if response is None or count == 1:
+    return response
+
+  upcoming = []
+  for upcoming_step in range(step + 1, step + count):
+    upcoming_response = get(upcoming_step)
+    if upcoming_response is None:
+      break
+    upcoming += [b'"' + str(upcoming_step).encode() + b'": '
+                 + upcoming_response]
+  if not upcoming:
+    return response
+  return (response[:-1] + b', "<upcoming>": {' + b", ".join(upcoming)
+          + b"}}")
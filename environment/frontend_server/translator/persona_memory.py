@@ -0,0 +1,95 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+File: persona_memory.py
+Description: Reads a persona's saved associative memory for the frontend. 
+The backend (reverie/backend_server/persona/memory_structures/
+associative_memory.py) writes either the original JSON layout (nodes.json) or
+the binary layout (format.json, nodes.npz, nodes_text.json, ...). The 
+frontend only needs the node table, so the embedding matrix is never read. 
+"""
+import json
+import datetime
+import os
+
+import numpy as np
+
+NODE_TYPES = ["event", "thought", "chat"]
+
+
+def seconds_to_str(seconds): 
+  dt = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=seconds)
+  return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def load_associative_nodes(a_mem_folder): 
+  """
+  Returns the nodes of a saved associative memory in the nodes.json form: 
+  a dictionary from "node_<count>" to a dictionary of node details. 
+
+  ARGS:
+    a_mem_folder: path to the persona's associative_memory folder. 
+  RETURNS: 
+    dictionary of node details keyed by node id. 
+  """
+  if not os.path.exists(a_mem_folder + "/format.json"): 
+    with open(a_mem_folder + "/nodes.json") as json_file: 
+      return json.load(json_file)
+
+  with open(a_mem_folder + "/format.json") as json_file: 
+    meta = json.load(json_file)
+  with open(a_mem_folder + "/embedding_keys.json") as json_file: 
+    keys = json.load(json_file)
+  with np.load(a_mem_folder + "/nodes.npz") as nodes_load: 
+    cols = {name: nodes_load[name] for name in nodes_load.files}
+  with open(a_mem_folder + "/nodes_text.json") as json_file: 
+    text_cols = json.load(json_file)
+
+  nodes = dict()
+  type_counts = {node_type: 0 for node_type in NODE_TYPES}
+  add_node_columns(nodes, type_counts, cols, text_cols, keys)
+
+  # Nodes saved incrementally live in segments on top of the base files. 
+  for segment in meta.get("segments", []): 
+    with np.load(f"{a_mem_folder}/{segment}.npz") as segment_load: 
+      cols = {name: segment_load[name] for name in segment_load.files}
+    with open(f"{a_mem_folder}/{segment}.json") as json_file: 
+      text_cols = json.load(json_file)
+    key_set = set(keys)
+    keys += [key for key in text_cols["new_keys"] if key not in key_set]
+    add_node_columns(nodes, type_counts, cols, text_cols, keys, 
+                     text_cols["first_node"])
+  return nodes
+
+
+def add_node_columns(nodes, type_counts, cols, text_cols, keys, first_node=0): 
+  """
+  Adds the nodes of one node table (the base files or a segment) to <nodes>,
+  skipping the ones that are already there. 
+  """
+  for i in range(max(0, len(nodes) - first_node), len(cols["node_type"])): 
+    node_type = NODE_TYPES[cols["node_type"][i]]
+    type_counts[node_type] += 1
+
+    expiration = None
+    if not np.isnan(cols["expiration"][i]): 
+      expiration = seconds_to_str(float(cols["expiration"][i]))
+    poignancy = float(cols["poignancy"][i])
+    if poignancy.is_integer(): 
+      poignancy = int(poignancy)
+
+    node_count = len(nodes) + 1
+    nodes[f"node_{str(node_count)}"] = {
+      "node_count": node_count, 
+      "type_count": type_counts[node_type], 
+      "type": node_type, 
+      "depth": int(cols["depth"][i]), 
+      "created": seconds_to_str(float(cols["created"][i])), 
+      "expiration": expiration, 
+      "subject": text_cols["subject"][i], 
+      "predicate": text_cols["predicate"][i], 
+      "object": text_cols["object"][i], 
+      "description": text_cols["description"][i], 
+      "embedding_key": keys[cols["embedding_row"][i]], 
+      "poignancy": poignancy, 
+      "keywords": text_cols["keywords"][i], 
+      "filling": text_cols["filling"][i]}
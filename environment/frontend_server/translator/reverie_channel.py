@@ -0,0 +1,128 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+File: reverie_channel.py
+Description: The frontend side of the local socket channel to Reverie (see
+reverie/backend_server/frontend_channel.py). process_environment pushes the
+browser's environment through it, and update_environment serves the
+movements Reverie pushes back, so neither side waits on files. When Reverie
+is not listening, both views fall back to the file protocol.
+"""
+import collections
+import json
+import os
+import socket
+import threading
+import time
+
+CHANNEL_PATH = "temp_storage/reverie.sock"
+# How long we wait before trying to connect again after a failed attempt.
+RECONNECT_INTERVAL = 1.0
+# The number of received movements we keep for the browser to pick up.
+MAX_MOVEMENTS = 64
+
+
+class ReverieChannel:
+  def __init__(self, path):
+    self.path = path
+    self.sock = None
+    self.movements = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.next_attempt = 0.0
+
+
+  def connect(self):
+    """
+    Connects to Reverie if we are not connected yet. Must be called with
+    <lock> held.
+
+    RETURNS:
+      True if the channel is connected.
+    """
+    if self.sock is not None:
+      return True
+    if not hasattr(socket, "AF_UNIX"):
+      return False
+    now = time.monotonic()
+    if now < self.next_attempt or not os.path.exists(self.path):
+      return False
+    self.next_attempt = now + RECONNECT_INTERVAL
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(self.path)
+    except OSError:
+      sock.close()
+      return False
+    self.sock = sock
+    threading.Thread(target=self.read_loop, args=(sock,),
+                     name="reverie-channel", daemon=True).start()
+    return True
+
+
+  def read_loop(self, sock):
+    try:
+      for line in sock.makefile("rb"):
+        try:
+          message = json.loads(line)
+          if message["type"] != "movement":
+            continue
+          key = (message["sim_code"], int(message["step"]))
+        except (ValueError, KeyError, TypeError):
+          continue
+        with self.lock:
+          self.movements[key] = message["movement"]
+          while len(self.movements) > MAX_MOVEMENTS:
+            self.movements.popitem(last=False)
+    except OSError:
+      pass
+    with self.lock:
+      self.disconnect(sock)
+
+
+  def disconnect(self, sock):
+    if self.sock is sock:
+      self.sock = None
+    try:
+      sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+    try:
+      sock.close()
+    except OSError:
+      pass
+
+
+  def send_environment(self, sim_code, step, environment):
+    """
+    Pushes the environment of <step> to Reverie.
+
+    RETURNS:
+      True if it was sent; False if the caller should write the environment
+      file instead.
+    """
+    line = (json.dumps({"type": "environment",
+                        "sim_code": sim_code,
+                        "step": int(step),
+                        "environment": environment},
+                       separators=(",", ":")) + "\n").encode("utf-8")
+    with self.lock:
+      if not self.connect():
+        return False
+      try:
+        self.sock.sendall(line)
+      except OSError:
+        self.disconnect(self.sock)
+        return False
+    return True
+
+
+  def get_movement(self, sim_code, step):
+    """
+    Returns the movement of <step> if Reverie has pushed it, or None.
+    """
+    with self.lock:
+      self.connect()
+      return self.movements.get((sim_code, int(step)))
+
+
+channel = ReverieChannel(CHANNEL_PATH)
@@ -11,12 +11,19 @@ import os
 
 import datetime
 from django.shortcuts import render, redirect, HttpResponseRedirect
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, Http404
 from django.views.decorators.csrf import csrf_exempt
 from global_methods import *
 
 from django.contrib.staticfiles.templatetags.staticfiles import static
 from .models import *
+from .persona_memory import load_associative_nodes
+from .reverie_channel import channel as reverie_channel
+from .movement_store import movement_response, get_compressed_movements
+
+# The number of steps after the starting step that the demo page gets with
+# the page itself; it asks update_environment for the rest as it plays.
+DEMO_PRELOAD_STEPS = 500
 
 def landing(request):
   context = {}
@@ -25,7 +32,6 @@ def landing(request):
 
 
 def demo(request, sim_code, step, play_speed="2"):
-  move_file = f"compressed_storage/{sim_code}/master_movement.json"
   meta_file = f"compressed_storage/{sim_code}/meta.json"
   step = int(step)
   play_speed_opt = {"1": 1, "2": 2, "3": 4,
@@ -41,55 +47,50 @@ def demo(request, sim_code, step, play_speed="2"):
   sec_per_step = meta["sec_per_step"]
   start_datetime = datetime.datetime.strptime(meta["start_date"] + " 00:00:00",
                                               '%B %d, %Y %H:%M:%S')
-  for i in range(step):
-    start_datetime += datetime.timedelta(seconds=sec_per_step)
+  start_datetime += datetime.timedelta(seconds=sec_per_step * step)
   start_datetime = start_datetime.strftime("%Y-%m-%dT%H:%M:%S")
 
-  # Loading the movement file
-  raw_all_movement = dict()
-  with open(move_file) as json_file:
-    raw_all_movement = json.load(json_file)
+  # Loading the movements (see movement_store.py)
+  movements = get_compressed_movements(sim_code)
+  if movements is None:
+    raise Http404(f"{sim_code} has no compressed movements.")
 
   # Loading all names of the personas
-  persona_names = dict()
   persona_names = []
-  persona_names_set = set()
-  for p in list(raw_all_movement["0"].keys()):
+  for p in movements.persona_names:
     persona_names += [{"original": p,
                        "underscore": p.replace(" ", "_"),
                        "initial": p[0] + p.split(" ")[-1][0]}]
-    persona_names_set.add(p)
 
   # <all_movement> is the main movement variable that we are passing to the
   # frontend. Whereas we use ajax scheme to communicate steps to the frontend
-  # during the simulation stage, for this demo, we send all movement
-  # information in one step.
+  # during the simulation stage, for this demo, we send the first
+  # DEMO_PRELOAD_STEPS steps with the page, and the page asks
+  # update_environment for the following ones as it plays.
   all_movement = dict()
 
   # Preparing the initial step.
   # <init_prep> sets the locations and descriptions of all agents at the
-  # beginning of the demo determined by <step>.
-  init_prep = dict()
-  for int_key in range(step+1):
-    key = str(int_key)
-    val = raw_all_movement[key]
-    for p in persona_names_set:
-      if p in val:
-        init_prep[p] = val[p]
+  # beginning of the demo determined by <step>. With the keyframed replay
+  # format, this reads one keyframe and the steps since.
+  init_prep = movements.state_at(step)
   persona_init_pos = dict()
-  for p in persona_names_set:
+  for p in movements.persona_names:
     persona_init_pos[p.replace(" ","_")] = init_prep[p]["movement"]
   all_movement[step] = init_prep
 
   # Finish loading <all_movement>
-  for int_key in range(step+1, len(raw_all_movement.keys())):
-    all_movement[int_key] = raw_all_movement[str(int_key)]
+  loaded_until = min(step + DEMO_PRELOAD_STEPS, movements.n_steps - 1)
+  for int_key in range(step+1, loaded_until+1):
+    all_movement[int_key] = movements.delta(int_key)
 
   context = {"sim_code": sim_code,
              "step": step,
              "persona_names": persona_names,
              "persona_init_pos": json.dumps(persona_init_pos),
              "all_movement": json.dumps(all_movement),
+             "loaded_until": loaded_until,
+             "last_step": movements.n_steps - 1,
              "start_datetime": start_datetime,
              "sec_per_step": sec_per_step,
              "play_speed": play_speed,
@@ -128,13 +129,11 @@ def home(request):
       persona_names += [[x, x.replace(" ", "_")]]
       persona_names_set.add(x)
 
+  # The environment files of a copy-on-write fork may be in the simulation
+  # it was forked from.
   persona_init_pos = []
-  file_count = []
-  for i in find_filenames(f"storage/{sim_code}/environment", ".json"):
-    x = i.split("/")[-1].strip()
-    if x[0] != ".":
-      file_count += [int(x.split(".")[0])]
-  curr_json = f'storage/{sim_code}/environment/{str(max(file_count))}.json'
+  env_files = sim_step_files(f"storage/{sim_code}", "environment")
+  curr_json = env_files[max(env_files)]
   with open(curr_json) as json_file:
     persona_init_pos_dict = json.load(json_file)
     for key, val in persona_init_pos_dict.items():
@@ -162,13 +161,11 @@ def replay(request, sim_code, step):
       persona_names += [[x, x.replace(" ", "_")]]
       persona_names_set.add(x)
 
+  # The environment files of a copy-on-write fork may be in the simulation
+  # it was forked from.
   persona_init_pos = []
-  file_count = []
-  for i in find_filenames(f"storage/{sim_code}/environment", ".json"):
-    x = i.split("/")[-1].strip()
-    if x[0] != ".":
-      file_count += [int(x.split(".")[0])]
-  curr_json = f'storage/{sim_code}/environment/{str(max(file_count))}.json'
+  env_files = sim_step_files(f"storage/{sim_code}", "environment")
+  curr_json = env_files[max(env_files)]
   with open(curr_json) as json_file:
     persona_init_pos_dict = json.load(json_file)
     for key, val in persona_init_pos_dict.items():
@@ -200,8 +197,7 @@ def replay_persona_state(request, sim_code, step, persona_name):
   with open(memory + "/spatial_memory.json") as json_file:
     spatial = json.load(json_file)
 
-  with open(memory + "/associative_memory/nodes.json") as json_file:
-    associative = json.load(json_file)
+  associative = load_associative_nodes(memory + "/associative_memory")
 
   a_mem_event = []
   a_mem_chat = []
@@ -244,8 +240,9 @@ def process_environment(request):
   """
   <FRONTEND to BACKEND>
   This sends the frontend visual world information to the backend server.
-  It does this by writing the current environment representation to
-  "storage/environment.json" file.
+  It does this by pushing the current environment representation through
+  the Reverie channel, or, if Reverie is not listening on it, by writing it
+  to the "storage/{sim_code}/environment/{step}.json" file.
 
   ARGS:
     request: Django request
@@ -261,8 +258,10 @@ def process_environment(request):
   sim_code = data["sim_code"]
   environment = data["environment"]
 
-  with open(f"storage/{sim_code}/environment/{step}.json", "w") as outfile:
-    outfile.write(json.dumps(environment, indent=2))
+  # Reverie records the environments it receives through the channel itself.
+  if not reverie_channel.send_environment(sim_code, step, environment):
+    with open(f"storage/{sim_code}/environment/{step}.json", "w") as outfile:
+      outfile.write(json.dumps(environment))
 
   return HttpResponse("received")
 
@@ -273,9 +272,12 @@ def update_environment(request):
   <BACKEND to FRONTEND>
   This sends the backend computation of the persona behavior to the frontend
   visual server.
-  It does this by reading the new movement information from
+  It does this by serving the movement Reverie pushed through the Reverie
+  channel, or by reading the new movement information from
   compressed_storage/{sim_code}/master_movement.json file or
-  storage/{sim_code}/movement/{step}.json file.
+  storage/{sim_code}/movement/{step}.json file (see movement_store.py). If
+  the request has a "count", up to that many steps are returned, the ones
+  after <step> under "<upcoming>".
 
   ARGS:
     request: Django request
@@ -283,31 +285,21 @@ def update_environment(request):
     HttpResponse
   """
   data = json.loads(request.body)
-  step = str(data["step"])
+  step = int(data["step"])
   sim_code = data["sim_code"]
-
-  response_data = {"<step>": -1}
-
-  # First try compressed storage (for demo mode)
-  move_file = f"compressed_storage/{sim_code}/master_movement.json"
-
-  if check_if_file_exists(move_file):
-    with open(move_file) as json_file:
-      all_movement = json.load(json_file)
-      if step in all_movement:
-        response_data = all_movement[step]
-        response_data["<step>"] = int(step)
-  else:
-    # If not found in compressed storage, try regular storage (for simulation mode)
-    move_file = f"storage/{sim_code}/movement/{step}.json"
-    if check_if_file_exists(move_file):
-      print(f"Found movement file: {move_file}")
-      with open(move_file) as json_file:
-        movement_data = json.load(json_file)
-        response_data = movement_data
-        response_data["<step>"] = int(step)
-
-  return JsonResponse(response_data)
+  count = int(data.get("count", 1))
+
+  # Movements pushed by a running simulation need no disk access at all.
+  movement = reverie_channel.get_movement(sim_code, step)
+  if movement is not None:
+    response_data = dict(movement)
+    response_data["<step>"] = step
+    return JsonResponse(response_data)
+
+  response = movement_response(sim_code, step, count)
+  if response is None:
+    return JsonResponse({"<step>": -1})
+  return HttpResponse(response, content_type="application/json")
 
 
 @csrf_exempt
@@ -0,0 +1,370 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: benchmark.py
+Description: Measures how fast the simulation runs, end to end, without a
+model. The benchmark starts the mock Ollama server (mock_llm_server.py) in
+its own process, points gpt_structure.py at it with the LLM cache and the
+embedding store turned off, and runs headless simulations of the_ville with
+3, 25 and 100 personas for a number of steps each. It reports, as JSON:
+  steps/sec (overall, and without the first step, which plans the day),
+  the time of each step (mean, median, 95th percentile, max),
+  the time spent in each phase of a step (perceive, retrieve, plan, react,
+    reflect, execute, as timed by the step profiler in profiler.py, and the
+    rest of the step outside move_personas), and
+  the LLM chat and embedding requests per step, per prompt template.
+
+The 3 personas are base_the_ville_isabella_maria_klaus and the 25 are
+base_the_ville_n25. Other counts are made from base_the_ville_n25: its first
+n personas, or, beyond 25, copies of them with a number after the first
+name (e.g., "Isabella2 Rodriguez") that start where the original does. The
+forks and the made-up base simulations are deleted afterwards unless --keep
+is given.
+
+Usage (from reverie/backend_server):
+  python benchmark.py
+  python benchmark.py --personas 3 25 --steps 50 --latency 100 --jitter 50
+  python benchmark.py --step-workers 8 --output benchmark.json
+"""
+import argparse
+import collections
+import contextlib
+import datetime
+import importlib
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import urllib.request
+
+import utils
+from global_methods import sim_step_file
+
+BASE_SIMS = {3: "base_the_ville_isabella_maria_klaus",
+             25: "base_the_ville_n25"}
+# The simulation the other persona counts are made from.
+POPULATION_SIM = "base_the_ville_n25"
+PHASES = ["perceive", "retrieve", "plan", "react", "reflect", "execute"]
+
+
+def phase_totals(profiler):
+  """
+  Returns the calls and seconds of every phase the step profiler (see
+  profiler.py) has timed since it started. The phases of several personas
+  may run at once (see ReverieServer.step_workers), so their times add up to
+  more than the wall time of the step.
+  """
+  with profiler.lock:
+    return {name: tuple(total) for (kind, name), total
+            in profiler.totals.items() if kind == "phase"}
+
+
+def phase_report(before, after):
+  """
+  Returns the phases timed between two phase_totals.
+  """
+  report = dict()
+  for phase in PHASES:
+    calls = after.get(phase, (0, 0))[0] - before.get(phase, (0, 0))[0]
+    seconds = after.get(phase, (0, 0))[1] - before.get(phase, (0, 0))[1]
+    report[phase] = {"calls": calls,
+                     "total_sec": round(seconds, 4),
+                     "mean_ms": round(1000 * seconds / max(1, calls), 3)}
+  return report
+
+
+def start_mock_server(latency, jitter):
+  """
+  Starts mock_llm_server.py in its own process, so that answering requests
+  does not compete with the simulation for the interpreter.
+
+  OUTPUT
+    The process and the server's URL.
+  """
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "mock_llm_server.py")
+  process = subprocess.Popen(
+    [sys.executable, script, "--port", "0", "--latency", str(latency),
+     "--jitter", str(jitter)],
+    stdout=subprocess.PIPE, text=True)
+  line = process.stdout.readline()
+  if not line.startswith("Mock LLM server listening on "):
+    process.kill()
+    raise RuntimeError(f"mock LLM server did not start: {line!r}")
+  return process, line.strip().split(" ")[-1]
+
+
+def llm_stats(url):
+  with urllib.request.urlopen(f"{url}/api/stats") as response:
+    return collections.Counter(json.loads(response.read()))
+
+
+def load_reverie(url, debug):
+  """
+  Points the LLM requests at <url> and imports reverie. utils.py is
+  overridden before anything copies its settings, so the user's settings
+  file is left as it is.
+  """
+  utils.use_ollama = True
+  utils.ollama_base_url = url
+  utils.llm_cache_path = None
+  utils.embedding_store_path = None
+  utils.profile_path = None
+  utils.debug = debug
+  return importlib.import_module("reverie")
+
+
+def make_population_sim(n_personas, sim_code):
+  """
+  Makes a base simulation with <n_personas> personas out of POPULATION_SIM,
+  in storage/<sim_code>.
+  """
+  source = f"{utils.fs_storage}/{POPULATION_SIM}"
+  target = f"{utils.fs_storage}/{sim_code}"
+  with open(f"{source}/reverie/meta.json") as json_file:
+    meta = json.load(json_file)
+  # The source may be a copy-on-write fork, whose environment is then in
+  # the simulation it was forked from.
+  with open(sim_step_file(source, "environment", meta["step"])) as json_file:
+    environment = json.load(json_file)
+
+  os.makedirs(f"{target}/personas")
+  os.makedirs(f"{target}/environment")
+  # The new simulation has an environment of its own, so it is not a fork.
+  shutil.copytree(f"{source}/reverie", f"{target}/reverie",
+                  ignore=shutil.ignore_patterns("parent.json"))
+  names = []
+  originals = meta["persona_names"]
+  for count in range(n_personas):
+    original = originals[count % len(originals)]
+    copy_number = count // len(originals) + 1
+    folder = f"{target}/personas"
+    if copy_number == 1:
+      name = original
+      shutil.copytree(f"{source}/personas/{original}", f"{folder}/{name}")
+    else:
+      first_name, last_name = original.split(" ", 1)
+      name = f"{first_name}{copy_number} {last_name}"
+      shutil.copytree(f"{source}/personas/{original}", f"{folder}/{name}")
+      scratch_file = f"{folder}/{name}/bootstrap_memory/scratch.json"
+      with open(scratch_file) as json_file:
+        scratch = json.load(json_file)
+      scratch["name"] = name
+      scratch["first_name"] = f"{first_name}{copy_number}"
+      with open(scratch_file, "w") as outfile:
+        outfile.write(json.dumps(scratch, indent=2))
+    environment[name] = dict(environment[original])
+    names += [name]
+
+  environment = {name: environment[name] for name in names}
+  with open(f"{target}/environment/{meta['step']}.json", "w") as outfile:
+    outfile.write(json.dumps(environment, indent=2))
+  meta["persona_names"] = names
+  meta["fork_sim_code"] = sim_code
+  with open(f"{target}/reverie/meta.json", "w") as outfile:
+    outfile.write(json.dumps(meta, indent=2))
+
+
+def summarize_times(times):
+  times = sorted(times)
+  if not times:
+    return None
+  return {"mean": round(statistics.mean(times), 4),
+          "p50": round(times[len(times) // 2], 4),
+          "p95": round(times[min(len(times) - 1, int(len(times) * 0.95))], 4),
+          "max": round(times[-1], 4)}
+
+
+def run_benchmark(reverie, url, fork_sim_code, sim_code, steps,
+                  step_workers=1, seed=0, log=None):
+  """
+  Runs <steps> headless steps of a fork of <fork_sim_code> and measures
+  them.
+
+  OUTPUT
+    A dictionary of the measurements (see the module docstring). If a step
+    fails, the steps before it are reported along with the error.
+  """
+  result = {"fork_sim_code": fork_sim_code, "steps": steps}
+  profiler = reverie.PROFILER
+  phases_before = phase_totals(profiler)
+  step_times = []
+  move_times = []
+  before = llm_stats(url)
+
+  rs = None
+  load_start = time.perf_counter()
+  try:
+    with contextlib.redirect_stdout(log):
+      rs = reverie.ReverieServer(fork_sim_code, sim_code)
+      rs.step_workers = step_workers
+      rs.seed = seed
+      result["personas"] = len(rs.personas)
+      result["load_sec"] = round(time.perf_counter() - load_start, 4)
+
+      # move_personas is the cognitive part of a step; the rest is moving
+      # the personas on the maze and writing the step's files.
+      move_personas = rs.move_personas
+      def timed_move_personas():
+        start = time.perf_counter()
+        try:
+          return move_personas()
+        finally:
+          move_times.append(time.perf_counter() - start)
+      rs.move_personas = timed_move_personas
+
+      for _ in range(steps):
+        start = time.perf_counter()
+        rs.start_server(1, headless=True)
+        step_times += [time.perf_counter() - start]
+
+      start = time.perf_counter()
+      rs.save()
+      result["save_sec"] = round(time.perf_counter() - start, 4)
+  except Exception as e:
+    result["error"] = "".join(
+      traceback.format_exception_only(type(e), e)).strip()
+    if log is not None:
+      traceback.print_exc(file=log)
+    # The phases of the step that failed count towards this run, not the
+    # next one.
+    profiler.end_step(sim_code, rs.step if rs else 0, 0.0, "error")
+
+  after = llm_stats(url)
+  n_steps = len(step_times)
+  wall = sum(step_times)
+  result["completed_steps"] = n_steps
+  result["wall_sec"] = round(wall, 4)
+  result["steps_per_sec"] = round(n_steps / wall, 4) if wall else None
+  result["first_step_sec"] = round(step_times[0], 4) if step_times else None
+  rest = step_times[1:]
+  result["steady_steps_per_sec"] = (round(len(rest) / sum(rest), 4)
+                                    if rest else None)
+  result["step_sec"] = summarize_times(step_times)
+
+  phases = phase_report(phases_before, phase_totals(profiler))
+  other = sum(step_times[:len(move_times)]) - sum(move_times)
+  phases["outside_move_personas"] = {"calls": n_steps,
+                                     "total_sec": round(other, 4),
+                                     "mean_ms": round(1000 * other
+                                                      / max(1, n_steps), 3)}
+  result["phases"] = phases
+
+  chat = after["chat"] - before["chat"]
+  embeddings = after["embeddings"] - before["embeddings"]
+  by_template = {key.split(":", 1)[1]: after[key] - before[key]
+                 for key in sorted(after)
+                 if key.startswith("chat:") and after[key] - before[key]}
+  result["llm"] = {
+    "chat_calls": chat,
+    "embedding_calls": embeddings,
+    "chat_calls_per_step": round(chat / n_steps, 3) if n_steps else None,
+    "embedding_calls_per_step": (round(embeddings / n_steps, 3)
+                                 if n_steps else None),
+    "chat_calls_by_template": by_template}
+  return result
+
+
+@contextlib.contextmanager
+def preserved_temp_storage():
+  """
+  ReverieServer announces itself to the frontend through the temp storage;
+  this puts the files there back the way they were.
+  """
+  saved = dict()
+  for name in ["curr_sim_code.json", "curr_step.json"]:
+    path = f"{utils.fs_temp_storage}/{name}"
+    saved[path] = None
+    if os.path.exists(path):
+      with open(path) as data_file:
+        saved[path] = data_file.read()
+  try:
+    yield
+  finally:
+    for path, content in saved.items():
+      if content is None:
+        if os.path.exists(path):
+          os.remove(path)
+      else:
+        with open(path, "w") as outfile:
+          outfile.write(content)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description="Benchmark headless simulations against a mock LLM.")
+  parser.add_argument("--personas", type=int, nargs="+", default=[3, 25, 100],
+                      help="the persona counts to run")
+  parser.add_argument("--steps", type=int, default=20,
+                      help="the steps to run per persona count")
+  parser.add_argument("--latency", type=float, default=0,
+                      help="the milliseconds every LLM request takes at least")
+  parser.add_argument("--jitter", type=float, default=0,
+                      help="up to this many milliseconds are added to the "
+                           "latency of an LLM request")
+  parser.add_argument("--step-workers", type=int, default=1,
+                      help="ReverieServer.step_workers")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="the personas' random seed")
+  parser.add_argument("--output", help="write the JSON report here too")
+  parser.add_argument("--log", default=os.devnull,
+                      help="where the simulation's output goes")
+  parser.add_argument("--debug", action="store_true",
+                      help="keep utils.debug on (more output, slower)")
+  parser.add_argument("--profile",
+                      help="keep the step profiler's timings (JSON lines) "
+                           "here; see profiler.py")
+  parser.add_argument("--keep", action="store_true",
+                      help="keep the simulations the benchmark made")
+  args = parser.parse_args()
+
+  process, url = start_mock_server(args.latency, args.jitter)
+  reverie = load_reverie(url, args.debug)
+  # The phases are timed by the step profiler.
+  profile_folder = tempfile.TemporaryDirectory()
+  reverie.PROFILER.start(args.profile
+                         or f"{profile_folder.name}/profile.jsonl")
+  stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+  report = {"started": stamp,
+            "config": {"personas": args.personas, "steps": args.steps,
+                       "latency_ms": args.latency, "jitter_ms": args.jitter,
+                       "step_workers": args.step_workers, "seed": args.seed,
+                       "debug": args.debug},
+            "runs": []}
+  made = []
+  try:
+    with open(args.log, "a") as log, preserved_temp_storage():
+      for n_personas in args.personas:
+        fork_sim_code = BASE_SIMS.get(n_personas)
+        if fork_sim_code is None:
+          fork_sim_code = f"benchmark-{stamp}-base-n{n_personas}"
+          make_population_sim(n_personas, fork_sim_code)
+          made += [fork_sim_code]
+        sim_code = f"benchmark-{stamp}-n{n_personas}"
+        made += [sim_code]
+        print (f"Running {args.steps} steps with {n_personas} personas...",
+               file=sys.stderr)
+        result = run_benchmark(reverie, url, fork_sim_code, sim_code,
+                               args.steps, args.step_workers,
+                               args.seed, log)
+        report["runs"] += [result]
+  finally:
+    process.terminate()
+    process.wait()
+    reverie.PROFILER.stop()
+    profile_folder.cleanup()
+    if not args.keep:
+      # Forks first: they read their history from the base they came from.
+      for sim_code in reversed(made):
+        shutil.rmtree(f"{utils.fs_storage}/{sim_code}", ignore_errors=True)
+
+  output = json.dumps(report, indent=2)
+  print (output)
+  if args.output:
+    with open(args.output, "w") as outfile:
+      outfile.write(output)
@@ -0,0 +1,91 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: compile_maze.py
+Description: Builds and checks the compiled maze cache of the current map 
+(<env_matrix> in utils.py). Maze builds the cache by itself the first time it
+reads a map; this script lets you build it ahead of time (e.g., after editing
+the Tiled exports) and check that it matches the exports. 
+
+Usage (from reverie/backend_server): 
+  python compile_maze.py             # build the cache if it is missing
+  python compile_maze.py --force     # rebuild the cache
+  python compile_maze.py --verify    # check the cache against the exports
+"""
+import argparse
+import sys
+import time
+
+from maze import *
+
+
+def compare_mazes(compiled, parsed): 
+  """
+  Compares a maze loaded from the compiled cache with one parsed from the 
+  Tiled exports. 
+
+  INPUT
+    compiled: A <Maze> loaded from the cache. 
+    parsed: A <Maze> read with use_compiled=False. 
+  OUTPUT
+    A list of the differences found (empty if the two mazes match). 
+  """
+  differences = []
+  for name in ["sector_grid", "arena_grid", "game_object_grid", 
+               "spawning_location_grid", "collision_grid", "arena_sectors", 
+               "game_object_arenas"]: 
+    if not numpy.array_equal(getattr(compiled, name), getattr(parsed, name)): 
+      differences += [name]
+  for name in ["world", "sector_names", "arena_names", "game_object_names", 
+               "spawning_location_names", "collision_blocks"]: 
+    if getattr(compiled, name) != getattr(parsed, name): 
+      differences += [name]
+  if compiled.address_tiles != parsed.address_tiles: 
+    differences += ["address_tiles"]
+  else: 
+    # The order the tiles of an address come out in matters too, since 
+    # personas sample their destinations from it. 
+    for address, tiles in parsed.address_tiles.items(): 
+      if list(compiled.address_tiles[address]) != list(tiles): 
+        differences += [f"address_tiles order of {address}"]
+  return differences
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description="Build or verify the compiled maze cache.")
+  parser.add_argument("--force", action="store_true", 
+                      help="rebuild the cache even if it exists")
+  parser.add_argument("--verify", action="store_true", 
+                      help="check the cache against the Tiled exports")
+  args = parser.parse_args()
+
+  compiled_path = compiled_maze_path(env_matrix)
+  exists = (os.path.exists(f"{compiled_path}.npz") 
+            and os.path.exists(f"{compiled_path}.pkl"))
+
+  if args.verify: 
+    if not exists: 
+      print (f"No compiled maze at {compiled_path}.")
+      sys.exit(1)
+    compiled = Maze("verify")
+    parsed = Maze("verify", use_compiled=False)
+    differences = compare_mazes(compiled, parsed)
+    if differences: 
+      print (f"{compiled_path} does not match {env_matrix}:")
+      for difference in differences: 
+        print (f"  {difference}")
+      sys.exit(1)
+    print (f"{compiled_path} matches {env_matrix}.")
+    sys.exit(0)
+
+  if exists and not args.force: 
+    print (f"{compiled_path} is up to date.")
+  else: 
+    maze = Maze("compile", use_compiled=False)
+    maze.save_compiled(compiled_path)
+    print (f"Compiled {env_matrix} to {compiled_path}.")
+
+  start = time.time()
+  Maze("compile")
+  print (f"Maze loads in {(time.time() - start) * 1000:.1f} ms.")
@@ -0,0 +1,65 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: convert_memory_storage.py
+Description: Converts the personas' associative memories of saved simulations
+from the original JSON layout (nodes.json, embeddings.json) to the binary 
+layout described in persona/memory_structures/associative_memory.py. 
+
+Usage (from reverie/backend_server): 
+  python convert_memory_storage.py <sim_code> [<sim_code> ...]
+  python convert_memory_storage.py --all
+"""
+import argparse
+import os
+
+from global_methods import *
+from utils import *
+from persona.memory_structures.associative_memory import convert_json_memory
+
+fs_compressed_storage = f"{os.path.dirname(fs_storage)}/compressed_storage"
+
+
+def convert_sim(sim_folder): 
+  """
+  Converts every persona's associative memory in a simulation folder. 
+
+  INPUT
+    sim_folder: Path to storage/<sim_code> or compressed_storage/<sim_code>.
+  OUTPUT
+    The number of associative memory folders that were converted. 
+  """
+  count = 0
+  persona_folder = f"{sim_folder}/personas"
+  if not os.path.exists(persona_folder): 
+    return count
+  for persona in sorted(find_filenames(persona_folder, "")): 
+    a_mem_folder = f"{persona}/bootstrap_memory/associative_memory"
+    if os.path.exists(f"{a_mem_folder}/nodes.json"): 
+      if convert_json_memory(a_mem_folder): 
+        print (f"converted {a_mem_folder}")
+        count += 1
+  return count
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description="Convert associative memories to the binary layout.")
+  parser.add_argument("sim_codes", nargs="*", 
+                      help="simulations to convert")
+  parser.add_argument("--all", action="store_true", 
+                      help="convert every simulation in storage and "
+                           "compressed_storage")
+  args = parser.parse_args()
+
+  sim_folders = []
+  for storage in [fs_storage, fs_compressed_storage]: 
+    if args.all: 
+      sim_folders += sorted(find_filenames(storage, ""))
+    else: 
+      sim_folders += [f"{storage}/{sim_code}" for sim_code in args.sim_codes]
+
+  total = 0
+  for sim_folder in sim_folders: 
+    total += convert_sim(sim_folder)
+  print (f"{total} associative memories converted.")
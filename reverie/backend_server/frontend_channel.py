@@ -0,0 +1,225 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: frontend_channel.py
+Description: A local socket channel between Reverie and the frontend server.
+Reverie listens on a Unix socket in the temp storage folder; the frontend
+server connects to it, pushes each environment as soon as the browser posts
+it, and receives each movement as soon as the personas have moved. This
+replaces the polling of environment/<step>.json and movement/<step>.json,
+which are still written as the record of the simulation and remain the
+fallback whenever the channel is not connected. The channel writes each
+environment it receives to its file right away, so that one pushed after
+the last step Reverie ran (e.g., before "fin") is not lost.
+
+Messages are compact JSON objects, one per line:
+  {"type": "environment", "sim_code": .., "step": .., "environment": {..}}
+  {"type": "movement", "sim_code": .., "step": .., "movement": {..}}
+The frontend side lives in environment/frontend_server/translator/
+reverie_channel.py.
+"""
+import collections
+import json
+import os
+import socket
+import threading
+
+CHANNEL_FILE_NAME = "reverie.sock"
+# The number of recent movements sent to a frontend server when it connects,
+# so that it does not miss the ones produced while it was away.
+MOVEMENT_BACKLOG = 8
+
+
+def encode_message(message):
+  return (json.dumps(message, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+class FrontendChannel:
+  def __init__(self, path, storage):
+    """
+    Starts listening on the Unix socket at <path>. If the platform has no
+    Unix sockets or the socket cannot be created, the channel stays closed
+    and Reverie falls back to the file protocol.
+
+    INPUT
+      path: the socket file, e.g., "<fs_temp_storage>/reverie.sock"
+      storage: the folder of the simulations (fs_storage), where the
+               environments received are written.
+    OUTPUT
+      None
+    """
+    self.path = path
+    self.storage = storage
+    # <environments> holds the environments pushed by the frontend that
+    # Reverie has not picked up yet, keyed by (sim_code, step).
+    self.environments = dict()
+    self.movements = collections.deque(maxlen=MOVEMENT_BACKLOG)
+    self.clients = []
+    self.cond = threading.Condition()
+    self.send_lock = threading.Lock()
+    self.server = None
+
+    if not hasattr(socket, "AF_UNIX"):
+      return
+    try:
+      if os.path.exists(path):
+        # A socket left behind by a Reverie that did not shut down cleanly.
+        os.unlink(path)
+      server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      server.bind(path)
+      server.listen()
+    except OSError as e:
+      print (f"Frontend channel unavailable ({e}); using files only.")
+      return
+    self.server = server
+    threading.Thread(target=self.accept_loop, name="frontend-channel",
+                     daemon=True).start()
+
+
+  def is_open(self):
+    return self.server is not None
+
+
+  def accept_loop(self):
+    while True:
+      try:
+        conn, _ = self.server.accept()
+      except OSError:
+        return
+      with self.send_lock:
+        with self.cond:
+          backlog = list(self.movements)
+          self.clients += [conn]
+        try:
+          for line in backlog:
+            conn.sendall(line)
+        except OSError:
+          self.drop(conn)
+          continue
+      threading.Thread(target=self.read_loop, args=(conn,),
+                       name="frontend-channel-client", daemon=True).start()
+
+
+  def read_loop(self, conn):
+    try:
+      for line in conn.makefile("rb"):
+        try:
+          message = json.loads(line)
+          if message["type"] != "environment":
+            continue
+          key = (message["sim_code"], int(message["step"]))
+        except (ValueError, KeyError, TypeError):
+          continue
+        self.write_environment(key, message["environment"])
+        with self.cond:
+          self.environments[key] = message["environment"]
+          self.cond.notify_all()
+    except OSError:
+      pass
+    self.drop(conn)
+
+
+  def write_environment(self, key, environment):
+    """
+    Writes an environment pushed by the frontend to
+    "<storage>/<sim_code>/environment/<step>.json", as the frontend would
+    have without the channel.
+    """
+    sim_code, step = key
+    env_folder = f"{self.storage}/{sim_code}/environment"
+    if not os.path.isdir(env_folder):
+      return
+    env_file = f"{env_folder}/{step}.json"
+    try:
+      with open(f"{env_file}.tmp", "w") as outfile:
+        outfile.write(json.dumps(environment))
+      os.replace(f"{env_file}.tmp", env_file)
+    except OSError as e:
+      print (f"Could not write {env_file} ({e}).")
+
+
+  def drop(self, conn):
+    with self.cond:
+      if conn in self.clients:
+        self.clients.remove(conn)
+    try:
+      # shutdown() also ends the read loop, which holds its own reference.
+      conn.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+    try:
+      conn.close()
+    except OSError:
+      pass
+
+
+  def wait_environment(self, sim_code, step, timeout):
+    """
+    Waits up to <timeout> seconds for the frontend to push the environment
+    of <step>.
+
+    INPUT
+      sim_code: the current simulation code.
+      step: the step whose environment we need.
+      timeout: the longest we wait, in seconds.
+    OUTPUT
+      The environment dictionary (persona name -> {"maze", "x", "y"}), or
+      None if it did not arrive in time.
+    """
+    key = (sim_code, step)
+    with self.cond:
+      if self.server is not None:
+        self.cond.wait_for(lambda: key in self.environments, timeout)
+      environment = self.environments.pop(key, None)
+      for stale_key in [k for k in self.environments
+                        if k[0] == sim_code and k[1] < step]:
+        del self.environments[stale_key]
+      return environment
+
+
+  def send_movement(self, sim_code, step, movement):
+    """
+    Pushes the movement of <step> to every connected frontend server.
+
+    INPUT
+      sim_code: the current simulation code.
+      step: the step the movement belongs to.
+      movement: the movement dictionary, as written to the movement file.
+    OUTPUT
+      None
+    """
+    if self.server is None:
+      return
+    line = encode_message({"type": "movement",
+                           "sim_code": sim_code,
+                           "step": step,
+                           "movement": movement})
+    with self.send_lock:
+      with self.cond:
+        self.movements.append(line)
+        clients = list(self.clients)
+      for conn in clients:
+        try:
+          conn.sendall(line)
+        except OSError:
+          self.drop(conn)
+
+
+  def close(self):
+    if self.server is None:
+      return
+    server = self.server
+    self.server = None
+    try:
+      server.close()
+    except OSError:
+      pass
+    with self.cond:
+      clients = list(self.clients)
+      self.cond.notify_all()
+    for conn in clients:
+      self.drop(conn)
+    try:
+      os.unlink(self.path)
+    except OSError:
+      pass
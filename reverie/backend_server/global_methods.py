@@ -15,6 +15,7 @@ import sys
 import numpy
 import math
 import shutil, errno
+import json
 
 from os import listdir
 
@@ -225,6 +226,145 @@ def copyanything(src, dst):
     else: raise
 
 
+def link_or_copy(src, dst): 
+  """
+  Hardlinks the file <src> to <dst> if it is in an associative memory 
+  folder, and copies it otherwise (or if it cannot be linked, e.g., across 
+  file systems). The associative memory files are only ever replaced 
+  through a new file and a rename (see write_file_atomic in 
+  associative_memory.py), never written in place, so a simulation and its 
+  forks can share them. 
+  ARGS:
+    src: address of the source file  
+    dst: address of the destination file  
+  RETURNS: 
+    dst
+  """
+  if os.path.basename(os.path.dirname(src)) == "associative_memory": 
+    try: 
+      os.link(src, dst)
+      return dst
+    except OSError: 
+      pass
+  return shutil.copy2(src, dst)
+
+
+def fork_sim_folder(fork_folder, sim_folder): 
+  """
+  Creates <sim_folder> as a copy-on-write fork of the simulation in 
+  <fork_folder>. Everything but the step histories (environment/ and 
+  movement/) is copied, except for the personas' associative memory files,
+  which are hardlinked (see link_or_copy). The fork starts the step 
+  histories empty, and reverie/parent.json points to <fork_folder> and the
+  step it is forked at, so the parent's files up to that step are read from
+  the parent (see sim_step_file). 
+  ARGS:
+    fork_folder: address of the simulation we fork from 
+    sim_folder: address of the new simulation's folder 
+  RETURNS: 
+    None
+  """
+  with open(f"{fork_folder}/reverie/meta.json") as json_file: 
+    fork_step = json.load(json_file)["step"]
+
+  os.makedirs(sim_folder)
+  for name in listdir(fork_folder): 
+    if name in ["environment", "movement"]: 
+      os.makedirs(f"{sim_folder}/{name}")
+    elif os.path.isdir(f"{fork_folder}/{name}"): 
+      shutil.copytree(f"{fork_folder}/{name}", f"{sim_folder}/{name}", 
+                      copy_function=link_or_copy)
+    else: 
+      copyanything(f"{fork_folder}/{name}", f"{sim_folder}/{name}")
+
+  parent = {"sim_code": os.path.basename(fork_folder.rstrip("/")), 
+            "step": fork_step}
+  with open(f"{sim_folder}/reverie/parent.json", "w") as outfile: 
+    outfile.write(json.dumps(parent, indent=2))
+
+
+def sim_parent(sim_folder): 
+  """
+  Returns the parent of a copy-on-write fork. 
+  ARGS:
+    sim_folder: address of the simulation's folder 
+  RETURNS: 
+    (parent_folder, fork_step), or None if the simulation is not a 
+    copy-on-write fork. 
+  """
+  parent_file = f"{sim_folder}/reverie/parent.json"
+  if not os.path.exists(parent_file): 
+    return None
+  with open(parent_file) as json_file: 
+    parent = json.load(json_file)
+  parent_folder = f"{os.path.dirname(sim_folder.rstrip('/'))}/{parent['sim_code']}"
+  return parent_folder, parent["step"]
+
+
+def inherits_step(history, step, fork_step): 
+  """
+  Whether a fork at <fork_step> sees its parent's <history> file of <step>. 
+  The fork shares the environment its parent was at when it was forked, but
+  makes its own movement from there. 
+  """
+  if history == "environment": 
+    return step <= fork_step
+  return step < fork_step
+
+
+def sim_step_file(sim_folder, history, step): 
+  """
+  Finds the file of a step in a simulation's history, following 
+  copy-on-write forks back to the simulation that wrote it. 
+  ARGS:
+    sim_folder: address of the simulation's folder 
+    history: "environment" or "movement" 
+    step: the step 
+  RETURNS: 
+    The address of {history}/{step}.json, or None if there is no such file.
+  """
+  while True: 
+    curr_file = f"{sim_folder}/{history}/{step}.json"
+    if os.path.exists(curr_file): 
+      return curr_file
+    parent = sim_parent(sim_folder)
+    if not parent or not inherits_step(history, step, parent[1]): 
+      return None
+    sim_folder = parent[0]
+
+
+def sim_step_files(sim_folder, history): 
+  """
+  Finds all the files of a simulation's history, following copy-on-write 
+  forks back to the simulations that wrote them. 
+  ARGS:
+    sim_folder: address of the simulation's folder 
+    history: "environment" or "movement" 
+  RETURNS: 
+    A dictionary from step to the address of its file. 
+  """
+  step_files = dict()
+  fork_step = None
+  while True: 
+    if os.path.exists(f"{sim_folder}/{history}"): 
+      for filename in listdir(f"{sim_folder}/{history}"): 
+        if filename[0] == "." or not filename.endswith(".json"): 
+          continue
+        step = int(filename[:-len(".json")])
+        if step in step_files: 
+          continue
+        if fork_step is None or inherits_step(history, step, fork_step): 
+          step_files[step] = f"{sim_folder}/{history}/{filename}"
+    parent = sim_parent(sim_folder)
+    if not parent: 
+      return step_files
+    sim_folder = parent[0]
+    if fork_step is None: 
+      fork_step = parent[1]
+    else: 
+      fork_step = min(fork_step, parent[1])
+
+
 if __name__ == '__main__':
   pass
 
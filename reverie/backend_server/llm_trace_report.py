@@ -0,0 +1,155 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: llm_trace_report.py
+Description: Summarizes LLM traces (see persona/prompt_template/llm_trace.py)
+to show which prompts to optimize first. For every prompt function (or
+prompt template, with --by template) it reports:
+  calls, attempts and retries (attempts beyond the first of each call),
+  the total and mean time of its calls and the 95th percentile call time,
+  the retry waste: the time spent on attempts whose response was thrown
+    away (it failed validation, could not be parsed, or was an error),
+  the calls that fell back to their fail-safe, the error responses, and
+    the attempts answered from the LLM cache,
+  the mean prompt and response length in characters.
+Two tables rank the prompts by total time and by retry waste.
+
+A trace is written by running reverie.py with --trace <file> (or with
+llm_trace_path set in utils.py).
+
+Usage (from reverie/backend_server):
+  python llm_trace_report.py llm_trace.jsonl
+  python llm_trace_report.py llm_trace.jsonl --by template --top 10
+  python llm_trace_report.py run1.jsonl run2.jsonl --json > report.json
+"""
+import argparse
+import collections
+import json
+import sys
+
+import numpy as np
+
+
+def read_trace(paths):
+  """
+  Returns the attempts in the trace files <paths>, grouped by call, as a
+  dictionary from call id to the call's attempt records in order. Lines that
+  are not complete JSON (e.g., the last line of a trace that is still being
+  written) are skipped.
+  """
+  calls = collections.OrderedDict()
+  for path in paths:
+    with open(path) as trace_file:
+      for line in trace_file:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          continue
+        calls.setdefault(record["call_id"], []).append(record)
+  for attempts in calls.values():
+    attempts.sort(key=lambda record: record["attempt"])
+  return calls
+
+
+def summarize(calls, by="function"):
+  """
+  Returns the statistics of every prompt function (or template) in
+  <calls>, as a dictionary from its name to its statistics.
+
+  INPUT
+    calls: what read_trace returns.
+    by: "function" or "template"; what to group the calls by.
+  """
+  groups = collections.defaultdict(list)
+  for attempts in calls.values():
+    groups[attempts[0].get(by) or "(none)"].append(attempts)
+
+  summary = dict()
+  for name, group in groups.items():
+    call_sec = [sum(record["latency_sec"] or 0 for record in attempts)
+                for attempts in group]
+    records = [record for attempts in group for record in attempts]
+    # An attempt is wasted if the call went on to another attempt or to its
+    # fail-safe. (Requests that are not validated have valid None.)
+    wasted = [record for record in records if record["valid"] is False]
+    summary[name] = {
+      "calls": len(group),
+      "attempts": len(records),
+      "retries": len(records) - len(group),
+      "total_sec": round(sum(call_sec), 6),
+      "mean_call_sec": round(sum(call_sec) / len(group), 6),
+      "p95_call_sec": round(float(np.percentile(call_sec, 95)), 6),
+      "wasted_sec": round(sum(record["latency_sec"] or 0
+                              for record in wasted), 6),
+      "wasted_attempts": len(wasted),
+      "fail_safes": sum(1 for attempts in group if attempts[0]["fail_safe"]),
+      "errors": collections.Counter(record["error"] for record in records
+                                    if record["error"]),
+      "cached_attempts": sum(1 for record in records if record["cached"]),
+      "mean_prompt_chars": round(sum(record["prompt_chars"]
+                                     for record in records) / len(records)),
+      "mean_response_chars": round(sum(record["response_chars"] or 0
+                                       for record in records)
+                                   / len(records)),
+      "wrappers": sorted(set(record["wrapper"] for record in records)),
+      "templates": sorted(set(record["template"] for record in records
+                              if record["template"])),
+      "functions": sorted(set(record["function"] for record in records
+                              if record["function"]))}
+  return summary
+
+
+def print_ranking(summary, key, title, top):
+  """
+  Prints the <top> entries of <summary> with the highest <key>, leaving out
+  the ones where it is 0.
+  """
+  ranked = [item for item in sorted(summary.items(),
+                                    key=lambda item: -item[1][key])
+            if item[1][key] > 0]
+  print (f"\n{title}")
+  if not ranked:
+    print ("(none)")
+    return
+  total = sum(stats[key] for stats in summary.values())
+  print (f"{'prompt':<48} {'calls':>6} {'retries':>7} {'fail-safe':>9} "
+         f"{'total s':>9} {'wasted s':>9} {'share':>6}")
+  for name, stats in ranked[:top]:
+    share = stats[key] / total
+    # Templates are shown without the folder they all share.
+    name = name.replace("persona/prompt_template/", "")
+    print (f"{name[-48:]:<48} {stats['calls']:>6} {stats['retries']:>7} "
+           f"{stats['fail_safes']:>9} {stats['total_sec']:>9.2f} "
+           f"{stats['wasted_sec']:>9.2f} {share:>6.1%}")
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description="Rank the prompts of LLM traces by time and retry waste.")
+  parser.add_argument("traces", nargs="+", help="the trace files to read")
+  parser.add_argument("--by", choices=["function", "template"],
+                      default="function",
+                      help="group the calls by prompt function or template")
+  parser.add_argument("--top", type=int, default=20,
+                      help="the number of prompts in each ranking")
+  parser.add_argument("--json", action="store_true",
+                      help="print the statistics as JSON instead of tables")
+  args = parser.parse_args()
+
+  calls = read_trace(args.traces)
+  if not calls:
+    sys.exit("No LLM calls in the trace.")
+  summary = summarize(calls, args.by)
+  if args.json:
+    print (json.dumps(summary, indent=2))
+  else:
+    records = [record for attempts in calls.values() for record in attempts]
+    print (f"{len(calls)} calls, {len(records)} attempts, "
+           f"{sum(stats['total_sec'] for stats in summary.values()):.2f} s "
+           f"of LLM time, of which "
+           f"{sum(stats['wasted_sec'] for stats in summary.values()):.2f} s "
+           f"on thrown away attempts; "
+           f"{sum(stats['fail_safes'] for stats in summary.values())} "
+           f"fail-safes.")
+    print_ranking(summary, "total_sec", "By total time:", args.top)
+    print_ranking(summary, "wasted_sec", "By retry waste:", args.top)
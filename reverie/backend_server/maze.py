@@ -5,18 +5,62 @@ File: maze.py
 Description: Defines the Maze class, which represents the map of the simulated
 world in a 2-dimensional matrix. 
 """
+import hashlib
+import heapq
 import json
 import numpy
+import os
 import datetime
 import pickle
 import time
 import math
 
 from global_methods import *
+from path_finder import *
 from utils import *
 
+# Bump this when the layout of the compiled maze cache changes. 
+COMPILED_MAZE_VERSION = 1
+# The side, in tiles, of the grid cells that the event index buckets tiles
+# into. 
+EVENT_CELL_SIZE = 8
+
+
+def matrix_hash(matrix_folder): 
+  """
+  Returns a hash of the contents of a maze matrix folder (the meta info, the
+  special blocks and the maze CSVs), which keys the compiled maze cache. 
+
+  INPUT
+    matrix_folder: e.g., "<maze_assets_loc>/the_ville/matrix"
+  OUTPUT
+    The hex digest of the folder contents. 
+  """
+  h = hashlib.sha256(f"compiled maze v{COMPILED_MAZE_VERSION}".encode())
+  files = ["maze_meta_info.json"]
+  for sub_folder in ["special_blocks", "maze"]: 
+    files += sorted(f"{sub_folder}/{name}" for name 
+                    in os.listdir(f"{matrix_folder}/{sub_folder}")
+                    if name.endswith(".csv"))
+  for name in files: 
+    with open(f"{matrix_folder}/{name}", "rb") as f: 
+      content = f.read()
+    h.update(f"{name}:{len(content)}:".encode())
+    h.update(content)
+  return h.hexdigest()
+
+
+def compiled_maze_path(matrix_folder): 
+  """
+  Returns the path (without extension) of the compiled maze cache for the
+  current contents of a maze matrix folder. 
+  e.g., "<matrix_folder>/compiled/maze_3f2a9c0d1b7e4a55"
+  """
+  return f"{matrix_folder}/compiled/maze_{matrix_hash(matrix_folder)[:16]}"
+
+
 class Maze: 
-  def __init__(self, maze_name): 
+  def __init__(self, maze_name, precompute_paths=False, use_compiled=True): 
     # READING IN THE BASIC META INFORMATION ABOUT THE MAP
     self.maze_name = maze_name
     # Reading in the meta information about the world. If you want tp see the
@@ -33,6 +77,81 @@ class Maze:
     # e.g., "planning to stay at home all day and never go out of her home"
     self.special_constraint = meta_info["special_constraint"]
 
+    # READING IN THE MAP
+    # The map is read from the compiled maze cache if there is one for the
+    # current contents of <env_matrix> (see compile_maze.py). Otherwise it is
+    # read from the Tiled exports and compiled, so that the next start (or 
+    # fork) can skip the parsing. 
+    compiled_path = None
+    if use_compiled: 
+      compiled_path = compiled_maze_path(env_matrix)
+    if not (compiled_path and self.load_compiled(compiled_path)): 
+      self.read_matrix(meta_info)
+      if compiled_path: 
+        self.save_compiled(compiled_path)
+
+    # <self.events> is the sparse event store: a dictionary from an (x, y)
+    # tile to the set of all events taking place in it. Only tiles whose 
+    # events differ from their default have an entry. By default, each game
+    # object tile holds the object's idle event, and every other tile holds
+    # no event. 
+    # e.g., self.tile_events((58, 9)) == 
+    #         {('double studio:double studio:bedroom 2:bed',
+    #           None, None, None)}
+    self.events = dict()
+
+    # <self.subject_events> and <self.arena_subjects> are the event registry
+    # of the event store, kept up to date by the store's sets (see 
+    # TileEventSet). <self.subject_events> maps the subject of an event (its
+    # first element, e.g., a persona's name) to the tiles its events are in,
+    # and <self.arena_subjects> maps an arena code to the number of events 
+    # of each subject in it. The default idle events of game objects are not
+    # in the registry until their tile gets an entry in the store. 
+    # e.g., self.subject_events["Isabella Rodriguez"] == 
+    #         {(72, 14): {('Isabella Rodriguez', 'is', 'idle', 'idle')}}
+    self.subject_events = dict()
+    self.arena_subjects = dict()
+
+    # <self.event_arenas> and <self.event_cells> are the spatial index of the
+    # tiles that may hold events: every game object tile, and every tile with
+    # an entry in the event store. The tiles are bucketed by arena code, and
+    # by arena code and grid cell of EVENT_CELL_SIZE x EVENT_CELL_SIZE tiles
+    # (the cells of all arenas together are under the arena None). See 
+    # query_events. 
+    # e.g., self.event_cells[(arena_code, 7, 1)] == {(58, 9), (59, 9), ...}
+    self.event_arenas = dict()
+    self.event_cells = dict()
+    ys, xs = numpy.nonzero(self.game_object_grid)
+    for tile in zip(xs.tolist(), ys.tolist()): 
+      self.index_event_tile(tile)
+
+    # <self.tiles> keeps the old self.tiles[row][col] access (a dictionary 
+    # per tile) working on top of the code grids. See access_tile. 
+    self.tiles = TileGridView(self)
+
+    # <self.path_engine> finds the personas' paths on the collision maze. It
+    # is built once here and reused for every search, with the arenas as the
+    # regions of its region graph. Distance fields to the addresses'
+    # tiles and distances between arenas are computed as they are needed, or
+    # all at once here if <precompute_paths> is True (slower start, faster 
+    # first moves). 
+    self.path_engine = PathFinder(self.collision_maze, collision_block_id, 
+                                  regions=self.arena_grid)
+    if precompute_paths: 
+      self.path_engine.precompute(self.address_tiles.values())
+      self.path_engine.precompute_regions()
+
+
+  def read_matrix(self, meta_info): 
+    """
+    Reads the map from the Tiled exports in <env_matrix> and sets up the code
+    grids, the string tables and <self.address_tiles>. 
+
+    INPUT
+      meta_info: The contents of maze_meta_info.json. 
+    OUTPUT
+      None
+    """
     # READING IN SPECIAL BLOCKS
     # Special blocks are those that are colored in the Tiled map. 
 
@@ -90,119 +209,260 @@ class Maze:
     # Loading the maze. The mazes are taken directly from the json exports of
     # Tiled maps. They should be in csv format. 
     # Importantly, they are "not" in a 2-d matrix format -- they are single 
-    # row matrices with the length of width x height of the maze. So we need
-    # to convert here. 
-    # We can do this all at once since the dimension of all these matrices are
-    # identical (e.g., 70 x 40).
-    # example format: [['0', '0', ... '25309', '0',...], ['0',...]...]
+    # row matrices with the length of width x height of the maze. So we 
+    # reshape them here (all of them have the same dimension, e.g., 70 x 40).
+    # example format: ['0', '0', ... '25309', '0',...]
     # 25309 is the collision bar number right now.
-    self.collision_maze = []
-    sector_maze = []
-    arena_maze = []
-    game_object_maze = []
-    spawning_location_maze = []
-    for i in range(0, len(collision_maze_raw), meta_info["maze_width"]): 
-      tw = meta_info["maze_width"]
-      self.collision_maze += [collision_maze_raw[i:i+tw]]
-      sector_maze += [sector_maze_raw[i:i+tw]]
-      arena_maze += [arena_maze_raw[i:i+tw]]
-      game_object_maze += [game_object_maze_raw[i:i+tw]]
-      spawning_location_maze += [spawning_location_maze_raw[i:i+tw]]
-
-    # Once we are done loading in the maze, we now set up self.tiles. This is
-    # a matrix accessed by row:col where each access point is a dictionary
-    # that contains all the things that are taking place in that tile. 
-    # More specifically, it contains information about its "world," "sector,"
-    # "arena," "game_object," "spawning_location," as well as whether it is a
-    # collision block, and a set of all events taking place in it. 
-    # e.g., self.tiles[32][59] = {'world': 'double studio', 
-    #            'sector': '', 'arena': '', 'game_object': '', 
-    #            'spawning_location': '', 'collision': False, 'events': set()}
-    # e.g., self.tiles[9][58] = {'world': 'double studio', 
-    #         'sector': 'double studio', 'arena': 'bedroom 2', 
-    #         'game_object': 'bed', 'spawning_location': 'bedroom-2-a', 
-    #         'collision': False,
-    #         'events': {('double studio:double studio:bedroom 2:bed',
-    #                    None, None)}} 
-    self.tiles = []
-    for i in range(self.maze_height): 
-      row = []
-      for j in range(self.maze_width):
-        tile_details = dict()
-        tile_details["world"] = wb
-        
-        tile_details["sector"] = ""
-        if sector_maze[i][j] in sb_dict: 
-          tile_details["sector"] = sb_dict[sector_maze[i][j]]
-        
-        tile_details["arena"] = ""
-        if arena_maze[i][j] in ab_dict: 
-          tile_details["arena"] = ab_dict[arena_maze[i][j]]
-        
-        tile_details["game_object"] = ""
-        if game_object_maze[i][j] in gob_dict: 
-          tile_details["game_object"] = gob_dict[game_object_maze[i][j]]
-        
-        tile_details["spawning_location"] = ""
-        if spawning_location_maze[i][j] in slb_dict: 
-          tile_details["spawning_location"] = slb_dict[spawning_location_maze[i][j]]
-        
-        tile_details["collision"] = False
-        if self.collision_maze[i][j] != "0": 
-          tile_details["collision"] = True
-
-        tile_details["events"] = set()
-        
-        row += [tile_details]
-      self.tiles += [row]
-    # Each game object occupies an event in the tile. We are setting up the 
-    # default event value here. 
-    for i in range(self.maze_height):
-      for j in range(self.maze_width): 
-        if self.tiles[i][j]["game_object"]:
-          object_name = ":".join([self.tiles[i][j]["world"], 
-                                  self.tiles[i][j]["sector"], 
-                                  self.tiles[i][j]["arena"], 
-                                  self.tiles[i][j]["game_object"]])
-          go_event = (object_name, None, None, None)
-          self.tiles[i][j]["events"].add(go_event)
+    shape = (self.maze_height, self.maze_width)
+    collision_maze_raw = numpy.array(collision_maze_raw).reshape(shape)
+    sector_maze_raw = numpy.array(sector_maze_raw).reshape(shape)
+    arena_maze_raw = numpy.array(arena_maze_raw).reshape(shape)
+    game_object_maze_raw = numpy.array(game_object_maze_raw).reshape(shape)
+    spawning_location_maze_raw = (numpy.array(spawning_location_maze_raw)
+                                  .reshape(shape))
+
+    # Once we are done loading in the maze, we set up the code grids. Rather
+    # than keeping a dictionary per tile, the maze is stored in columns: for
+    # each layer, a height x width int16 grid of codes, and a string table 
+    # that maps a code to its name. Code 0 is always the empty name. 
+    #   <sector_grid> / <sector_names>
+    #   <arena_grid> / <arena_names>: an arena code stands for a (sector, 
+    #     arena) pair, so two tiles have the same arena code exactly when they
+    #     have the same arena address. <arena_sectors> holds the sector code 
+    #     of each arena code. 
+    #   <game_object_grid> / <game_object_names>: likewise, a game object code
+    #     stands for an (arena, game object) pair; <game_object_arenas> holds
+    #     the arena code of each game object code. Tiles without a game object
+    #     all have code 0. 
+    #   <spawning_location_grid> / <spawning_location_names>
+    #   <collision_grid> / <collision_blocks>: codes of the raw collision
+    #     block ids ("0" for no collision). 
+    # e.g., for tile (58, 9): sector_names[sector_grid[9, 58]] == 
+    #   'double studio', arena_names[arena_grid[9, 58]] == 'bedroom 2'
+    self.world = wb
+
+    sector_table = {"": 0}
+    self.sector_grid = intern_grid(
+      sector_maze_raw, sector_table, lambda block: sb_dict.get(block, ""))
+    self.sector_names = list(sector_table)
+
+    arena_name_table = {"": 0}
+    arena_name_grid = intern_grid(
+      arena_maze_raw, arena_name_table, lambda block: ab_dict.get(block, ""))
+    arena_name_list = list(arena_name_table)
+    arena_table = {(0, 0): 0}
+    self.arena_grid = intern_grid(
+      self.sector_grid.astype(numpy.int32) * len(arena_name_table) 
+      + arena_name_grid, 
+      arena_table, 
+      lambda key: divmod(key, len(arena_name_table)))
+    self.arena_names = [arena_name_list[name] for _, name in arena_table]
+    self.arena_sectors = numpy.array([sector for sector, _ in arena_table], 
+                                     dtype=numpy.int16)
+
+    game_object_name_table = {"": 0}
+    game_object_name_grid = intern_grid(
+      game_object_maze_raw, game_object_name_table, 
+      lambda block: gob_dict.get(block, ""))
+    game_object_name_list = list(game_object_name_table)
+    game_object_table = {(0, 0): 0}
+    self.game_object_grid = intern_grid(
+      numpy.where(game_object_name_grid != 0, 
+                  self.arena_grid.astype(numpy.int32) 
+                  * len(game_object_name_table) + game_object_name_grid, 
+                  0), 
+      game_object_table, 
+      lambda key: divmod(key, len(game_object_name_table)))
+    self.game_object_names = [game_object_name_list[name] 
+                              for _, name in game_object_table]
+    self.game_object_arenas = numpy.array(
+      [arena for arena, _ in game_object_table], dtype=numpy.int16)
+
+    spawning_location_table = {"": 0}
+    self.spawning_location_grid = intern_grid(
+      spawning_location_maze_raw, spawning_location_table, 
+      lambda block: slb_dict.get(block, ""))
+    self.spawning_location_names = list(spawning_location_table)
+
+    collision_table = {"0": 0}
+    self.collision_grid = intern_grid(
+      collision_maze_raw, collision_table, lambda block: block)
+    self.collision_blocks = list(collision_table)
+
+    self.build_addresses()
 
     # Reverse tile access. 
     # <self.address_tiles> -- given a string address, we return a set of all 
     # tile coordinates belonging to that address (this is opposite of  
-    # self.tiles that give you the string address given a coordinate). This is
-    # an optimization component for finding paths for the personas' movement. 
+    # access_tile that gives you the string address given a coordinate). This
+    # is an optimization component for finding paths for the personas' 
+    # movement. 
     # self.address_tiles['<spawn_loc>bedroom-2-a'] == {(58, 9)}
     # self.address_tiles['double studio:recreation:pool table'] 
     #   == {(29, 14), (31, 11), (30, 14), (32, 11), ...}, 
     self.address_tiles = dict()
-    for i in range(self.maze_height):
-      for j in range(self.maze_width): 
-        addresses = []
-        if self.tiles[i][j]["sector"]: 
-          add = f'{self.tiles[i][j]["world"]}:'
-          add += f'{self.tiles[i][j]["sector"]}'
-          addresses += [add]
-        if self.tiles[i][j]["arena"]: 
-          add = f'{self.tiles[i][j]["world"]}:'
-          add += f'{self.tiles[i][j]["sector"]}:'
-          add += f'{self.tiles[i][j]["arena"]}'
-          addresses += [add]
-        if self.tiles[i][j]["game_object"]: 
-          add = f'{self.tiles[i][j]["world"]}:'
-          add += f'{self.tiles[i][j]["sector"]}:'
-          add += f'{self.tiles[i][j]["arena"]}:'
-          add += f'{self.tiles[i][j]["game_object"]}'
-          addresses += [add]
-        if self.tiles[i][j]["spawning_location"]: 
-          add = f'<spawn_loc>{self.tiles[i][j]["spawning_location"]}'
-          addresses += [add]
-
-        for add in addresses: 
-          if add in self.address_tiles: 
-            self.address_tiles[add].add((j, i))
-          else: 
-            self.address_tiles[add] = set([(j, i)])
+    layers = [(self.sector_grid, self.sector_names, self.sector_addresses), 
+              (self.arena_grid, self.arena_names, self.arena_addresses), 
+              (self.game_object_grid, self.game_object_names, 
+               self.game_object_addresses), 
+              (self.spawning_location_grid, self.spawning_location_names,
+               [f"<spawn_loc>{name}" 
+                for name in self.spawning_location_names])]
+    for grid, names, addresses in layers: 
+      # Tiles go in in row-major order, as they always have, so that each 
+      # set (and the order a list of it comes out in) stays the same. 
+      flat = grid.ravel()
+      order = numpy.argsort(flat, kind="stable")
+      codes, starts = numpy.unique(flat[order], return_index=True)
+      ends = list(starts[1:]) + [len(order)]
+      for code, start, end in zip(codes.tolist(), starts, ends): 
+        if not names[code]: 
+          continue
+        tiles = [(idx % self.maze_width, idx // self.maze_width) 
+                 for idx in order[start:end].tolist()]
+        self.address_tiles.setdefault(addresses[code], set()).update(tiles)
+
+
+  def build_addresses(self): 
+    """
+    Sets up the string addresses of every sector, arena and game object code
+    from the string tables. 
+    """
+    # e.g., self.arena_addresses[self.arena_grid[9, 58]] == 
+    #   'double studio:double studio:bedroom 2'
+    self.sector_addresses = [f"{self.world}:{sector}" 
+                             for sector in self.sector_names]
+    self.arena_addresses = [
+      f"{self.sector_addresses[self.arena_sectors[code]]}:{arena}"
+      for code, arena in enumerate(self.arena_names)]
+    self.game_object_addresses = [
+      f"{self.arena_addresses[self.game_object_arenas[code]]}:{game_object}"
+      for code, game_object in enumerate(self.game_object_names)]
+    # The reverse: from an arena's string address to its code. 
+    self.arena_codes = {address: code 
+                        for code, address in enumerate(self.arena_addresses)}
+
+
+  def save_compiled(self, compiled_path): 
+    """
+    Writes the code grids, the string tables and <self.address_tiles> to the
+    compiled maze cache: <compiled_path>.npz holds the arrays and 
+    <compiled_path>.pkl the tables. A cache that cannot be written is only
+    reported; the maze works the same without it. 
+
+    INPUT
+      compiled_path: The cache path without its extension, as returned by
+                     compiled_maze_path. 
+    OUTPUT
+      None
+    """
+    # The tiles of each address, in the order they were added (row-major), 
+    # as flat tile indices. 
+    addresses = list(self.address_tiles)
+    tile_index = []
+    offsets = [0]
+    for address in addresses: 
+      tiles = sorted(self.address_tiles[address], key=lambda t: (t[1], t[0]))
+      tile_index += [y * self.maze_width + x for x, y in tiles]
+      offsets += [len(tile_index)]
+
+    tables = {"version": COMPILED_MAZE_VERSION, 
+              "world": self.world, 
+              "sector_names": self.sector_names, 
+              "arena_names": self.arena_names, 
+              "game_object_names": self.game_object_names, 
+              "spawning_location_names": self.spawning_location_names, 
+              "collision_blocks": self.collision_blocks, 
+              "addresses": addresses}
+    try: 
+      os.makedirs(os.path.dirname(compiled_path), exist_ok=True)
+      # Both files are written under temporary names and then renamed, so 
+      # that a concurrent start never reads a half-written cache. 
+      with open(f"{compiled_path}.npz.tmp", "wb") as npz_file: 
+        numpy.savez(npz_file, 
+                    sector_grid=self.sector_grid, 
+                    arena_grid=self.arena_grid, 
+                    game_object_grid=self.game_object_grid, 
+                    spawning_location_grid=self.spawning_location_grid, 
+                    collision_grid=self.collision_grid, 
+                    arena_sectors=self.arena_sectors, 
+                    game_object_arenas=self.game_object_arenas, 
+                    address_tile_index=numpy.array(tile_index, 
+                                                   dtype=numpy.int32), 
+                    address_tile_offsets=numpy.array(offsets, 
+                                                     dtype=numpy.int32))
+      with open(f"{compiled_path}.pkl.tmp", "wb") as pkl_file: 
+        pickle.dump(tables, pkl_file)
+      os.replace(f"{compiled_path}.npz.tmp", f"{compiled_path}.npz")
+      os.replace(f"{compiled_path}.pkl.tmp", f"{compiled_path}.pkl")
+      # Caches of earlier versions of the map are of no use anymore. 
+      compiled_folder, compiled_name = os.path.split(compiled_path)
+      for name in os.listdir(compiled_folder): 
+        base, ext = os.path.splitext(name)
+        if (name.startswith("maze_") and ext in [".npz", ".pkl"] 
+            and base != compiled_name): 
+          os.remove(f"{compiled_folder}/{name}")
+    except OSError as e: 
+      print (f"Could not write the compiled maze {compiled_path}: {e}")
+
+
+  def load_compiled(self, compiled_path): 
+    """
+    Reads the code grids, the string tables and <self.address_tiles> from 
+    the compiled maze cache. 
+
+    INPUT
+      compiled_path: The cache path without its extension, as returned by
+                     compiled_maze_path. 
+    OUTPUT
+      True if the maze was loaded, False if there is no usable cache. 
+    """
+    if not (os.path.exists(f"{compiled_path}.npz") 
+            and os.path.exists(f"{compiled_path}.pkl")): 
+      return False
+    try: 
+      with open(f"{compiled_path}.pkl", "rb") as pkl_file: 
+        tables = pickle.load(pkl_file)
+      arrays = dict(numpy.load(f"{compiled_path}.npz"))
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError): 
+      return False
+    if tables.get("version") != COMPILED_MAZE_VERSION: 
+      return False
+    if arrays["sector_grid"].shape != (self.maze_height, self.maze_width): 
+      return False
+
+    self.world = tables["world"]
+    self.sector_names = tables["sector_names"]
+    self.arena_names = tables["arena_names"]
+    self.game_object_names = tables["game_object_names"]
+    self.spawning_location_names = tables["spawning_location_names"]
+    self.collision_blocks = tables["collision_blocks"]
+    self.sector_grid = arrays["sector_grid"]
+    self.arena_grid = arrays["arena_grid"]
+    self.game_object_grid = arrays["game_object_grid"]
+    self.spawning_location_grid = arrays["spawning_location_grid"]
+    self.collision_grid = arrays["collision_grid"]
+    self.arena_sectors = arrays["arena_sectors"]
+    self.game_object_arenas = arrays["game_object_arenas"]
+    self.build_addresses()
+
+    self.address_tiles = dict()
+    tile_index = arrays["address_tile_index"].tolist()
+    offsets = arrays["address_tile_offsets"].tolist()
+    for i, address in enumerate(tables["addresses"]): 
+      self.address_tiles[address] = set(
+        (idx % self.maze_width, idx // self.maze_width) 
+        for idx in tile_index[offsets[i]:offsets[i + 1]])
+    return True
+
+
+  @property
+  def collision_maze(self): 
+    """
+    The collision maze as a numpy grid of the raw block ids (e.g., "0" or
+    "32125"), indexed by [row][col]. 
+    """
+    return numpy.array(self.collision_blocks)[self.collision_grid]
 
 
   def turn_coordinate_to_tile(self, px_coordinate): 
@@ -225,8 +485,11 @@ class Maze:
 
   def access_tile(self, tile): 
     """
-    Returns the tiles details dictionary that is stored in self.tiles of the 
-    designated x, y location. 
+    Returns the tile details dictionary of the designated x, y location. The
+    dictionary is built from the code grids on every call; its "events" set 
+    is the tile's entry in the event store if it has one, and a fresh copy 
+    of the tile's default events otherwise. Use the *_event_from_tile 
+    methods to change a tile's events. 
 
     INPUT
       tile: The tile coordinate of our interest in (x, y) form.
@@ -234,16 +497,223 @@ class Maze:
       The tile detail dictionary for the designated tile. 
     EXAMPLE OUTPUT
       Given (58, 9), 
-      self.tiles[9][58] = {'world': 'double studio', 
-            'sector': 'double studio', 'arena': 'bedroom 2', 
-            'game_object': 'bed', 'spawning_location': 'bedroom-2-a', 
-            'collision': False,
-            'events': {('double studio:double studio:bedroom 2:bed',
-                       None, None)}} 
+      {'world': 'double studio', 
+       'sector': 'double studio', 'arena': 'bedroom 2', 
+       'game_object': 'bed', 'spawning_location': 'bedroom-2-a', 
+       'collision': False,
+       'events': {('double studio:double studio:bedroom 2:bed',
+                  None, None, None)}} 
     """
+    return self.tile_details(tile)
+
+
+  def tile_details(self, tile, create_events=False): 
     x = tile[0]
     y = tile[1]
-    return self.tiles[y][x]
+    tile_details = dict()
+    tile_details["world"] = self.world
+    tile_details["sector"] = self.sector_names[self.sector_grid[y, x]]
+    tile_details["arena"] = self.arena_names[self.arena_grid[y, x]]
+    tile_details["game_object"] = (self.game_object_names
+                                   [self.game_object_grid[y, x]])
+    tile_details["spawning_location"] = (self.spawning_location_names
+                                         [self.spawning_location_grid[y, x]])
+    tile_details["collision"] = bool(self.collision_grid[y, x])
+    tile_details["events"] = self.tile_events(tile, create_events)
+    return tile_details
+
+
+  def tile_events(self, tile, create=False): 
+    """
+    Returns the set of events taking place in a tile. 
+
+    INPUT
+      tile: The tile coordinate of our interest in (x, y) form.
+      create: If True, the tile gets an entry in the event store (if it does
+              not have one yet) and the returned set is that entry, so 
+              changing it changes the tile. Otherwise a tile without an 
+              entry returns a fresh set of its default events. 
+    OUTPUT
+      The set of event tuples in the tile. 
+    """
+    tile = (int(tile[0]), int(tile[1]))
+    events = self.events.get(tile)
+    if events is not None: 
+      return events
+    events = set()
+    game_object = self.game_object_grid[tile[1], tile[0]]
+    if game_object: 
+      # Each game object occupies an event in the tile; this is its default
+      # (idle) value. 
+      events.add((self.game_object_addresses[game_object], None, None, None))
+    if create: 
+      events = TileEventSet(self, tile, events)
+      self.events[tile] = events
+      self.index_event_tile(tile)
+    return events
+
+
+  def register_event(self, event, tile): 
+    """
+    Adds an event that was just added to a tile's set to the registry. 
+    """
+    subject = event[0]
+    tiles = self.subject_events.setdefault(subject, dict())
+    tiles.setdefault(tile, set()).add(event)
+    counts = self.arena_subjects.setdefault(
+      int(self.arena_grid[tile[1], tile[0]]), dict())
+    counts[subject] = counts.get(subject, 0) + 1
+
+
+  def unregister_event(self, event, tile): 
+    """
+    Removes an event that was just removed from a tile's set from the 
+    registry. 
+    """
+    subject = event[0]
+    tiles = self.subject_events[subject]
+    tiles[tile].discard(event)
+    if not tiles[tile]: 
+      del tiles[tile]
+      if not tiles: 
+        del self.subject_events[subject]
+    arena = int(self.arena_grid[tile[1], tile[0]])
+    counts = self.arena_subjects[arena]
+    counts[subject] -= 1
+    if not counts[subject]: 
+      del counts[subject]
+
+
+  def subject_tiles(self, subject): 
+    """
+    Returns the tiles that hold events of <subject>. 
+
+    INPUT
+      subject: e.g., "Isabella Rodriguez"
+    OUTPUT
+      A list of (x, y) tiles. 
+    """
+    return list(self.subject_events.get(subject, ()))
+
+
+  def tile_occupants(self, tile, subjects=None): 
+    """
+    Returns the subjects of the events on a tile (e.g., which personas are 
+    on it). 
+
+    INPUT
+      tile: The tile coordinate of our interest in (x, y) form.
+      subjects: If given, only these subjects (e.g., the set of persona 
+                names) are returned. 
+    OUTPUT
+      A set of subjects. 
+    """
+    events = self.events.get((int(tile[0]), int(tile[1])))
+    if not events: 
+      return set()
+    occupants = set(event[0] for event in events)
+    if subjects is not None: 
+      occupants &= set(subjects)
+    return occupants
+
+
+  def arena_occupants(self, arena, subjects=None): 
+    """
+    Returns the subjects of the events in an arena (e.g., which personas are
+    in it). 
+
+    INPUT
+      arena: The arena's string address, 
+             e.g., "the Ville:Hobbs Cafe:cafe"
+      subjects: If given, only these subjects (e.g., the set of persona 
+                names) are returned. 
+    OUTPUT
+      A set of subjects. 
+    """
+    occupants = set(self.arena_subjects.get(self.arena_codes.get(arena), ()))
+    if subjects is not None: 
+      occupants &= set(subjects)
+    return occupants
+
+
+  def index_event_tile(self, tile): 
+    """
+    Adds a tile to the event index. 
+    """
+    arena = int(self.arena_grid[tile[1], tile[0]])
+    cell = (tile[0] // EVENT_CELL_SIZE, tile[1] // EVENT_CELL_SIZE)
+    self.event_arenas.setdefault(arena, set()).add(tile)
+    self.event_cells.setdefault((arena, *cell), set()).add(tile)
+    self.event_cells.setdefault((None, *cell), set()).add(tile)
+
+
+  def unindex_event_tile(self, tile): 
+    """
+    Removes a tile from the event index. 
+    """
+    arena = int(self.arena_grid[tile[1], tile[0]])
+    cell = (tile[0] // EVENT_CELL_SIZE, tile[1] // EVENT_CELL_SIZE)
+    self.event_arenas[arena].discard(tile)
+    self.event_cells[(arena, *cell)].discard(tile)
+    self.event_cells[(None, *cell)].discard(tile)
+
+
+  def query_events(self, tile, radius, same_arena=True, k=None): 
+    """
+    Returns the events taking place within <radius> of a tile, closest 
+    first, using the event index instead of looking at every nearby tile. 
+    The area covered is the square of get_nearby_tiles, and events that are
+    in several tiles (e.g., an object that spans a few tiles) are only 
+    returned once, at their first tile in get_nearby_tiles' order. Events at
+    the same distance keep that order too. 
+
+    INPUT
+      tile: The tile coordinate of our interest in (x, y) form.
+      radius: The radius of the square to look in (e.g., vision_r). 
+      same_arena: If True, only events in the same arena as <tile> count. 
+      k: The most events to return (e.g., att_bandwidth); None for all. 
+    OUTPUT
+      A list of event tuples. 
+    EXAMPLE OUTPUT
+      [('Isabella Rodriguez', 'is', 'idle', 'idle'), 
+       ('the Ville:Hobbs Cafe:cafe:cafe customer seating', None, None, None), 
+       ...]
+    """
+    left, right, top, bottom = self.get_nearby_bounds(tile, radius)
+    arena = int(self.arena_grid[tile[1], tile[0]]) if same_arena else None
+
+    # Either scan the arena's tiles or the cells that overlap the square, 
+    # whichever is fewer; the cost does not grow with the square's area
+    # beyond the number of cells. 
+    cell_xs = range(left // EVENT_CELL_SIZE, 
+                    (right - 1) // EVENT_CELL_SIZE + 1)
+    cell_ys = range(top // EVENT_CELL_SIZE, 
+                    (bottom - 1) // EVENT_CELL_SIZE + 1)
+    arena_tiles = self.event_arenas.get(arena) if same_arena else None
+    if (arena_tiles is not None 
+        and len(arena_tiles) <= len(cell_xs) * len(cell_ys)): 
+      candidates = arena_tiles
+    else: 
+      candidates = []
+      for cx in cell_xs: 
+        for cy in cell_ys: 
+          candidates += self.event_cells.get((arena, cx, cy), ())
+
+    tiles = sorted(t for t in candidates 
+                   if left <= t[0] < right and top <= t[1] < bottom)
+    seen = set()
+    ranked = []
+    for t in tiles: 
+      dist = math.dist(t, tile)
+      for event in self.tile_events(t): 
+        if event not in seen: 
+          seen.add(event)
+          ranked += [(dist, len(ranked), event)]
+    if k is not None: 
+      ranked = heapq.nsmallest(k, ranked)
+    else: 
+      ranked.sort()
+    return [event for _, _, event in ranked]
 
 
   def get_tile_path(self, tile, level): 
@@ -262,25 +732,43 @@ class Maze:
     """
     x = tile[0]
     y = tile[1]
-    tile = self.tiles[y][x]
 
-    path = f"{tile['world']}"
     if level == "world": 
-      return path
-    else: 
-      path += f":{tile['sector']}"
-    
+      return self.world
     if level == "sector": 
-      return path
-    else: 
-      path += f":{tile['arena']}"
-
+      return self.sector_addresses[self.sector_grid[y, x]]
     if level == "arena": 
-      return path
-    else: 
-      path += f":{tile['game_object']}"
+      return self.arena_addresses[self.arena_grid[y, x]]
+    game_object = self.game_object_grid[y, x]
+    if not game_object: 
+      return f"{self.arena_addresses[self.arena_grid[y, x]]}:"
+    return self.game_object_addresses[game_object]
 
-    return path
+
+  def get_nearby_bounds(self, tile, vision_r): 
+    """
+    Returns the bounds of the square around <tile> that get_nearby_tiles 
+    covers, as (left, right, top, bottom) with the right and bottom ends
+    excluded, so that grid[top:bottom, left:right] is the nearby area of any
+    of the code grids. 
+    """
+    left_end = 0
+    if tile[0] - vision_r > left_end: 
+      left_end = tile[0] - vision_r
+
+    right_end = self.maze_width - 1
+    if tile[0] + vision_r + 1 < right_end: 
+      right_end = tile[0] + vision_r + 1
+
+    bottom_end = self.maze_height - 1
+    if tile[1] + vision_r + 1 < bottom_end: 
+      bottom_end = tile[1] + vision_r + 1
+
+    top_end = 0
+    if tile[1] - vision_r > top_end: 
+      top_end = tile[1] - vision_r 
+
+    return left_end, right_end, top_end, bottom_end
 
 
   def get_nearby_tiles(self, tile, vision_r): 
@@ -301,22 +789,8 @@ class Maze:
     OUTPUT: 
       nearby_tiles: a list of tiles that are within the radius. 
     """
-    left_end = 0
-    if tile[0] - vision_r > left_end: 
-      left_end = tile[0] - vision_r
-
-    right_end = self.maze_width - 1
-    if tile[0] + vision_r + 1 < right_end: 
-      right_end = tile[0] + vision_r + 1
-
-    bottom_end = self.maze_height - 1
-    if tile[1] + vision_r + 1 < bottom_end: 
-      bottom_end = tile[1] + vision_r + 1
-
-    top_end = 0
-    if tile[1] - vision_r > top_end: 
-      top_end = tile[1] - vision_r 
-
+    left_end, right_end, top_end, bottom_end = self.get_nearby_bounds(
+                                                 tile, vision_r)
     nearby_tiles = []
     for i in range(left_end, right_end): 
       for j in range(top_end, bottom_end): 
@@ -336,7 +810,7 @@ class Maze:
     OUPUT: 
       None
     """
-    self.tiles[tile[1]][tile[0]]["events"].add(curr_event)
+    self.tile_events(tile, create=True).add(curr_event)
 
 
   def remove_event_from_tile(self, curr_event, tile):
@@ -351,19 +825,27 @@ class Maze:
     OUPUT: 
       None
     """
-    curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
-    for event in curr_tile_ev_cp: 
-      if event == curr_event:  
-        self.tiles[tile[1]][tile[0]]["events"].remove(event)
+    if curr_event not in self.tile_events(tile): 
+      return
+    self.tile_events(tile, create=True).discard(curr_event)
+    self.release_tile_events(tile)
 
 
   def turn_event_from_tile_idle(self, curr_event, tile):
-    curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
-    for event in curr_tile_ev_cp: 
-      if event == curr_event:  
-        self.tiles[tile[1]][tile[0]]["events"].remove(event)
-        new_event = (event[0], None, None, None)
-        self.tiles[tile[1]][tile[0]]["events"].add(new_event)
+    """
+    Turn an event in a tile to its idle form, (subject, None, None, None).
+
+    INPUT: 
+      curr_event: Current event triple. 
+      tile: The tile coordinate of our interest in (x, y) form.
+    OUPUT: 
+      None
+    """
+    if curr_event not in self.tile_events(tile): 
+      return
+    events = self.tile_events(tile, create=True)
+    events.remove(curr_event)
+    events.add((curr_event[0], None, None, None))
 
 
   def remove_subject_events_from_tile(self, subject, tile):
@@ -376,41 +858,161 @@ class Maze:
     OUPUT: 
       None
     """
-    curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
-    for event in curr_tile_ev_cp: 
-      if event[0] == subject:  
-        self.tiles[tile[1]][tile[0]]["events"].remove(event)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    tile = (int(tile[0]), int(tile[1]))
+    if (tile not in self.events 
+        and (subject, None, None, None) in self.tile_events(tile)): 
+      # The subject's event is the tile's default idle event, which only 
+      # gets into the registry once the tile has an entry. 
+      self.tile_events(tile, create=True)
+    subject_events = self.subject_events.get(subject, dict()).get(tile)
+    if not subject_events: 
+      return
+    events = self.events[tile]
+    for event in list(subject_events): 
+      events.remove(event)
+    self.release_tile_events(tile)
+
+
+  def move_subject(self, subject, curr_tile, new_tile, new_event): 
+    """
+    Moves a subject (e.g., a persona) from one tile to another: removes the
+    subject's events from <curr_tile>, and adds <new_event> to <new_tile>. 
 
+    INPUT: 
+      subject: "Isabella Rodriguez"
+      curr_tile: The tile the subject was on, in (x, y) form. 
+      new_tile: The tile the subject moves to, in (x, y) form. 
+      new_event: The subject's event on the new tile. 
+    OUPUT: 
+      None
+    """
+    self.remove_subject_events_from_tile(subject, curr_tile)
+    self.add_event_from_tile(new_event, new_tile)
 
 
+  def release_tile_events(self, tile): 
+    """
+    Drops the event store entry of a tile that has no game object and no
+    events left, to keep the store sparse. 
+    """
+    tile = (int(tile[0]), int(tile[1]))
+    if (not self.events.get(tile, True) 
+        and not self.game_object_grid[tile[1], tile[0]]): 
+      del self.events[tile]
+      self.unindex_event_tile(tile)
+
+
+class TileEventSet(set): 
+  """
+  The set of events of a tile in the event store. It behaves like a set, 
+  and also keeps the maze's event registry up to date as events are added
+  and removed, whether through the Maze methods or directly (e.g., through 
+  maze.tiles[row][col]["events"]). 
+  """
+  def __init__(self, maze, tile, events=()): 
+    super().__init__()
+    self.maze = maze
+    self.tile = tile
+    self.update(events)
+
+  def add(self, event): 
+    if event not in self: 
+      super().add(event)
+      self.maze.register_event(event, self.tile)
+
+  def discard(self, event): 
+    if event in self: 
+      super().discard(event)
+      self.maze.unregister_event(event, self.tile)
+
+  def remove(self, event): 
+    if event not in self: 
+      raise KeyError(event)
+    self.discard(event)
+
+  def pop(self): 
+    event = next(iter(self))
+    self.discard(event)
+    return event
+
+  def clear(self): 
+    for event in list(self): 
+      self.discard(event)
+
+  def update(self, *others): 
+    for other in others: 
+      for event in other: 
+        self.add(event)
+
+  def difference_update(self, *others): 
+    for other in others: 
+      for event in list(other): 
+        self.discard(event)
+
+  def __ior__(self, other): 
+    self.update(other)
+    return self
+
+  def __isub__(self, other): 
+    self.difference_update(other)
+    return self
+
+
+def intern_grid(raw_grid, table, to_key): 
+  """
+  Turns a grid of raw values into an int16 grid of codes. 
+
+  INPUT
+    raw_grid: A numpy grid of raw values (block ids or integers). 
+    table: A dictionary from key to code that new keys are added to, in the 
+           order of their first appearance in <raw_grid> (row-major). 
+    to_key: The function that maps a raw value to its key. 
+  OUTPUT
+    The int16 code grid, with the shape of <raw_grid>. 
+  """
+  values, first, inverse = numpy.unique(raw_grid, return_index=True, 
+                                        return_inverse=True)
+  codes = numpy.zeros(len(values), dtype=numpy.int16)
+  for i in numpy.argsort(first, kind="stable").tolist(): 
+    key = to_key(values[i].item())
+    if key not in table: 
+      table[key] = len(table)
+    codes[i] = table[key]
+  return codes[inverse].reshape(raw_grid.shape)
+
+
+class TileGridView: 
+  """
+  Old-style self.tiles access on top of the code grids: 
+  maze.tiles[row][col] is the tile details dictionary of (col, row), as 
+  access_tile returns it, except that its "events" set is always the tile's
+  live entry in the event store. 
+  """
+  def __init__(self, maze): 
+    self.maze = maze
+
+  def __len__(self): 
+    return self.maze.maze_height
+
+  def __getitem__(self, row): 
+    return TileRowView(self.maze, row)
+
+  def __iter__(self): 
+    for row in range(self.maze.maze_height): 
+      yield TileRowView(self.maze, row)
+
+
+class TileRowView: 
+  def __init__(self, maze, row): 
+    self.maze = maze
+    self.row = row
+
+  def __len__(self): 
+    return self.maze.maze_width
+
+  def __getitem__(self, col): 
+    return self.maze.tile_details((col, self.row), create_events=True)
+
+  def __iter__(self): 
+    for col in range(self.maze.maze_width): 
+      yield self[col]
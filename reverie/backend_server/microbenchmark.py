@@ -0,0 +1,545 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: microbenchmark.py
+Description: Times the parts of a step that run on the CPU rather than wait
+for a model, one at a time, so that an optimization of one of them can be
+measured before and after. benchmark.py measures whole steps; this measures:
+  maze_init      -- Maze("the_ville"), from the compiled cache and parsed
+  path_finder    -- path_finder (a new PathFinder per call), the maze's
+                    path_engine and the original path_finder_v2, between
+                    random pairs of tiles of the_ville's collision maze
+  nearby_tiles   -- Maze.get_nearby_tiles and Maze.query_events
+  perceive       -- perceive for a persona walking over random tiles
+  retrieve       -- new_retrieve over synthetic memory streams
+  amem           -- AssociativeMemory load, full save and incremental save
+  compress       -- compress_sim_storage.compress on a synthetic simulation
+
+Nothing here calls a model. The memory streams, their embeddings and the
+simulation that compress reads are made up from a seed (see the fixtures
+below), and where the code under test asks for an embedding or a poignancy
+score, it gets the mock server's deterministic embedding (see
+mock_llm_server.embedding) and a fixed score, so only the code's own work is
+timed.
+
+Every measurement is repeated; the report is JSON with the min, median, mean
+and max seconds per call of each benchmark, keyed by its name and
+parameters. Pass an earlier report to --compare to print the ratio of the
+medians of the benchmarks both have.
+
+Usage (from reverie/backend_server):
+  python microbenchmark.py
+  python microbenchmark.py --only retrieve amem --sizes 1000 10000
+  python microbenchmark.py --output before.json
+  python microbenchmark.py --output after.json --compare before.json
+"""
+import argparse
+import contextlib
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+
+# For compress_sim_storage.py, in reverie.
+sys.path.append("..")
+
+from utils import *
+from maze import Maze
+from path_finder import PathFinder, path_finder, path_finder_v2
+from mock_llm_server import embedding
+from persona.persona import Persona
+from persona.memory_structures.associative_memory import AssociativeMemory
+from persona.cognitive_modules import perceive as perceive_module
+from persona.cognitive_modules import retrieve as retrieve_module
+
+# The simulation whose personas perceive walks around.
+PERSONA_SIM = "base_the_ville_isabella_maria_klaus"
+COMPRESS_SIM = "microbenchmark_compress"
+# path_finder_v2 gives up on paths longer than this.
+V2_MAX_PATH = 150
+FOCAL_POINTS = ["Isabella Rodriguez is planning a Valentine's Day party",
+                "Klaus Mueller is writing a research paper",
+                "What is Maria Lopez doing at the cafe?"]
+SUBJECTS = ["Isabella Rodriguez", "Maria Lopez", "Klaus Mueller",
+            "the Ville:Hobbs Cafe:cafe:counter",
+            "the Ville:Oak Hill College:library:bookshelf"]
+PREDICATES = ["is", "talks with", "plans", "reads", "makes"]
+OBJECTS = ["coffee", "a party", "a research paper", "breakfast", "music",
+           "the weather", "a book", "idle"]
+
+
+"""
+FIXTURES
+"""
+def synthetic_embeddings(n, dim, rng):
+  """
+  Returns <n> random unit vectors of <dim> float32s as rows of a matrix.
+  """
+  vectors = rng.standard_normal((n, dim)).astype(np.float32)
+  return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def empty_memory():
+  """
+  Returns an AssociativeMemory with no nodes.
+  """
+  with tempfile.TemporaryDirectory() as folder:
+    for name, content in [("nodes.json", {}), ("embeddings.json", {}),
+                          ("kw_strength.json", {"kw_strength_event": {},
+                                                "kw_strength_thought": {}})]:
+      with open(f"{folder}/{name}", "w") as outfile:
+        json.dump(content, outfile)
+    return AssociativeMemory(folder)
+
+
+def add_synthetic_nodes(a_mem, n_nodes, rng, embeddings, start=None):
+  """
+  Adds <n_nodes> made-up events and thoughts to <a_mem>, a minute apart,
+  about three quarters of them events (some of them idle, which retrieval
+  skips). The descriptions are drawn from len(<embeddings>) distinct ones,
+  so that, as in a real memory stream, many nodes share an embedding.
+
+  INPUT
+    a_mem: the AssociativeMemory to add to.
+    n_nodes: the number of nodes to add.
+    rng: a numpy Generator.
+    embeddings: a matrix with the embedding of every distinct description.
+    start: the creation time of the first node; by default, a minute after
+           the last node of <a_mem>, or 2023-02-13 00:00 if it has none.
+  """
+  if start is None:
+    start = datetime.datetime(2023, 2, 13)
+    if a_mem.nodes:
+      start = a_mem.nodes[-1].created + datetime.timedelta(minutes=1)
+  texts = rng.integers(len(embeddings), size=n_nodes)
+  kinds = rng.random(n_nodes)
+  for count in range(n_nodes):
+    text = int(texts[count])
+    s = SUBJECTS[text % len(SUBJECTS)]
+    p = PREDICATES[text // len(SUBJECTS) % len(PREDICATES)]
+    o = OBJECTS[text // (len(SUBJECTS) * len(PREDICATES)) % len(OBJECTS)]
+    description = f"{s} {p} {o} ({text})"
+    created = start + datetime.timedelta(minutes=count)
+    keywords = set([s.split(":")[-1], o])
+    embedding_pair = (description, embeddings[text])
+    poignancy = 1 + text % 10
+    if kinds[count] < 0.75:
+      a_mem.add_event(created, None, s, p, o, description, keywords,
+                      poignancy, embedding_pair, None)
+    else:
+      a_mem.add_thought(created, created + datetime.timedelta(days=30),
+                        s, p, o, description, keywords, poignancy,
+                        embedding_pair, None)
+
+
+def make_memory_stream(n_nodes, dim=1536, unique=0.2, seed=0):
+  """
+  Returns an AssociativeMemory of <n_nodes> made-up nodes (see
+  add_synthetic_nodes), with <unique> of them having a description (and
+  embedding) of their own.
+  """
+  rng = np.random.default_rng(seed)
+  embeddings = synthetic_embeddings(max(1, int(n_nodes * unique)), dim, rng)
+  a_mem = empty_memory()
+  add_synthetic_nodes(a_mem, n_nodes, rng, embeddings)
+  return a_mem
+
+
+def retrieval_persona(a_mem):
+  """
+  Returns the parts of a persona that new_retrieve uses, around <a_mem>,
+  with the default weights of Scratch.
+  """
+  curr_time = datetime.datetime(2023, 2, 13)
+  if a_mem.nodes:
+    curr_time = a_mem.nodes[-1].created + datetime.timedelta(minutes=1)
+  scratch = types.SimpleNamespace(recency_w=1, relevance_w=1, importance_w=1,
+                                  recency_decay=0.99, curr_time=curr_time)
+  return types.SimpleNamespace(name="Microbenchmark Persona", a_mem=a_mem,
+                               scratch=scratch)
+
+
+def fixture_embeddings(texts, model=None):
+  """
+  Stands in for gpt_structure.get_embeddings.
+  """
+  return [embedding(text) for text in texts]
+
+
+def make_movement_sim(sim_code, n_personas, n_steps, seed=0):
+  """
+  Writes a made-up simulation to the storage: <n_personas> personas walking
+  about the_ville for <n_steps> steps, each of them changing its action
+  every few steps and keeping still about half of the time, which is what
+  compress reads.
+  """
+  rng = random.Random(seed)
+  sim_folder = f"{fs_storage}/{sim_code}"
+  if os.path.exists(sim_folder):
+    shutil.rmtree(sim_folder)
+  names = [f"Persona{count} Microbenchmark" for count in range(n_personas)]
+  for name in names:
+    os.makedirs(f"{sim_folder}/personas/{name}/bootstrap_memory")
+  os.makedirs(f"{sim_folder}/reverie")
+  os.makedirs(f"{sim_folder}/movement")
+  meta = {"fork_sim_code": sim_code,
+          "start_date": "February 13, 2023",
+          "curr_time": "February 13, 2023, 00:00:00",
+          "sec_per_step": 10,
+          "maze_name": "the_ville",
+          "persona_names": names,
+          "step": n_steps}
+  with open(f"{sim_folder}/reverie/meta.json", "w") as outfile:
+    json.dump(meta, outfile, indent=2)
+
+  state = {name: {"movement": [rng.randrange(140), rng.randrange(100)],
+                  "pronunciatio": "💤",
+                  "description": "sleeping @ the Ville",
+                  "chat": None}
+           for name in names}
+  for step in range(n_steps):
+    for name in names:
+      record = state[name]
+      if rng.random() < 0.5:
+        x, y = record["movement"]
+        record["movement"] = [min(139, max(0, x + rng.choice([-1, 1]))), y]
+      if rng.random() < 0.05:
+        record["pronunciatio"] = rng.choice(["💤", "☕", "📚", "🍳", "🎵"])
+        record["description"] = (f"{rng.choice(PREDICATES)} "
+                                 f"{rng.choice(OBJECTS)} @ the Ville")
+    movement = {"persona": state,
+                "meta": {"curr_time": "February 13, 2023, 00:00:00"}}
+    with open(f"{sim_folder}/movement/{step}.json", "w") as outfile:
+      json.dump(movement, outfile)
+  return sim_folder
+
+
+"""
+MEASURING
+"""
+@contextlib.contextmanager
+def patched(module, **attributes):
+  """
+  Sets attributes of <module> while the context is entered.
+  """
+  saved = {name: getattr(module, name) for name in attributes}
+  for name, value in attributes.items():
+    setattr(module, name, value)
+  try:
+    yield
+  finally:
+    for name, value in saved.items():
+      setattr(module, name, value)
+
+
+def measure(fn, repeat, number=1, setup=None):
+  """
+  Calls <fn> <number> times in a row, <repeat> times over, with garbage
+  collection off (as timeit does), and returns the seconds per call.
+
+  INPUT
+    fn: the function to time; it takes no arguments.
+    repeat: the number of timed runs.
+    number: the calls to <fn> in each run.
+    setup: if given, called before each run, outside the timing.
+  OUTPUT
+    A dictionary of the "min", "median", "mean" and "max" seconds per call
+    over the runs.
+  """
+  times = []
+  gc_enabled = gc.isenabled()
+  try:
+    for _ in range(repeat):
+      if setup:
+        setup()
+      gc.disable()
+      start = time.perf_counter()
+      for _ in range(number):
+        fn()
+      times += [(time.perf_counter() - start) / number]
+      if gc_enabled:
+        gc.enable()
+  finally:
+    if gc_enabled:
+      gc.enable()
+  return {"min": min(times),
+          "median": float(np.median(times)),
+          "mean": sum(times) / len(times),
+          "max": max(times)}
+
+
+def result(name, params, seconds, repeat, number=1):
+  return {"name": name, "params": params, "repeat": repeat, "number": number,
+          "seconds": seconds}
+
+
+def result_key(entry):
+  return entry["name"] + json.dumps(entry["params"], sort_keys=True)
+
+
+def walkable_tiles(maze, n, seed):
+  """
+  Returns <n> random tiles of <maze> that a persona can stand on and that
+  are connected to each other.
+  """
+  rng = random.Random(seed)
+  # We keep to the largest connected area, so that every pair has a path.
+  components = maze.path_engine.components
+  largest = np.bincount(components[components >= 0]).argmax()
+  ys, xs = np.nonzero(components == largest)
+  tiles = list(zip(xs.tolist(), ys.tolist()))
+  return [rng.choice(tiles) for _ in range(n)]
+
+
+"""
+BENCHMARKS
+"""
+def bench_maze_init(args):
+  return [result("maze_init", {"compiled": True},
+                 measure(lambda: Maze("the_ville"), args.repeat),
+                 args.repeat),
+          result("maze_init", {"compiled": False},
+                 measure(lambda: Maze("the_ville", use_compiled=False),
+                         args.repeat),
+                 args.repeat)]
+
+
+def bench_path_finder(args):
+  maze = Maze("the_ville")
+  collision_maze = maze.collision_maze
+  tiles = walkable_tiles(maze, args.pairs * 2, args.seed)
+  pairs = list(zip(tiles[::2], tiles[1::2]))
+  results = []
+
+  def run_path_finder():
+    for start, end in pairs:
+      path_finder(collision_maze, start, end, collision_block_id)
+  seconds = measure(run_path_finder, args.repeat)
+  results += [result("path_finder", {"pairs": len(pairs)}, seconds,
+                     args.repeat)]
+
+  def run_path_engine():
+    engine = PathFinder(collision_maze, collision_block_id,
+                        regions=maze.arena_grid)
+    for start, end in pairs:
+      engine.find_path(start, end)
+  seconds = measure(run_path_engine, args.repeat)
+  results += [result("path_engine", {"pairs": len(pairs)}, seconds,
+                     args.repeat)]
+
+  # path_finder_v2 works on (row, col) tiles, and only finds short paths.
+  short_pairs = [(start, end) for start, end in pairs
+                 if len(maze.path_engine.find_path(start, end)) < V2_MAX_PATH]
+  short_pairs = short_pairs[:args.v2_pairs]
+  grid = collision_maze.tolist()
+  def run_path_finder_v2():
+    for start, end in short_pairs:
+      path_finder_v2(grid, start[::-1], end[::-1], collision_block_id)
+  if short_pairs:
+    seconds = measure(run_path_finder_v2, 1)
+    results += [result("path_finder_v2", {"pairs": len(short_pairs)},
+                       seconds, 1)]
+  return results
+
+
+def bench_nearby_tiles(args):
+  maze = Maze("the_ville")
+  tiles = walkable_tiles(maze, args.tiles, args.seed)
+  results = []
+  for vision_r in [4, 8]:
+    params = {"tiles": len(tiles), "vision_r": vision_r}
+    seconds = measure(lambda: [maze.get_nearby_tiles(tile, vision_r)
+                               for tile in tiles], args.repeat)
+    results += [result("get_nearby_tiles", params, seconds, args.repeat)]
+    seconds = measure(lambda: [maze.query_events(tile, vision_r, k=3)
+                               for tile in tiles], args.repeat)
+    results += [result("query_events", params, seconds, args.repeat)]
+  return results
+
+
+def bench_perceive(args):
+  maze = Maze("the_ville")
+  tiles = walkable_tiles(maze, args.tiles, args.seed)
+  persona_folder = f"{fs_storage}/{PERSONA_SIM}/personas"
+  name = sorted(os.listdir(persona_folder))[0]
+  persona = Persona(name, f"{persona_folder}/{name}")
+  poignancy = lambda persona, event_type, description: 5
+
+  def walk():
+    for tile in tiles:
+      persona.scratch.curr_tile = tile
+      perceive_module.perceive(persona, maze)
+  with patched(perceive_module, get_embeddings=fixture_embeddings,
+               generate_poig_score=poignancy):
+    # The first walk embeds the events; the timed walks find most of them
+    # in the persona's memory already, as a persona going about its day
+    # does.
+    walk()
+    seconds = measure(walk, args.repeat)
+  return [result("perceive", {"tiles": len(tiles)}, seconds, args.repeat)]
+
+
+def bench_retrieve(args):
+  results = []
+  focal_embeddings = dict(zip(FOCAL_POINTS, fixture_embeddings(FOCAL_POINTS)))
+  focal_lookup = lambda texts, model=None: [focal_embeddings[text]
+                                            for text in texts]
+  for n_nodes in args.sizes:
+    persona = retrieval_persona(make_memory_stream(n_nodes, args.dim,
+                                                   seed=args.seed))
+    with patched(retrieve_module, get_embeddings=focal_lookup):
+      seconds = measure(lambda: retrieve_module.new_retrieve(persona,
+                                                             FOCAL_POINTS),
+                        args.repeat)
+    results += [result("new_retrieve",
+                       {"nodes": n_nodes, "focal_points": len(FOCAL_POINTS),
+                        "dim": args.dim},
+                       seconds, args.repeat)]
+  return results
+
+
+def bench_amem(args):
+  results = []
+  for n_nodes in args.sizes:
+    rng = np.random.default_rng(args.seed)
+    embeddings = synthetic_embeddings(max(1, int(n_nodes * 0.2)), args.dim,
+                                      rng)
+    a_mem = empty_memory()
+    add_synthetic_nodes(a_mem, n_nodes, rng, embeddings)
+    params = {"nodes": n_nodes, "dim": args.dim}
+    with tempfile.TemporaryDirectory() as folder:
+      seconds = measure(lambda: a_mem.save(folder), args.repeat)
+      results += [result("amem_save_full", params, seconds, args.repeat)]
+
+      seconds = measure(lambda: AssociativeMemory(folder), args.repeat)
+      results += [result("amem_load", params, seconds, args.repeat)]
+
+      # An incremental save writes the nodes of one step or so.
+      a_mem = AssociativeMemory(folder)
+      new_nodes = lambda: add_synthetic_nodes(a_mem, 10, rng, embeddings)
+      seconds = measure(lambda: a_mem.save(folder, incremental=True),
+                        args.repeat, setup=new_nodes)
+      results += [result("amem_save_incremental", dict(params, added=10),
+                         seconds, args.repeat)]
+  return results
+
+
+def bench_compress(args):
+  import compress_sim_storage
+  make_movement_sim(COMPRESS_SIM, args.compress_personas,
+                    args.compress_steps, args.seed)
+  compressed_folder = f"{fs_storage}/../compressed_storage/{COMPRESS_SIM}"
+  cwd = os.getcwd()
+  try:
+    # compress_sim_storage.py runs from reverie.
+    os.chdir("..")
+    seconds = measure(lambda: compress_sim_storage.compress(COMPRESS_SIM,
+                                                            resume=False),
+                      args.repeat)
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(f"{fs_storage}/{COMPRESS_SIM}", ignore_errors=True)
+    shutil.rmtree(compressed_folder, ignore_errors=True)
+  return [result("compress", {"personas": args.compress_personas,
+                              "steps": args.compress_steps},
+                 seconds, args.repeat)]
+
+
+BENCHMARKS = {"maze_init": bench_maze_init,
+              "path_finder": bench_path_finder,
+              "nearby_tiles": bench_nearby_tiles,
+              "perceive": bench_perceive,
+              "retrieve": bench_retrieve,
+              "amem": bench_amem,
+              "compress": bench_compress}
+
+
+def git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                          capture_output=True, text=True,
+                          check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def compare(results, baseline):
+  """
+  Prints the median seconds per call of the benchmarks in both <results>
+  and <baseline> (earlier results), and their ratio (above 1 is faster),
+  to stderr, so that stdout stays JSON.
+  """
+  earlier = {result_key(entry): entry for entry in baseline}
+  print (f"{'benchmark':<60} {'before':>10} {'after':>10} {'speedup':>8}",
+         file=sys.stderr)
+  for entry in results:
+    old = earlier.get(result_key(entry))
+    if not old:
+      continue
+    label = entry["name"] + " " + " ".join(
+              f"{key}={value}" for key, value in entry["params"].items())
+    before = old["seconds"]["median"]
+    after = entry["seconds"]["median"]
+    print (f"{label:<60} {before:>10.6f} {after:>10.6f} "
+           f"{before / after if after else float('inf'):>7.2f}x",
+           file=sys.stderr)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description="Time the CPU-bound parts of a simulation step.")
+  parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS),
+                      help="run only these benchmarks")
+  parser.add_argument("--repeat", type=int, default=5,
+                      help="the timed runs of each benchmark")
+  parser.add_argument("--sizes", type=int, nargs="+",
+                      default=[1000, 10000, 100000],
+                      help="the memory stream sizes for retrieve and amem")
+  parser.add_argument("--dim", type=int, default=1536,
+                      help="the size of the synthetic embeddings")
+  parser.add_argument("--pairs", type=int, default=50,
+                      help="the pairs of tiles path_finder goes between")
+  parser.add_argument("--v2-pairs", type=int, default=3,
+                      help="the pairs of tiles path_finder_v2 goes between")
+  parser.add_argument("--tiles", type=int, default=200,
+                      help="the tiles nearby_tiles and perceive look from")
+  parser.add_argument("--compress-personas", type=int, default=25,
+                      help="the personas of the simulation compress reads")
+  parser.add_argument("--compress-steps", type=int, default=2000,
+                      help="the steps of the simulation compress reads")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="the seed of the synthetic fixtures")
+  parser.add_argument("--output", help="write the JSON report here too")
+  parser.add_argument("--compare",
+                      help="an earlier JSON report to compare against")
+  args = parser.parse_args()
+
+  report = {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "settings": vars(args),
+            "results": []}
+  for name in args.only or BENCHMARKS:
+    print (f"Running {name}...", file=sys.stderr)
+    report["results"] += BENCHMARKS[name](args)
+
+  print (json.dumps(report, indent=2))
+  if args.output:
+    with open(args.output, "w") as outfile:
+      outfile.write(json.dumps(report, indent=2))
+  if args.compare:
+    with open(args.compare) as json_file:
+      baseline = json.load(json_file)["results"]
+    compare(report["results"], baseline)
@@ -0,0 +1,401 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: mock_llm_server.py
+Description: A local stand-in for the Ollama server, for benchmarking the
+simulation without a model (see benchmark.py). It speaks the two endpoints
+gpt_structure.py uses, /api/chat (streamed) and /api/embeddings, and its
+answers are deterministic: a chat prompt is matched to the prompt template it
+was made from and gets an answer that passes that template's validation,
+with the choices (e.g., which of the area options to go to) made by a hash of
+the prompt; an embedding is a unit vector seeded by a hash of the text. Every
+request can be slowed down by a fixed latency plus a jitter, which is also
+drawn from the hash, so that runs are repeatable.
+
+GET /api/stats returns the number of requests answered so far, in total and
+per template.
+
+Usage (from reverie/backend_server):
+  python mock_llm_server.py --port 11434
+  python mock_llm_server.py --port 11434 --latency 200 --jitter 100
+and point ollama_base_url in utils.py at it.
+"""
+import argparse
+import collections
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+EMBEDDING_DIM = 1536
+
+WORK_ACTIVITIES = ["working on the current project",
+                   "reading at the library",
+                   "meeting friends at the cafe",
+                   "taking a walk in the park",
+                   "shopping for groceries",
+                   "writing in the journal"]
+EMOJIS = ["🙂", "📚", "☕", "🚶", "💼", "🍽️", "😴", "✍️"]
+
+
+def prompt_hash(text):
+  """
+  Returns a hash of <text> that is the same in every process (unlike
+  Python's hash()).
+  """
+  return int(hashlib.md5(text.encode("utf-8")).hexdigest()[:12], 16)
+
+
+def braced_options(prompt, marker):
+  """
+  Returns the comma separated options in the braces that follow the last
+  <marker> in <prompt>, e.g., the area options of an action location prompt.
+  """
+  tail = prompt[prompt.rfind(marker) + len(marker):]
+  return [i.strip() for i in tail.split("}")[0].split(",") if i.strip()]
+
+
+def pick(options, h):
+  """
+  Picks one of <options> by the hash <h>. Raises IndexError if there are
+  none.
+  """
+  if not options:
+    raise IndexError("no options to pick from")
+  return options[h % len(options)]
+
+
+def hour_of(hour_str):
+  """
+  "07:00 AM" -> 7, "12:00 PM" -> 12, "03:00 PM" -> 15
+  """
+  hour = int(hour_str[:2]) % 12
+  return hour + 12 if hour_str.endswith("PM") else hour
+
+
+# The answers to each prompt template. Each function takes the prompt and
+# its hash and returns what a model could have answered.
+def answer_wake_up_hour(prompt, h):
+  return f"{6 + h % 3}am"
+
+
+def answer_daily_plan(prompt, h):
+  wake_up_hour = int(re.findall(r"morning routine at (\d+):00 am", prompt)[-1])
+  return (f"eat breakfast at {wake_up_hour + 1}:00 am, "
+          f"3) {WORK_ACTIVITIES[h % len(WORK_ACTIVITIES)]} from "
+          f"{wake_up_hour + 2}:00 am to 12:00 pm, "
+          f"4) have lunch at 12:00 pm, "
+          f"5) {WORK_ACTIVITIES[(h // 7) % len(WORK_ACTIVITIES)]} from "
+          f"1:00 pm to 5:00 pm, "
+          f"6) have dinner at 6:00 pm, "
+          f"7) relax from 7:00 pm to 10:00 pm, 8) go to bed at 11:00 pm")
+
+
+def answer_hourly_schedule(prompt, h):
+  hour_str, first_name = re.findall(
+    r"-- (\d\d:\d\d [AP]M)\] Activity: (\S+) is$", prompt)[-1]
+  hour = hour_of(hour_str)
+  # The same persona does the same work every day.
+  work = WORK_ACTIVITIES[prompt_hash(first_name) % len(WORK_ACTIVITIES)]
+  if hour < 6 or hour >= 23:
+    return "sleeping"
+  if hour < 8:
+    return "waking up and completing the morning routine"
+  if hour == 8:
+    return "having breakfast"
+  if hour == 12:
+    return "having lunch"
+  if hour == 18:
+    return "having dinner"
+  if hour > 18:
+    return "relaxing at home"
+  return work
+
+
+def answer_task_decomp(prompt, h):
+  total = int(re.findall(r"\(total duration in minutes (\d+)\)", prompt)[-1])
+  name = re.findall(r"1\) (.+) is$", prompt)[-1]
+  if total <= 15:
+    subtasks = [("getting it done", total)]
+  else:
+    subtasks = [("getting started", 5),
+                ("focusing on the main part", total - 10),
+                ("wrapping up", 5)]
+  lines = []
+  minutes_left = total
+  for count, (subtask, duration) in enumerate(subtasks):
+    minutes_left -= duration
+    line = (f"{subtask}. (duration in minutes: {duration}, "
+            f"minutes left: {minutes_left})")
+    if count:
+      line = f"{count + 1}) {name} is {line}"
+    lines += [line]
+  return "\n".join(lines)
+
+
+def answer_action_sector(prompt, h):
+  options = braced_options(prompt, "Area options: {")
+  return f"{pick(options, h)}}}"
+
+
+def answer_action_arena(prompt, h):
+  options = braced_options(prompt, "(MUST pick one of {")
+  return f"{pick(options, h)}}}"
+
+
+def answer_action_object(prompt, h):
+  return pick(braced_options(prompt, "Objects available: {"), h)
+
+
+def answer_pronunciatio(prompt, h):
+  return json.dumps({"output": EMOJIS[h % len(EMOJIS)]})
+
+
+def answer_object_state(prompt, h):
+  return json.dumps({"output": "being used"})
+
+
+def answer_object_event_triple(prompt, h):
+  return "is, being used)"
+
+
+def answer_event_triple(prompt, h):
+  # "Action: <first name> <last name> <action>"
+  action = re.findall(r"Action: (.*)", prompt)[-1].split(" ")
+  return f"{' '.join(action[:2])}, is, {' '.join(action[2:]) or 'idle'}"
+
+
+def answer_new_decomp_schedule(prompt, h):
+  end = re.findall(r"\(it has to end by (\d\d:\d\d)", prompt)[-1]
+  planned = re.findall(r"^\d\d:\d\d ~ \d\d:\d\d -- (.*)$", prompt, re.M)
+  return f"{end} -- {planned[-1] if planned else 'resting'}"
+
+
+def answer_decide_to_talk(prompt, h):
+  # Always "no": the conversation prompts (e.g.,
+  # run_gpt_generate_iterative_chat_utt) are not in run_gpt_prompt.py.
+  return "no"
+
+
+def answer_poignancy(prompt, h):
+  return str(1 + h % 3)
+
+
+def answer_memo_on_convo(prompt, h):
+  return EMOJIS[h % len(EMOJIS)]
+
+
+def answer_planning_thought(prompt, h):
+  return "I should follow up on what we talked about."
+
+
+def answer_insights(prompt, h):
+  return json.dumps({"I have been keeping busy with my routine":
+                     ["Recent experiences"]})
+
+
+def answer_focal_points(prompt, h):
+  return json.dumps(["What happened today", "How I feel about my work",
+                     "Plans for tomorrow"])
+
+
+def answer_anything(prompt, h):
+  return "Status: going about the day as planned."
+
+
+# (template, a phrase only its prompts contain, answer function), in the
+# order they are tried.
+PROMPT_TEMPLATES = [
+  ("wake_up_hour", "'s wake up hour:", answer_wake_up_hour),
+  ("daily_planning", "'s plan today in broad-strokes (with the time of the "
+   "day. e.g., have a lunch at 12:00 pm, watch TV from 7 to 8 pm): 1)",
+   answer_daily_plan),
+  ("generate_hourly_schedule", "Hourly schedule format:",
+   answer_hourly_schedule),
+  ("task_decomp", "In 5 min increments, list the subtasks",
+   answer_task_decomp),
+  ("action_location_sector", "should go to the following area: {",
+   answer_action_sector),
+  ("action_location_object", "(MUST pick one of {", answer_action_arena),
+  ("action_object", "Pick ONE most relevant object", answer_action_object),
+  ("generate_pronunciatio", "Convert an action description to an emoji",
+   answer_pronunciatio),
+  ("generate_obj_event", "We want to understand the state of an object",
+   answer_object_state),
+  ("generate_event_triple", "Task: Turn the input into (subject, predicate",
+   answer_object_event_triple),
+  ("event_triple", "into a triple of (subject, predicate, object)",
+   answer_event_triple),
+  ("new_decomp_schedule", "The revised schedule:",
+   answer_new_decomp_schedule),
+  ("decide_to_talk", "initiate a conversation with", answer_decide_to_talk),
+  ("poignancy", "rate the likely poignancy", answer_poignancy),
+  ("memo_on_convo", "generate 1-3 emojis", answer_memo_on_convo),
+  ("planning_thought_on_convo", "generate a planning thought",
+   answer_planning_thought),
+  ("insight_and_guidance", "key insights", answer_insights),
+  ("focal_pt", "key focal points", answer_focal_points),
+]
+
+
+def chat_answer(prompt):
+  """
+  Returns the template <prompt> was made from ("other" if we do not know
+  it) and the mock's answer to it.
+  """
+  h = prompt_hash(prompt)
+  for template, phrase, answer in PROMPT_TEMPLATES:
+    if phrase in prompt:
+      try:
+        return template, answer(prompt, h)
+      except Exception:
+        # The prompt did not have the shape we expected (e.g., it offers no
+        # options); a model would still answer something.
+        return template, answer_anything(prompt, h)
+  return "other", answer_anything(prompt, h)
+
+
+def embedding(text, dim=EMBEDDING_DIM):
+  """
+  Returns a unit vector of <dim> floats that only depends on <text>.
+  """
+  vector = np.random.default_rng(prompt_hash(text)).standard_normal(dim)
+  return (vector / np.linalg.norm(vector)).tolist()
+
+
+class MockLLMServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, latency=0.0, jitter=0.0,
+               embedding_dim=EMBEDDING_DIM):
+    """
+    INPUT
+      address: the (host, port) to listen on; port 0 picks a free port.
+      latency: the seconds every request takes at least.
+      jitter: up to this many seconds are added to <latency>, depending on
+              the request.
+      embedding_dim: the length of the embeddings.
+    """
+    super().__init__(address, MockLLMHandler)
+    self.latency = latency
+    self.jitter = jitter
+    self.embedding_dim = embedding_dim
+    self.stats = collections.Counter()
+    self.stats_lock = threading.Lock()
+
+
+  def delay(self, h):
+    if self.latency or self.jitter:
+      time.sleep(self.latency + self.jitter * (h % 1000) / 1000)
+
+
+  def count(self, *keys):
+    with self.stats_lock:
+      for key in keys:
+        self.stats[key] += 1
+
+
+  def url(self):
+    return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+  # Keep-alive, like Ollama, so the client's connection pool is used.
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    pass
+
+
+  def send_body(self, body, content_type="application/json"):
+    self.send_response(200)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+  def do_GET(self):
+    if self.path != "/api/stats":
+      self.send_error(404)
+      return
+    with self.server.stats_lock:
+      stats = dict(self.server.stats)
+    self.send_body(json.dumps(stats).encode("utf-8"))
+
+
+  def do_POST(self):
+    length = int(self.headers.get("Content-Length", 0))
+    try:
+      request = json.loads(self.rfile.read(length))
+    except ValueError:
+      self.send_error(400)
+      return
+
+    if self.path == "/api/embeddings":
+      text = request.get("prompt", "")
+      self.server.count("embeddings")
+      self.server.delay(prompt_hash(text))
+      body = json.dumps(
+        {"embedding": embedding(text, self.server.embedding_dim)})
+      self.send_body(body.encode("utf-8"))
+
+    elif self.path == "/api/chat":
+      prompt = request["messages"][-1]["content"]
+      template, answer = chat_answer(prompt)
+      self.server.count("chat", f"chat:{template}")
+      self.server.delay(prompt_hash(prompt))
+      # Streamed the way Ollama streams it: one JSON object per line, the
+      # last one marked "done".
+      model = request.get("model", "")
+      lines = [{"model": model, "done": False,
+                "message": {"role": "assistant", "content": answer}},
+               {"model": model, "done": True,
+                "message": {"role": "assistant", "content": ""}}]
+      body = "".join(json.dumps(line) + "\n" for line in lines)
+      self.send_body(body.encode("utf-8"), "application/x-ndjson")
+
+    else:
+      self.send_error(404)
+
+
+def start_mock_server(host="127.0.0.1", port=0, latency=0.0, jitter=0.0,
+                      embedding_dim=EMBEDDING_DIM):
+  """
+  Starts a MockLLMServer on a background thread and returns it. Call its
+  shutdown() to stop it.
+  """
+  server = MockLLMServer((host, port), latency, jitter, embedding_dim)
+  threading.Thread(target=server.serve_forever, name="mock-llm-server",
+                   daemon=True).start()
+  return server
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description="Serve deterministic Ollama answers for benchmarks.")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=11434,
+                      help="the port to listen on (0 picks a free one)")
+  parser.add_argument("--latency", type=float, default=0,
+                      help="the milliseconds every request takes at least")
+  parser.add_argument("--jitter", type=float, default=0,
+                      help="up to this many milliseconds are added to the "
+                           "latency of a request")
+  parser.add_argument("--embedding-dim", type=int, default=EMBEDDING_DIM,
+                      help="the length of the embeddings")
+  args = parser.parse_args()
+
+  server = MockLLMServer((args.host, args.port), args.latency / 1000,
+                         args.jitter / 1000, args.embedding_dim)
+  # The benchmark reads this line to find the port.
+  print (f"Mock LLM server listening on {server.url()}", flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
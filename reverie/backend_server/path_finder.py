@@ -5,8 +5,14 @@ File: path_finder.py
 Description: Implements various path finding functions for generative agents.
 Some of the functions are defunct. 
 """
+import heapq
+import threading
+from collections import OrderedDict, deque
+
 import numpy as np
 
+from profiler import profiled
+
 def print_maze(maze):
   for row in maze:
     for item in row:
@@ -14,6 +20,493 @@ def print_maze(maze):
     print()
 
 
+class PathFinder: 
+  """
+  Shortest path search over a fixed collision maze. The maze is turned into a
+  passability grid once (rather than on every call, as path_finder_v2 does),
+  and paths are found with A* on that grid. 
+
+  For searches towards a set of target tiles (e.g., all tiles of an arena or
+  a game object), the finder also keeps BFS distance fields: the distance of
+  every tile to the nearest target. Once a field is built, the shortest path
+  from any tile is found by walking downhill, in time proportional to the
+  path length. Fields are built on first use and kept in a bounded cache, or 
+  ahead of time with precompute(). 
+
+  Two more layers keep searches small: 
+  - A connected-component label for every tile, so that a target that 
+    cannot be reached is rejected in O(1) instead of after a full search. 
+  - If the maze is divided into regions (the arenas), a graph of the 
+    entrances between regions, which gives the distances between regions
+    (see region_distance). With <hierarchical> on, a search between two 
+    regions first finds a route of regions on that graph, and then runs A*
+    only over the tiles of the regions on the route and their neighbors 
+    (falling back to the whole maze if that fails). The route is chosen 
+    with straight-line costs inside regions, so such a path is the shortest
+    one through those regions, which is almost always, but not always, the
+    shortest one overall. This pays off on maps made of many enclosed 
+    regions; on maps like the_ville, where one open arena covers most of 
+    the map, the plain A* search is faster, so it is off by default. 
+
+  All tiles are in (x, y) form, as everywhere else in the backend. 
+  """
+  def __init__(self, collision_maze, collision_block_char, max_fields=512, 
+               regions=None, hierarchical=False): 
+    """
+    INPUT
+      collision_maze: The collision maze as a list of rows of block ids, as in
+                      Maze.collision_maze. 
+      collision_block_char: The block id of impassable tiles. 
+      max_fields: The most distance fields kept in the cache. 
+      regions: Optionally, a height x width grid of region codes (e.g., 
+               Maze.arena_grid) for the region graph. 
+      hierarchical: If True (and <regions> is given), searches between 
+                    regions go through the region graph first. 
+    """
+    # <passable> is a boolean height x width grid; True means a persona can
+    # stand on the tile. 
+    self.passable = np.array(collision_maze) != collision_block_char
+    self.height, self.width = self.passable.shape
+    # The search loops below run on flat tile indices (y * width + x) and 
+    # read passability from a plain list, which is much faster than indexing
+    # the numpy grid one element at a time. 
+    self.open = self.passable.ravel().tolist()
+    self.max_fields = max_fields
+    self.fields = OrderedDict()
+    # <lock> guards the caches (<fields> and <region_distances>), which the
+    # step workers share; the searches themselves run outside it. 
+    self.lock = threading.Lock()
+
+    # <components> labels each passable tile with its connected component 
+    # (-1 for impassable tiles); two tiles are reachable from each other 
+    # exactly when their labels are equal. 
+    self.component_of = self.label_components()
+    self.components = np.array(self.component_of, dtype=np.int32).reshape(
+                        self.height, self.width)
+
+    # The region graph. <region_nodes> maps a region to its entrance tiles,
+    # <node_links> maps an entrance tile to the entrance tiles on the other
+    # side of the region border, and <region_links> maps a region to the 
+    # regions next to it. <region_distances> caches, for a source region, 
+    # the distance to every other region. 
+    self.hierarchical = hierarchical
+    self.region_of = None
+    self.region_nodes = dict()
+    self.node_links = dict()
+    self.region_links = dict()
+    self.region_distances = dict()
+    if regions is not None: 
+      self.build_region_graph(regions)
+
+
+  def label_components(self): 
+    """
+    Returns the flat list of connected-component labels of the tiles. 
+    """
+    labels = [-1] * len(self.open)
+    count = 0
+    for idx in range(len(self.open)): 
+      if not self.open[idx] or labels[idx] >= 0: 
+        continue
+      labels[idx] = count
+      queue = deque([idx])
+      while queue: 
+        for n_idx in self.neighbors(queue.popleft()): 
+          if labels[n_idx] < 0: 
+            labels[n_idx] = count
+            queue.append(n_idx)
+      count += 1
+    return labels
+
+
+  def entry_tiles(self, idx): 
+    """
+    Returns the flat tile indices a search from <idx> starts on: <idx> 
+    itself if it is passable, and otherwise its passable neighbors, so that 
+    a persona standing on an impassable tile (which some stored environments
+    have) can still walk off it. 
+    """
+    if self.open[idx]: 
+      return [idx]
+    return self.neighbors(idx)
+
+
+  def reachable(self, start, end): 
+    """
+    Returns True if <end> can be reached from <start>. 
+    """
+    end_label = self.component_of[end[1] * self.width + end[0]]
+    return end_label >= 0 and any(
+      self.component_of[idx] == end_label 
+      for idx in self.entry_tiles(start[1] * self.width + start[0]))
+
+
+  def build_region_graph(self, regions): 
+    """
+    Finds the entrances between regions. Passable tiles next to each other
+    in different regions are crossings; a run of crossings along the same 
+    border is one entrance, represented by the crossing in its middle. 
+
+    INPUT
+      regions: A height x width grid of region codes. 
+    OUTPUT
+      None
+    """
+    width = self.width
+    self.region_of = np.asarray(regions).ravel().tolist()
+    # The crossings of each border, in order along the border: a border is 
+    # a column boundary ("h", between x and x + 1) or a row boundary ("v", 
+    # between y and y + 1) between two given regions. 
+    borders = dict()
+    for idx in range(len(self.open)): 
+      if not self.open[idx]: 
+        continue
+      region = self.region_of[idx]
+      x = idx % width
+      right = idx + 1
+      if (x < width - 1 and self.open[right] 
+          and self.region_of[right] != region): 
+        key = ("h", x, region, self.region_of[right])
+        borders.setdefault(key, []).append((idx // width, idx, right))
+      down = idx + width
+      if (down < len(self.open) and self.open[down] 
+          and self.region_of[down] != region): 
+        key = ("v", idx // width, region, self.region_of[down])
+        borders.setdefault(key, []).append((x, idx, down))
+
+    for crossings in borders.values(): 
+      run = [crossings[0]]
+      for crossing in crossings[1:] + [None]: 
+        if crossing is not None and crossing[0] == run[-1][0] + 1: 
+          run += [crossing]
+          continue
+        _, a_idx, b_idx = run[len(run) // 2]
+        for node, other in [(a_idx, b_idx), (b_idx, a_idx)]: 
+          nodes = self.region_nodes.setdefault(self.region_of[node], [])
+          if node not in self.node_links: 
+            nodes += [node]
+          self.node_links.setdefault(node, []).append(other)
+          self.region_links.setdefault(self.region_of[node], set()).add(
+            self.region_of[other])
+        run = [crossing]
+
+
+  def manhattan(self, a_idx, b_idx): 
+    return (abs(a_idx % self.width - b_idx % self.width) 
+            + abs(a_idx // self.width - b_idx // self.width))
+
+
+  def region_search(self, sources, goal_idx=None): 
+    """
+    Dijkstra over the region graph. Inside a region, an entrance leads to 
+    every other entrance of the region in the same component, at their 
+    straight-line (Manhattan) distance; an entrance leads to the entrance on
+    the other side of its border at distance 1. 
+
+    INPUT
+      sources: A dictionary from start entrance tile (or any tile) to its 
+               starting distance. 
+      goal_idx: If given, the search stops at this tile, which is reached 
+                from the entrances of its region. 
+    OUTPUT
+      The dictionary of distances, and the dictionary of predecessors. 
+    """
+    dist = dict(sources)
+    came_from = {idx: None for idx in sources}
+    goal_region = None
+    if goal_idx is not None: 
+      goal_region = self.region_of[goal_idx]
+    heap = [(d, idx) for idx, d in sources.items()]
+    heapq.heapify(heap)
+    while heap: 
+      d, idx = heapq.heappop(heap)
+      if d > dist[idx]: 
+        continue
+      if idx == goal_idx: 
+        break
+      region = self.region_of[idx]
+      component = self.component_of[idx]
+      steps = [(other, 1) for other in self.node_links.get(idx, [])]
+      steps += [(other, self.manhattan(idx, other)) 
+                for other in self.region_nodes.get(region, []) 
+                if other != idx and self.component_of[other] == component]
+      if region == goal_region and idx != goal_idx: 
+        steps += [(goal_idx, self.manhattan(idx, goal_idx))]
+      for other, cost in steps: 
+        if other not in dist or d + cost < dist[other]: 
+          dist[other] = d + cost
+          came_from[other] = idx
+          heapq.heappush(heap, (d + cost, other))
+    return dist, came_from
+
+
+  def region_route(self, start_idx, end_idx): 
+    """
+    Returns the set of regions on the best route from <start_idx> to 
+    <end_idx> on the region graph, and the regions next to them, or None if
+    there is no route. 
+    """
+    start_region = self.region_of[start_idx]
+    component = self.component_of[start_idx]
+    sources = {node: self.manhattan(start_idx, node) 
+               for node in self.region_nodes.get(start_region, []) 
+               if self.component_of[node] == component}
+    _, came_from = self.region_search(sources, end_idx)
+    if end_idx not in came_from: 
+      return None
+    route = {start_region}
+    idx = end_idx
+    while idx is not None: 
+      route.add(self.region_of[idx])
+      idx = came_from[idx]
+    # The neighbors give the A* search some room around the route, since 
+    # the route itself is only chosen on straight-line costs. 
+    for region in list(route): 
+      route |= self.region_links.get(region, set())
+    return route
+
+
+  def region_distance(self, a, b): 
+    """
+    Returns the distance between two regions on the region graph: the 
+    shortest route from an entrance of <a> to an entrance of <b>, counting 
+    straight-line distances inside regions. None if <b> cannot be reached 
+    from <a>. The distances from a region to all others are computed on 
+    first use and cached (see precompute_regions). 
+    """
+    distances = self.region_distances.get(a)
+    if distances is None: 
+      sources = {node: 0 for node in self.region_nodes.get(a, [])}
+      dist, _ = self.region_search(sources)
+      distances = {a: 0}
+      for idx, d in dist.items(): 
+        region = self.region_of[idx]
+        if d < distances.get(region, float("inf")): 
+          distances[region] = d
+      with self.lock: 
+        distances = self.region_distances.setdefault(a, distances)
+    return distances.get(b)
+
+
+  def precompute_regions(self): 
+    """
+    Computes the distances between all pairs of regions ahead of time. 
+    """
+    for region in self.region_nodes: 
+      self.region_distance(region, region)
+
+
+  def neighbors(self, idx): 
+    """
+    Returns the passable tiles next to the flat tile index <idx>, in the
+    order up, left, down, right. 
+    """
+    width = self.width
+    x = idx % width
+    out = []
+    if idx >= width and self.open[idx - width]: 
+      out += [idx - width]
+    if x > 0 and self.open[idx - 1]: 
+      out += [idx - 1]
+    if idx + width < len(self.open) and self.open[idx + width]: 
+      out += [idx + width]
+    if x < width - 1 and self.open[idx + 1]: 
+      out += [idx + 1]
+    return out
+
+
+  @profiled("operation", "path_finding")
+  def find_path(self, start, end): 
+    """
+    Finds a shortest path from <start> to <end> with A* (Manhattan distance
+    heuristic, binary heap). 
+
+    INPUT
+      start: The start tile in (x, y) form. 
+      end: The end tile in (x, y) form. 
+    OUTPUT
+      A list of (x, y) tiles from <start> to <end>, both included. [start] if
+      the two are the same tile, and [] if <end> cannot be reached. 
+    """
+    width = self.width
+    start_idx = start[1] * width + start[0]
+    end_idx = end[1] * width + end[0]
+    if start_idx == end_idx: 
+      return [tuple(start)]
+    if not self.reachable(start, end): 
+      return []
+    if not self.open[start_idx]: 
+      # Step off the impassable start onto the neighbor with the shortest 
+      # path. 
+      paths = [self.find_path((idx % width, idx // width), end) 
+               for idx in self.entry_tiles(start_idx)]
+      paths = [path for path in paths if path]
+      return [tuple(start)] + min(paths, key=len)
+
+    if (self.hierarchical and self.region_of is not None 
+        and self.region_of[start_idx] != self.region_of[end_idx]): 
+      route = self.region_route(start_idx, end_idx)
+      if route: 
+        path = self.a_star(start_idx, end_idx, route)
+        if path: 
+          return path
+    return self.a_star(start_idx, end_idx)
+
+
+  def a_star(self, start_idx, end_idx, regions=None): 
+    """
+    A* from <start_idx> to <end_idx> (flat tile indices), optionally only 
+    over the tiles of the given set of <regions>. Returns the path as a list
+    of (x, y) tiles, or [] if there is none. 
+    """
+    width = self.width
+    end_x, end_y = end_idx % width, end_idx // width
+    came_from = {start_idx: None}
+    g_score = {start_idx: 0}
+    # Heap entries are (f, -g, idx): among equal f, deeper tiles first, which
+    # keeps the search close to the straight line. 
+    heap = [(self.manhattan(start_idx, end_idx), 0, start_idx)]
+    while heap: 
+      _, neg_g, idx = heapq.heappop(heap)
+      if idx == end_idx: 
+        return self.trace_path(came_from, end_idx)
+      g = -neg_g
+      if g > g_score[idx]: 
+        continue
+      for n_idx in self.neighbors(idx): 
+        if regions is not None and self.region_of[n_idx] not in regions: 
+          continue
+        if n_idx not in g_score or g + 1 < g_score[n_idx]: 
+          g_score[n_idx] = g + 1
+          came_from[n_idx] = idx
+          h = abs(n_idx % width - end_x) + abs(n_idx // width - end_y)
+          heapq.heappush(heap, (g + 1 + h, -(g + 1), n_idx))
+    return []
+
+
+  def trace_path(self, came_from, end_idx): 
+    path = []
+    idx = end_idx
+    while idx is not None: 
+      path += [(idx % self.width, idx // self.width)]
+      idx = came_from[idx]
+    path.reverse()
+    return path
+
+
+  def distance_field(self, targets): 
+    """
+    Returns the BFS distance field of a set of target tiles: a flat int32 
+    array with, for each tile, the number of steps to the nearest target, or
+    -1 if no target can be reached from it. 
+
+    INPUT
+      targets: An iterable of target tiles in (x, y) form. 
+    OUTPUT
+      The distance field, as a numpy array of length width x height. 
+    """
+    key = frozenset((int(x), int(y)) for x, y in targets)
+    with self.lock: 
+      field = self.fields.get(key)
+      if field is not None: 
+        self.fields.move_to_end(key)
+        return field
+
+    dist = [-1] * len(self.open)
+    queue = deque()
+    for x, y in key: 
+      idx = y * self.width + x
+      if self.open[idx]: 
+        dist[idx] = 0
+        queue.append(idx)
+    while queue: 
+      idx = queue.popleft()
+      next_dist = dist[idx] + 1
+      for n_idx in self.neighbors(idx): 
+        if dist[n_idx] < 0: 
+          dist[n_idx] = next_dist
+          queue.append(n_idx)
+    field = np.array(dist, dtype=np.int32)
+
+    with self.lock: 
+      self.fields[key] = field
+      self.fields.move_to_end(key)
+      while len(self.fields) > self.max_fields: 
+        self.fields.popitem(last=False)
+    return field
+
+
+  def precompute(self, target_sets): 
+    """
+    Builds the distance fields of <target_sets> (e.g., the values of 
+    Maze.address_tiles) ahead of time. The cache is grown to hold them all. 
+    """
+    target_sets = list(target_sets)
+    self.max_fields = max(self.max_fields, len(target_sets) + 64)
+    for targets in target_sets: 
+      self.distance_field(targets)
+
+
+  @profiled("operation", "path_finding")
+  def path_to_nearest(self, start, targets): 
+    """
+    Finds a shortest path from <start> to the nearest of <targets>, by 
+    walking down the targets' distance field. The field is cached under the
+    whole set of <targets>, so callers should pass the same set (e.g., all 
+    tiles of an address) every time to reuse it. A single target is searched
+    for with A* instead. 
+
+    INPUT
+      start: The start tile in (x, y) form. 
+      targets: An iterable of target tiles in (x, y) form. 
+    OUTPUT
+      A list of (x, y) tiles from <start> to the nearest target, both 
+      included, or [] if no target can be reached. 
+    """
+    targets = list(targets)
+    if len(targets) == 1: 
+      return self.find_path(start, targets[0])
+    # Targets in other components do not change the distances in this one, 
+    # and tiles they cannot be reached from have distance -1. 
+    field = self.distance_field(targets)
+    idx = start[1] * self.width + start[0]
+    path = [(idx % self.width, idx // self.width)]
+    if not self.open[idx]: 
+      # Step off the impassable start onto its nearest neighbor. 
+      entries = [n_idx for n_idx in self.entry_tiles(idx) if field[n_idx] >= 0]
+      if not entries: 
+        return []
+      idx = min(entries, key=lambda n_idx: field[n_idx])
+      path += [(idx % self.width, idx // self.width)]
+    if field[idx] < 0: 
+      return []
+    while field[idx] > 0: 
+      for n_idx in self.neighbors(idx): 
+        if field[n_idx] == field[idx] - 1: 
+          idx = n_idx
+          break
+      path += [(idx % self.width, idx // self.width)]
+    return path
+
+
+  def distance(self, start, targets): 
+    """
+    Returns the number of steps from <start> to the nearest of <targets>, or
+    None if none of them can be reached. 
+    """
+    field = self.distance_field(targets)
+    idx = start[1] * self.width + start[0]
+    if self.open[idx]: 
+      d = int(field[idx])
+    else: 
+      # One step off the impassable start. 
+      d = min([int(field[n_idx]) + 1 for n_idx in self.entry_tiles(idx) 
+               if field[n_idx] >= 0], default=-1)
+    if d < 0: 
+      return None
+    return d
+
+
 def path_finder_v1(maze, start, end, collision_block_char, verbose=False): 
   def prepare_maze(maze, start, end):
     maze[start[0]][start[1]] = "S"
@@ -162,19 +655,14 @@ def path_finder_v2(a, start, end, collision_block_char, verbose=False):
 
 
 def path_finder(maze, start, end, collision_block_char, verbose=False):
-  # EMERGENCY PATCH
-  start = (start[1], start[0])
-  end = (end[1], end[0])
-  # END EMERGENCY PATCH
-
-  path = path_finder_v2(maze, start, end, collision_block_char, verbose)
-
-  new_path = []
-  for i in path: 
-    new_path += [(i[1], i[0])]
-  path = new_path
-  
-  return path
+  """
+  Finds a shortest path from <start> to <end> on the collision maze <maze>.
+  Tiles are in (x, y) form. Returns [] if <end> cannot be reached. 
+
+  This builds a PathFinder for the maze on every call; code that searches the
+  same maze repeatedly should use Maze.path_engine instead. 
+  """
+  return PathFinder(maze, collision_block_char).find_path(start, end)
 
 
 def closest_coordinate(curr_coordinate, target_coordinates): 
@@ -51,21 +51,21 @@ def execute(persona, maze, personas, plan):
       # Executing persona-persona interaction.
       target_p_tile = (personas[plan.split("<persona>")[-1].strip()]
                        .scratch.curr_tile)
-      potential_path = path_finder(maze.collision_maze, 
-                                   persona.scratch.curr_tile, 
-                                   target_p_tile, 
-                                   collision_block_id)
-      if len(potential_path) <= 2: 
+      potential_path = maze.path_engine.find_path(persona.scratch.curr_tile, 
+                                                  target_p_tile)
+      if not potential_path: 
+        # The other persona cannot be reached; the search below will keep 
+        # this persona where it is. 
+        target_tiles = [target_p_tile]
+      elif len(potential_path) <= 2: 
         target_tiles = [potential_path[0]]
       else: 
-        potential_1 = path_finder(maze.collision_maze, 
-                                persona.scratch.curr_tile, 
-                                potential_path[int(len(potential_path)/2)], 
-                                collision_block_id)
-        potential_2 = path_finder(maze.collision_maze, 
-                                persona.scratch.curr_tile, 
-                                potential_path[int(len(potential_path)/2)+1], 
-                                collision_block_id)
+        potential_1 = maze.path_engine.find_path(
+                        persona.scratch.curr_tile, 
+                        potential_path[int(len(potential_path)/2)])
+        potential_2 = maze.path_engine.find_path(
+                        persona.scratch.curr_tile, 
+                        potential_path[int(len(potential_path)/2)+1])
         if len(potential_1) <= len(potential_2): 
           target_tiles = [potential_path[int(len(potential_path)/2)]]
         else: 
@@ -85,7 +85,7 @@ def execute(persona, maze, personas, plan):
       if not target_tiles:
         print(f"Warning: Invalid address {plan}, defaulting to current tile")
         return persona.scratch.curr_tile, "", f"{persona.name} is waiting as the destination {plan} is unavailable"
-      target_tiles = random.sample(list(target_tiles), 1)
+      target_tiles = persona.rng.sample(list(target_tiles), 1)
 
     else: 
       # This is our default execution. We simply take the persona to the
@@ -101,10 +101,8 @@ def execute(persona, maze, personas, plan):
     # There are sometimes more than one tile returned from this (e.g., a tabe
     # may stretch many coordinates). So, we sample a few here. And from that 
     # random sample, we will take the closest ones. 
-    if len(target_tiles) < 4: 
-      target_tiles = random.sample(list(target_tiles), len(target_tiles))
-    else:
-      target_tiles = random.sample(list(target_tiles), 4)
+    target_tiles = persona.rng.sample(list(target_tiles), 
+                                      min(4, len(target_tiles)))
     # If possible, we want personas to occupy different tiles when they are 
     # headed to the same location on the maze. It is ok if they end up on the 
     # same time, but we try to lower that probability. 
@@ -112,54 +110,31 @@ def execute(persona, maze, personas, plan):
     persona_name_set = set(personas.keys())
     new_target_tiles = []
     for i in target_tiles: 
-      curr_event_set = maze.access_tile(i)["events"]
-      pass_curr_tile = False
-      for j in curr_event_set: 
-        if j[0] in persona_name_set: 
-          pass_curr_tile = True
-      if not pass_curr_tile: 
+      if not maze.tile_occupants(i, persona_name_set): 
         new_target_tiles += [i]
     if len(new_target_tiles) == 0: 
       new_target_tiles = target_tiles
     target_tiles = new_target_tiles
 
-    # Now that we've identified the target tile, we find the shortest path to
-    # one of the target tiles. 
+    # Now that we've identified the target tiles, we find the shortest path 
+    # to the closest of them. 
     curr_tile = persona.scratch.curr_tile
-    collision_maze = maze.collision_maze
-    
-    if not target_tiles:
-        # If we have no target tiles, stay at current position
-        closest_target_tile = curr_tile
-    else:
-        min_path_length = float('inf')
-        for i in target_tiles: 
-            try:
-                # Ensure coordinates are in the correct format
-                start = tuple(map(int, curr_tile))
-                end = tuple(map(int, i))
-                
-                # path_finder takes a collision_maze and the curr_tile coordinate as 
-                # an input, and returns a list of coordinate tuples that becomes the
-                # path. 
-                curr_path = path_finder(maze.collision_maze, 
-                                    start, 
-                                    end, 
-                                    collision_block_id)
-                
-                if curr_path and len(curr_path) < min_path_length:
-                    min_path_length = len(curr_path)
-                    closest_target_tile = i
-                    path = curr_path
-            except Exception as e:
-                print(f"Path finding error for tile {i}: {str(e)}")
-                continue
+    start = tuple(map(int, curr_tile))
+    min_path_length = float('inf')
+    for i in target_tiles: 
+      # The path engine returns a list of coordinate tuples (from curr_tile 
+      # to the target) that becomes the path, or [] if it cannot be reached.
+      curr_path = maze.path_engine.find_path(start, tuple(map(int, i)))
+      if curr_path and len(curr_path) < min_path_length: 
+        min_path_length = len(curr_path)
+        closest_target_tile = curr_path[-1]
+        path = curr_path
 
-        if not closest_target_tile:
-            # If no valid path was found to any target, stay at current position
-            print(f"No valid path found for {persona.name} to any target tile")
-            closest_target_tile = curr_tile
-            path = [curr_tile]
+    if not closest_target_tile: 
+      # If no valid path was found to any target, stay at current position
+      print(f"No valid path found for {persona.name} to any target tile")
+      closest_target_tile = curr_tile
+      path = [curr_tile]
 
     # Store the target tile and path for future reference
     persona.scratch.current_target_tile = closest_target_tile
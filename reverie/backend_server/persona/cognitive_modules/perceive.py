@@ -22,6 +22,16 @@ def generate_poig_score(persona, event_type, description):
     return run_gpt_prompt_chat_poignancy(persona, 
                            persona.scratch.act_description)[0]
 
+def get_embedding_text(desc): 
+  """
+  Returns the part of an event description that we embed: the text in 
+  parentheses if there is any, and the whole description otherwise. 
+  """
+  if "(" in desc: 
+    return desc.split("(")[1].split(")")[0].strip()
+  return desc
+
+
 def perceive(persona, maze): 
   """
   Perceives events around the persona and saves it to the memory, both events 
@@ -41,15 +51,28 @@ def perceive(persona, maze):
     ret_events: a list of <ConceptNode> that are perceived and new. 
   """
   # PERCEIVE SPACE
-  # We get the nearby tiles given our current tile and the persona's vision
-  # radius. 
-  nearby_tiles = maze.get_nearby_tiles(persona.scratch.curr_tile, 
-                                       persona.scratch.vision_r)
+  # We get the nearby area given our current tile and the persona's vision
+  # radius, as bounds on the maze's code grids. 
+  curr_tile = persona.scratch.curr_tile
+  left, right, top, bottom = maze.get_nearby_bounds(curr_tile, 
+                                                    persona.scratch.vision_r)
+  # The nearby tiles in get_nearby_tiles' order (column by column). 
+  arena_codes = maze.arena_grid[top:bottom, left:right].T.ravel()
+  game_object_codes = maze.game_object_grid[top:bottom, left:right].T.ravel()
 
   # We then store the perceived space. Note that the s_mem of the persona is
-  # in the form of a tree constructed using dictionaries. 
-  for i in nearby_tiles: 
-    i = maze.access_tile(i)
+  # in the form of a tree constructed using dictionaries. Each distinct 
+  # (arena, game object) pair only needs to be looked at once, in the order
+  # of its first tile. 
+  pair_codes = (arena_codes.astype(numpy.int32) * len(maze.game_object_names) 
+                + game_object_codes)
+  _, first_tiles = numpy.unique(pair_codes, return_index=True)
+  for idx in sorted(first_tiles.tolist()): 
+    arena_code = arena_codes[idx]
+    i = {"world": maze.world, 
+         "sector": maze.sector_names[maze.arena_sectors[arena_code]], 
+         "arena": maze.arena_names[arena_code], 
+         "game_object": maze.game_object_names[game_object_codes[idx]]}
     if i["world"]: 
       if (i["world"] not in persona.s_mem.tree): 
         persona.s_mem.tree[i["world"]] = {}
@@ -69,43 +92,24 @@ def perceive(persona, maze):
 
   # PERCEIVE EVENTS. 
   # We will perceive events that take place in the same arena as the
-  # persona's current arena. 
-  curr_arena_path = maze.get_tile_path(persona.scratch.curr_tile, "arena")
-  # We do not perceive the same event twice (this can happen if an object is
-  # extended across multiple tiles).
-  percept_events_set = set()
-  # We will order our percept based on the distance, with the closest ones
-  # getting priorities. 
-  percept_events_list = []
-  # First, we put all events that are occuring in the nearby tiles into the
-  # percept_events_list
-  for tile in nearby_tiles: 
-    tile_details = maze.access_tile(tile)
-    if tile_details["events"]: 
-      if maze.get_tile_path(tile, "arena") == curr_arena_path:  
-        # This calculates the distance between the persona's current tile, 
-        # and the target tile.
-        dist = math.dist([tile[0], tile[1]], 
-                         [persona.scratch.curr_tile[0], 
-                          persona.scratch.curr_tile[1]])
-        # Add any relevant events to our temp set/list with the distant info. 
-        for event in tile_details["events"]: 
-          if event not in percept_events_set: 
-            percept_events_list += [[dist, event]]
-            percept_events_set.add(event)
-
-  # We sort, and perceive only persona.scratch.att_bandwidth of the closest
-  # events. If the bandwidth is larger, then it means the persona can perceive
-  # more elements within a small area. 
-  percept_events_list = sorted(percept_events_list, key=itemgetter(0))
-  perceived_events = []
-  for dist, event in percept_events_list[:persona.scratch.att_bandwidth]: 
-    perceived_events += [event]
+  # persona's current arena. We do not perceive the same event twice (this 
+  # can happen if an object is extended across multiple tiles), and we 
+  # perceive only persona.scratch.att_bandwidth of the closest events. If 
+  # the bandwidth is larger, then it means the persona can perceive more 
+  # elements within a small area. 
+  perceived_events = maze.query_events(curr_tile, persona.scratch.vision_r, 
+                                       same_arena=True, 
+                                       k=persona.scratch.att_bandwidth)
 
   # Storing events. 
-  # <ret_events> is a list of <ConceptNode> instances from the persona's 
-  # associative memory. 
-  ret_events = []
+  # First, we find the events that are new. We check each event against the
+  # latest persona.scratch.retention events. If there is something new that
+  # is happening (that is, p_event not in latest_events), then we will add
+  # that event to the a_mem. Since every new event becomes one of the latest
+  # events, we keep <latest_events> up to date as we go. 
+  latest_events = [e_node.spo_summary() for e_node 
+                   in persona.a_mem.seq_event[:persona.scratch.retention]]
+  new_events = []
   for p_event in perceived_events: 
     s, p, o, desc = p_event
     if not p: 
@@ -116,67 +120,73 @@ def perceive(persona, maze):
     desc = f"{s.split(':')[-1]} is {desc}"
     p_event = (s, p, o)
 
-    # We retrieve the latest persona.scratch.retention events. If there is  
-    # something new that is happening (that is, p_event not in latest_events),
-    # then we add that event to the a_mem and return it. 
-    latest_events = persona.a_mem.get_summarized_latest_events(
-                                    persona.scratch.retention)
     if p_event not in latest_events:
-      # We start by managing keywords. 
-      keywords = set()
-      sub = p_event[0]
-      obj = p_event[2]
-      if ":" in p_event[0]: 
-        sub = p_event[0].split(":")[-1]
-      if ":" in p_event[2]: 
-        obj = p_event[2].split(":")[-1]
-      keywords.update([sub, obj])
-
-      # Get event embedding
-      desc_embedding_in = desc
-      if "(" in desc: 
-        desc_embedding_in = (desc_embedding_in.split("(")[1]
-                                              .split(")")[0]
-                                              .strip())
-      if desc_embedding_in in persona.a_mem.embeddings: 
-        event_embedding = persona.a_mem.embeddings[desc_embedding_in]
-      else: 
-        event_embedding = get_embedding(desc_embedding_in)
-      event_embedding_pair = (desc_embedding_in, event_embedding)
-      
-      # Get event poignancy. 
-      event_poignancy = generate_poig_score(persona, 
-                                            "event", 
-                                            desc_embedding_in)
-
-      # If we observe the persona's self chat, we include that in the memory
-      # of the persona here. 
-      chat_node_ids = []
-      if p_event[0] == f"{persona.name}" and p_event[1] == "chat with": 
-        curr_event = persona.scratch.act_event
-        if persona.scratch.act_description in persona.a_mem.embeddings: 
-          chat_embedding = persona.a_mem.embeddings[
-                             persona.scratch.act_description]
-        else: 
-          chat_embedding = get_embedding(persona.scratch
-                                                .act_description)
-        chat_embedding_pair = (persona.scratch.act_description, 
-                               chat_embedding)
-        chat_poignancy = generate_poig_score(persona, "chat", 
-                                             persona.scratch.act_description)
-        chat_node = persona.a_mem.add_chat(persona.scratch.curr_time, None,
-                      curr_event[0], curr_event[1], curr_event[2], 
-                      persona.scratch.act_description, keywords, 
-                      chat_poignancy, chat_embedding_pair, 
-                      persona.scratch.chat)
-        chat_node_ids = [chat_node.node_id]
-
-      # Finally, we add the current event to the agent's memory. 
-      ret_events += [persona.a_mem.add_event(persona.scratch.curr_time, None,
-                           s, p, o, desc, keywords, event_poignancy, 
-                           event_embedding_pair, chat_node_ids)]
-      persona.scratch.importance_trigger_curr -= event_poignancy
-      persona.scratch.importance_ele_n += 1
+      new_events += [(p_event, desc)]
+      latest_events = ([p_event] + latest_events)[:persona.scratch.retention]
+
+  # Then we embed everything the new events need in one batch. 
+  is_self_chat = lambda p_event: (p_event[0] == f"{persona.name}" 
+                                  and p_event[1] == "chat with")
+  embedding_texts = []
+  for p_event, desc in new_events: 
+    embedding_texts += [get_embedding_text(desc)]
+    if is_self_chat(p_event): 
+      embedding_texts += [persona.scratch.act_description]
+  embedding_texts = [text for text in dict.fromkeys(embedding_texts) 
+                     if text not in persona.a_mem.embeddings]
+  new_embeddings = dict(zip(embedding_texts, 
+                            get_embeddings(embedding_texts)))
+  def embedding_of(text): 
+    if text in persona.a_mem.embeddings: 
+      return persona.a_mem.embeddings[text]
+    return new_embeddings[text]
+
+  # <ret_events> is a list of <ConceptNode> instances from the persona's 
+  # associative memory. 
+  ret_events = []
+  for p_event, desc in new_events: 
+    s, p, o = p_event
+    # We start by managing keywords. 
+    keywords = set()
+    sub = p_event[0]
+    obj = p_event[2]
+    if ":" in p_event[0]: 
+      sub = p_event[0].split(":")[-1]
+    if ":" in p_event[2]: 
+      obj = p_event[2].split(":")[-1]
+    keywords.update([sub, obj])
+
+    # Get event embedding
+    desc_embedding_in = get_embedding_text(desc)
+    event_embedding_pair = (desc_embedding_in, embedding_of(desc_embedding_in))
+    
+    # Get event poignancy. 
+    event_poignancy = generate_poig_score(persona, 
+                                          "event", 
+                                          desc_embedding_in)
+
+    # If we observe the persona's self chat, we include that in the memory
+    # of the persona here. 
+    chat_node_ids = []
+    if is_self_chat(p_event): 
+      curr_event = persona.scratch.act_event
+      chat_embedding_pair = (persona.scratch.act_description, 
+                             embedding_of(persona.scratch.act_description))
+      chat_poignancy = generate_poig_score(persona, "chat", 
+                                           persona.scratch.act_description)
+      chat_node = persona.a_mem.add_chat(persona.scratch.curr_time, None,
+                    curr_event[0], curr_event[1], curr_event[2], 
+                    persona.scratch.act_description, keywords, 
+                    chat_poignancy, chat_embedding_pair, 
+                    persona.scratch.chat)
+      chat_node_ids = [chat_node.node_id]
+
+    # Finally, we add the current event to the agent's memory. 
+    ret_events += [persona.a_mem.add_event(persona.scratch.curr_time, None,
+                         s, p, o, desc, keywords, event_poignancy, 
+                         event_embedding_pair, chat_node_ids)]
+    persona.scratch.importance_trigger_curr -= event_poignancy
+    persona.scratch.importance_ele_n += 1
 
   return ret_events
 
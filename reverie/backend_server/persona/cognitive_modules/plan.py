@@ -684,7 +684,7 @@ def _choose_retrieved(persona, retrieved):
         and curr_event.subject != persona.name): 
       priority += [rel_ctx]
   if priority: 
-    return random.choice(priority)
+    return persona.rng.choice(priority)
 
   # Skip idle. 
   for event_desc, rel_ctx in retrieved.items(): 
@@ -692,7 +692,7 @@ def _choose_retrieved(persona, retrieved):
     if "is idle" not in event_desc: 
       priority += [rel_ctx]
   if priority: 
-    return random.choice(priority)
+    return persona.rng.choice(priority)
   return None
 
 
@@ -950,6 +950,22 @@ def plan(persona, maze, personas, new_day, retrieved):
   OUTPUT 
     The target action address of the persona (persona.scratch.act_address).
   """ 
+  plan_own_action(persona, maze, new_day)
+  return plan_reaction(persona, maze, personas, retrieved)
+
+
+def plan_own_action(persona, maze, new_day): 
+  """
+  The first half of plan(): the long term planning and, if the current 
+  action has expired, choosing the next one. This only reads and writes the
+  persona's own state, so it can run for several personas at once. 
+
+  INPUT: 
+    maze: Current <Maze> instance of the world. 
+    new_day: See plan(). 
+  OUTPUT 
+    None
+  """
   # PART 1: Generate the hourly schedule. 
   if new_day: 
     _long_term_planning(persona, new_day)
@@ -958,6 +974,21 @@ def plan(persona, maze, personas, new_day, retrieved):
   if persona.scratch.act_check_finished(): 
     _determine_action(persona, maze)
 
+
+def plan_reaction(persona, maze, personas, retrieved): 
+  """
+  The second half of plan(): reacting to the retrieved events. Starting a 
+  conversation writes to the scratch of the other persona as well, so the 
+  personas have to go through this one at a time. 
+
+  INPUT: 
+    maze: Current <Maze> instance of the world. 
+    personas: A dictionary that contains all persona names as keys, and the 
+              Persona instance as values. 
+    retrieved: See plan(). 
+  OUTPUT 
+    The target action address of the persona (persona.scratch.act_address).
+  """
   # PART 3: If you perceived an event that needs to be responded to (saw 
   # another persona), and retrieved relevant information. 
   # Step 1: Retrieved may have multiple events represented in it. The first 
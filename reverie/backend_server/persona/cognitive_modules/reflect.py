@@ -115,24 +115,28 @@ def run_reflect(persona):
   # <retrieved> has keys of focal points, and values of the associated Nodes.
   retrieved = new_retrieve(persona, focal_points)
 
-  # For each of the focal points, generate thoughts and save it in the
-  # agent's memory.
+  # For each of the focal points, generate thoughts. 
+  all_thoughts = []
   for focal_pt, nodes in retrieved.items():
     xx = [i.embedding_key for i in nodes]
     for xxx in xx: print (xxx)
 
     thoughts = generate_insights_and_evidence(persona, nodes, 5)
-    for thought, evidence in thoughts.items():
-      created = persona.scratch.curr_time
-      expiration = persona.scratch.curr_time + datetime.timedelta(days=30)
-      s, p, o = generate_action_event_triple(thought, persona)
-      keywords = set([s, p, o])
-      thought_poignancy = generate_poig_score(persona, "thought", thought)
-      thought_embedding_pair = (thought, get_embedding(thought))
+    all_thoughts += list(thoughts.items())
 
-      persona.a_mem.add_thought(created, expiration, s, p, o,
-                                thought, keywords, thought_poignancy,
-                                thought_embedding_pair, evidence)
+  # Then embed all of them in one batch and save them in the agent's memory.
+  thought_embeddings = get_embeddings([thought for thought, _ in all_thoughts])
+  for (thought, evidence), embedding in zip(all_thoughts, thought_embeddings):
+    created = persona.scratch.curr_time
+    expiration = persona.scratch.curr_time + datetime.timedelta(days=30)
+    s, p, o = generate_action_event_triple(thought, persona)
+    keywords = set([s, p, o])
+    thought_poignancy = generate_poig_score(persona, "thought", thought)
+    thought_embedding_pair = (thought, embedding)
+
+    persona.a_mem.add_thought(created, expiration, s, p, o,
+                              thought, keywords, thought_poignancy,
+                              thought_embedding_pair, evidence)
 
 
 def reflection_trigger(persona):
@@ -219,12 +223,18 @@ def reflect(persona):
       planning_thought = generate_planning_thought_on_convo(persona, all_utt)
       planning_thought = f"For {persona.scratch.name}'s planning: {planning_thought}"
 
+      memo_thought = generate_memo_on_convo(persona, all_utt)
+      memo_thought = f"{persona.scratch.name} {memo_thought}"
+
+      # Both thoughts are embedded in one batch.
+      thought_embeddings = get_embeddings([planning_thought, memo_thought])
+
       created = persona.scratch.curr_time
       expiration = persona.scratch.curr_time + datetime.timedelta(days=30)
       s, p, o = generate_action_event_triple(planning_thought, persona)
       keywords = set([s, p, o])
       thought_poignancy = generate_poig_score(persona, "thought", planning_thought)
-      thought_embedding_pair = (planning_thought, get_embedding(planning_thought))
+      thought_embedding_pair = (planning_thought, thought_embeddings[0])
 
       persona.a_mem.add_thought(created, expiration, s, p, o,
                                 planning_thought, keywords, thought_poignancy,
@@ -232,15 +242,12 @@ def reflect(persona):
 
 
 
-      memo_thought = generate_memo_on_convo(persona, all_utt)
-      memo_thought = f"{persona.scratch.name} {memo_thought}"
-
       created = persona.scratch.curr_time
       expiration = persona.scratch.curr_time + datetime.timedelta(days=30)
       s, p, o = generate_action_event_triple(memo_thought, persona)
       keywords = set([s, p, o])
       thought_poignancy = generate_poig_score(persona, "thought", memo_thought)
-      thought_embedding_pair = (memo_thought, get_embedding(memo_thought))
+      thought_embedding_pair = (memo_thought, thought_embeddings[1])
 
       persona.a_mem.add_thought(created, expiration, s, p, o,
                                 memo_thought, keywords, thought_poignancy,
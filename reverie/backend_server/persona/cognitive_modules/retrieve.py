@@ -9,7 +9,9 @@ sys.path.append('../../')
 
 from global_methods import *
 from persona.prompt_template.gpt_structure import *
+from profiler import profiled
 
+import numpy as np
 from numpy import dot
 from numpy.linalg import norm
 
@@ -129,6 +131,51 @@ def top_highest_x_values(d, x):
   return top_v
 
 
+def normalize_array_floats(a, target_min, target_max): 
+  """
+  Array counterpart of normalize_dict_floats: scales the values of 'a' to
+  the range [target_min, target_max] while keeping their relative 
+  proportions. 
+
+  INPUT: 
+    a: 1-D NumPy array of floats. 
+    target_min: Integer or float. The minimum of the target range. 
+    target_max: Integer or float. The maximum of the target range. 
+  OUTPUT: 
+    A new array with the normalized values. 
+  """
+  min_val = a.min()
+  max_val = a.max()
+  range_val = max_val - min_val
+
+  if range_val == 0: 
+    return np.full(len(a), (target_max - target_min)/2)
+  return (a - min_val) * (target_max - target_min) / range_val + target_min
+
+
+def top_highest_x_idx(a, x): 
+  """
+  Array counterpart of top_highest_x_values: returns the positions of the 'x'
+  highest values in 'a', highest first. Ties are broken by position, just like
+  the stable sort in top_highest_x_values. Only the candidates that can make
+  the cut are fully sorted. 
+
+  INPUT: 
+    a: 1-D NumPy array of floats. 
+    x: Integer. The number of positions to return. 
+  OUTPUT: 
+    A 1-D array of at most 'x' positions into 'a'. 
+  """
+  if x <= 0: 
+    return np.zeros(0, dtype=np.int64)
+  if x < len(a): 
+    kth_val = np.partition(a, len(a) - x)[len(a) - x]
+    cand = np.flatnonzero(a >= kth_val)
+  else: 
+    cand = np.arange(len(a))
+  return cand[np.argsort(-a[cand], kind="stable")][:x]
+
+
 def extract_recency(persona, nodes):
   """
   Gets the current Persona object and a list of nodes that are in a 
@@ -196,12 +243,18 @@ def extract_relevance(persona, nodes, focal_pt):
   return relevance_out
 
 
+@profiled("operation", "new_retrieve")
 def new_retrieve(persona, focal_points, n_count=30): 
   """
   Given the current persona and focal points (focal points are events or 
   thoughts for which we are retrieving), we retrieve a set of nodes for each
   of the focal points and return a dictionary. 
 
+  The scoring is the same as running extract_recency, extract_importance and
+  extract_relevance over the persona's events and thoughts, but it operates 
+  on the arrays in persona.a_mem.index: relevance for all focal points comes
+  out of one matrix product, and only the top n_count candidates get sorted.
+
   INPUT: 
     persona: The current persona object whose memory we are retrieving. 
     focal_points: A list of focal points (string description of the events or
@@ -217,68 +270,52 @@ def new_retrieve(persona, focal_points, n_count=30):
   """
   # <retrieved> is the main dictionary that we are returning
   retrieved = dict() 
-  for focal_pt in focal_points: 
-    # Getting all nodes from the agent's memory (both thoughts and events) and
-    # sorting them by the datetime of creation.
-    # You could also imagine getting the raw conversation, but for now. 
-    nodes = [[i.last_accessed, i]
-              for i in persona.a_mem.seq_event + persona.a_mem.seq_thought
-              if "idle" not in i.embedding_key]
-    nodes = sorted(nodes, key=lambda x: x[0])
-    nodes = [i for created, i in nodes]
-
-    # Calculating the component dictionaries and normalizing them.
-    recency_out = extract_recency(persona, nodes)
-    recency_out = normalize_dict_floats(recency_out, 0, 1)
-    importance_out = extract_importance(persona, nodes)
-    importance_out = normalize_dict_floats(importance_out, 0, 1)  
-    relevance_out = extract_relevance(persona, nodes, focal_pt)
-    relevance_out = normalize_dict_floats(relevance_out, 0, 1)
+
+  # Getting all nodes from the agent's memory (both thoughts and events) that
+  # are not idle. You could also imagine getting the raw conversation, but 
+  # for now. 
+  a_mem = persona.a_mem
+  idx = a_mem.index.retrievable_idx()
+  if len(idx) == 0: 
+    for focal_pt in focal_points: 
+      retrieved[focal_pt] = []
+    return retrieved
+
+  # The importance and relevance of a node do not depend on when it was last
+  # accessed, so we compute them once for all focal points. 
+  importance = normalize_array_floats(a_mem.index.poignancy[idx], 0, 1)
+  focal_embeddings = get_embeddings(focal_points)
+  relevance = a_mem.index.cos_sim(idx, focal_embeddings)
+  recency = normalize_array_floats(
+              persona.scratch.recency_decay ** np.arange(1, len(idx) + 1), 
+              0, 1)
+  # <pos> maps a node position back into <idx>. 
+  pos = np.zeros(a_mem.index.size, dtype=np.int64)
+  pos[idx] = np.arange(len(idx))
+
+  # Note to self: test out different weights. [1, 1, 1] tends to work
+  # decently, but in the future, these weights should likely be learned, 
+  # perhaps through an RL-like process.
+  # gw = [1, 1, 1]
+  # gw = [1, 2, 1]
+  gw = [0.5, 3, 2]
+  for count, focal_pt in enumerate(focal_points): 
+    # Sorting the nodes by the datetime of their last access. This has to be
+    # redone for every focal point because retrieving touches the nodes. 
+    order = a_mem.index.recency_order(idx)
+    relevance_out = normalize_array_floats(relevance[:, count], 0, 1)
 
     # Computing the final scores that combines the component values. 
-    # Note to self: test out different weights. [1, 1, 1] tends to work
-    # decently, but in the future, these weights should likely be learned, 
-    # perhaps through an RL-like process.
-    # gw = [1, 1, 1]
-    # gw = [1, 2, 1]
-    gw = [0.5, 3, 2]
-    master_out = dict()
-    for key in recency_out.keys(): 
-      master_out[key] = (persona.scratch.recency_w*recency_out[key]*gw[0] 
-                     + persona.scratch.relevance_w*relevance_out[key]*gw[1] 
-                     + persona.scratch.importance_w*importance_out[key]*gw[2])
-
-    master_out = top_highest_x_values(master_out, len(master_out.keys()))
-    for key, val in master_out.items(): 
-      print (persona.a_mem.id_to_node[key].embedding_key, val)
-      print (persona.scratch.recency_w*recency_out[key]*1, 
-             persona.scratch.relevance_w*relevance_out[key]*1, 
-             persona.scratch.importance_w*importance_out[key]*1)
-
-    # Extracting the highest x values.
-    # <master_out> has the key of node.id and value of float. Once we get the 
-    # highest x values, we want to translate the node.id into nodes and return
-    # the list of nodes.
-    master_out = top_highest_x_values(master_out, n_count)
-    master_nodes = [persona.a_mem.id_to_node[key] 
-                    for key in list(master_out.keys())]
-
-    for n in master_nodes: 
-      n.last_accessed = persona.scratch.curr_time
+    master_out = (persona.scratch.recency_w*recency*gw[0] 
+                  + persona.scratch.relevance_w*relevance_out[pos[order]]*gw[1] 
+                  + persona.scratch.importance_w*importance[pos[order]]*gw[2])
+
+    # Extracting the highest x values and translating them into nodes. 
+    top = order[top_highest_x_idx(master_out, n_count)]
+    master_nodes = [a_mem.nodes[i] for i in top]
+
+    a_mem.touch_nodes(master_nodes, persona.scratch.curr_time)
       
     retrieved[focal_pt] = master_nodes
 
   return retrieved
-
-
-
-
-
-
-
-
-
-
-
-
-
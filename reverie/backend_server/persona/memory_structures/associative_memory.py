@@ -12,9 +12,68 @@ sys.path.append('../../')
 
 import json
 import datetime
+import array
+import os
+import numpy as np
 
 from global_methods import *
 
+# Embeddings are kept in single precision; the full double-precision vectors
+# returned by the embedding APIs cost twice the memory for no visible change
+# in retrieval. 
+EMBEDDING_DTYPE = np.float32
+
+# On-disk layout of a saved associative memory, format version 3: 
+#   format.json          -- {"format_version": 3, "n_nodes": .., "dim": .., 
+#                            "segments": [..]}
+#   embeddings.npy       -- EMBEDDING_DTYPE matrix, one row per embedding key
+#   embedding_norms.npy  -- float64 L2 norm of every row in embeddings.npy
+#   embedding_keys.json  -- the embedding key of every row in embeddings.npy
+#   nodes.npz            -- numeric node columns, one entry per node
+#   nodes_text.json      -- text and list node columns, one entry per node
+#   kw_strength.json     -- same as in the JSON layout
+#   segment_<n>.npz/json -- nodes and embeddings added by an incremental save
+#                           (see AssociativeMemory.save_segment), replayed in
+#                           the order listed in format.json
+# Version 2 is the same without segments. The original layout (version 1) is
+# nodes.json, embeddings.json and kw_strength.json. Loading understands all 
+# of them; saving writes version 3. 
+AMEM_FORMAT_VERSION = 3
+NODE_TYPES = ["event", "thought", "chat"]
+NODE_TEXT_COLUMNS = ["subject", "predicate", "object", "description", 
+                     "keywords", "filling"]
+LEGACY_AMEM_FILES = ["nodes.json", "embeddings.json"]
+# An incremental save turns into a full save (which folds all segments back
+# into the base files) once this many segments have piled up. 
+AMEM_MAX_SEGMENTS = 16
+
+
+def write_file_atomic(path, write_fn, mode="w"): 
+  """
+  Writes a file through a temporary file and a rename, so that readers (and 
+  memory maps of the previous version of the file) never see a half-written
+  file. 
+
+  INPUT: 
+    path: The final path of the file. 
+    write_fn: A function that takes the open file object and writes to it. 
+    mode: "w" for text files, "wb" for binary files. 
+  OUTPUT: 
+    None
+  """
+  tmp_path = f"{path}.tmp"
+  with open(tmp_path, mode) as outfile: 
+    write_fn(outfile)
+  os.replace(tmp_path, path)
+
+
+def datetime_to_seconds(dt): 
+  return (dt - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+def seconds_to_datetime(seconds): 
+  return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=seconds)
+
 
 class ConceptNode: 
   def __init__(self,
@@ -47,13 +106,328 @@ class ConceptNode:
     return (self.subject, self.predicate, self.object)
 
 
+class MemoryIndex: 
+  """
+  Dense NumPy arrays that mirror the memory stream so that retrieval can score
+  every node at once instead of walking <ConceptNode> objects in Python. 
+
+  Position i of the per-node arrays belongs to the node whose node_count is 
+  i+1. Embeddings are stored once per embedding key (the same key maps to the 
+  same vector in <AssociativeMemory.embeddings>), and <node_row> points each
+  node at its row in <matrix>. All arrays grow by doubling so appends are 
+  amortized O(1). <matrix> is the only copy of the embeddings; 
+  <AssociativeMemory.embeddings> is a view onto it. 
+  """
+  def __init__(self): 
+    # <size> is the number of nodes, <n_rows> the number of unique embedding
+    # keys currently stored in <matrix>. 
+    self.size = 0
+    self.n_rows = 0
+
+    self.poignancy = np.zeros(64)
+    # Seconds since the epoch; see <datetime_to_seconds>. 
+    self.last_accessed = np.zeros(64)
+    # Only events and thoughts whose embedding key is not an "idle" 
+    # description take part in <new_retrieve>. 
+    self.retrievable = np.zeros(64, dtype=bool)
+    self.is_thought = np.zeros(64, dtype=bool)
+    self.node_row = np.zeros(64, dtype=np.int64)
+
+    self.key_to_row = dict()
+    self.matrix = None
+    self.row_norms = None
+    # Rows that were overwritten (rather than appended) since the last save. 
+    self.dirty_rows = set()
+
+
+  def load_embeddings(self, keys, matrix, row_norms): 
+    """
+    Adopts saved embeddings as-is. <matrix> may be a read-only memory map; it 
+    is only copied into memory once something needs to write to it. 
+    """
+    self.key_to_row = {key: row for row, key in enumerate(keys)}
+    self.n_rows = len(keys)
+    self.matrix = matrix
+    self.row_norms = np.array(row_norms, dtype=np.float64)
+
+
+  def row_keys(self): 
+    """
+    Returns the embedding key of every row in <matrix>, in row order. 
+    """
+    keys = [None] * self.n_rows
+    for key, row in self.key_to_row.items(): 
+      keys[row] = key
+    return keys
+
+
+  def _grow_nodes(self): 
+    capacity = 2 * len(self.poignancy)
+    for attr in ["poignancy", "last_accessed", "retrievable", "is_thought", 
+                 "node_row"]: 
+      old = getattr(self, attr)
+      new = np.zeros(capacity, dtype=old.dtype)
+      new[:self.size] = old[:self.size]
+      setattr(self, attr, new)
+
+
+  def set_embedding(self, embedding_key, embedding): 
+    """
+    Stores (or overwrites) the vector for <embedding_key> and returns its row
+    in <matrix>. 
+    """
+    vec = np.asarray(embedding, dtype=EMBEDDING_DTYPE)
+    if self.matrix is None: 
+      self.matrix = np.zeros((64, len(vec)), dtype=EMBEDDING_DTYPE)
+      self.row_norms = np.zeros(64)
+    elif vec.shape != (self.matrix.shape[1],): 
+      raise ValueError(f"Embedding for '{embedding_key}' has dimension "
+                       f"{vec.shape}, expected {self.matrix.shape[1]}.")
+
+    row = self.key_to_row.get(embedding_key)
+    if row is None: 
+      row = self.n_rows
+      if row == len(self.matrix): 
+        capacity = max(64, 2 * len(self.matrix))
+        matrix = np.zeros((capacity, self.matrix.shape[1]), 
+                          dtype=EMBEDDING_DTYPE)
+        matrix[:row] = self.matrix[:row]
+        self.matrix = matrix
+        row_norms = np.zeros(capacity)
+        row_norms[:row] = self.row_norms[:row]
+        self.row_norms = row_norms
+      self.key_to_row[embedding_key] = row
+      self.n_rows += 1
+    else: 
+      self.dirty_rows.add(row)
+      if not self.matrix.flags.writeable: 
+        # Overwriting a row of a memory-mapped matrix loaded from disk. 
+        self.matrix = np.array(self.matrix)
+
+    self.matrix[row] = vec
+    self.row_norms[row] = np.linalg.norm(vec.astype(np.float64))
+    return row
+
+
+  def add_node(self, node, embedding): 
+    """
+    Appends <node>. If <embedding> is None, the node reuses the vector that is 
+    already stored for its embedding key. 
+    """
+    if self.size == len(self.poignancy): 
+      self._grow_nodes()
+    i = self.size
+    if embedding is None: 
+      self.node_row[i] = self.key_to_row[node.embedding_key]
+    else: 
+      self.node_row[i] = self.set_embedding(node.embedding_key, embedding)
+    self.poignancy[i] = node.poignancy
+    self.last_accessed[i] = datetime_to_seconds(node.last_accessed)
+    self.retrievable[i] = (node.type in ["event", "thought"] 
+                           and "idle" not in node.embedding_key)
+    self.is_thought[i] = node.type == "thought"
+    self.size += 1
+
+
+  def touch(self, idx, curr_time): 
+    """
+    Marks the nodes at positions <idx> as accessed at <curr_time>. 
+    """
+    self.last_accessed[idx] = datetime_to_seconds(curr_time)
+
+
+  def retrievable_idx(self): 
+    return np.flatnonzero(self.retrievable[:self.size])
+
+
+  def recency_order(self, idx): 
+    """
+    Orders the node positions <idx> by last access, oldest first. Ties keep 
+    the order of <seq_event> + <seq_thought> (events before thoughts, newest
+    first within each), which is what sorting that concatenated list did. 
+    """
+    return idx[np.lexsort((-idx, 
+                           self.is_thought[idx], 
+                           self.last_accessed[idx]))]
+
+
+  def cos_sim(self, idx, focal_embeddings): 
+    """
+    Cosine similarity between the nodes at positions <idx> and each of the 
+    focal embeddings, computed as a single matrix product over the unique 
+    embedding rows. Returns an array of shape (len(idx), len(focal)). 
+    """
+    focal = np.asarray(focal_embeddings, dtype=EMBEDDING_DTYPE)
+    rows = self.matrix[:self.n_rows]
+    sims = ((rows @ focal.T) 
+            / (self.row_norms[:self.n_rows, None] 
+               * np.linalg.norm(focal.astype(np.float64), axis=1)[None, :]))
+    return sims[self.node_row[idx]]
+
+
+class NodeSeq: 
+  """
+  A newest-first, read-only view over part of the memory stream (e.g., all 
+  events, or all thoughts with a given keyword). 
+
+  It only stores the positions of its nodes in <AssociativeMemory.nodes>, in
+  insertion order, so adding a node is an amortized O(1) append rather than 
+  a prepend to a Python list. Indexing, slicing, iteration and concatenation
+  behave like the newest-first lists they replace. 
+  """
+  def __init__(self, nodes): 
+    self.nodes = nodes
+    self.idx = array.array("q")
+
+
+  def append(self, position): 
+    self.idx.append(position)
+
+
+  def __len__(self): 
+    return len(self.idx)
+
+
+  def __getitem__(self, key): 
+    n = len(self.idx)
+    if isinstance(key, slice): 
+      return [self.nodes[self.idx[n - 1 - i]] 
+              for i in range(*key.indices(n))]
+    if key < 0: 
+      key += n
+    if key < 0 or key >= n: 
+      raise IndexError("NodeSeq index out of range")
+    return self.nodes[self.idx[n - 1 - key]]
+
+
+  def __iter__(self): 
+    for position in reversed(self.idx): 
+      yield self.nodes[position]
+
+
+  def __add__(self, other): 
+    return list(self) + list(other)
+
+
+  def __radd__(self, other): 
+    return list(other) + list(self)
+
+
+  def __eq__(self, other): 
+    return list(self) == list(other)
+
+
+  def __repr__(self): 
+    return f"NodeSeq({list(self)!r})"
+
+
+class NodeIdMap: 
+  """
+  Read-only dict-like access to <AssociativeMemory.nodes> by string node id
+  (e.g., "node_12"). Node ids are just 1-based positions in the stream, so 
+  there is no need to keep a separate dictionary of them. 
+  """
+  def __init__(self, nodes): 
+    self.nodes = nodes
+
+
+  def _position(self, node_id): 
+    try: 
+      position = int(node_id[len("node_"):]) - 1
+    except (TypeError, ValueError): 
+      return None
+    if (not node_id.startswith("node_") 
+        or position < 0 or position >= len(self.nodes)): 
+      return None
+    return position
+
+
+  def __getitem__(self, node_id): 
+    position = self._position(node_id)
+    if position is None: 
+      raise KeyError(node_id)
+    return self.nodes[position]
+
+
+  def __contains__(self, node_id): 
+    return self._position(node_id) is not None
+
+
+  def get(self, node_id, default=None): 
+    position = self._position(node_id)
+    if position is None: 
+      return default
+    return self.nodes[position]
+
+
+  def __len__(self): 
+    return len(self.nodes)
+
+
+  def __iter__(self): 
+    return iter(self.keys())
+
+
+  def keys(self): 
+    return [node.node_id for node in self.nodes]
+
+
+  def values(self): 
+    return list(self.nodes)
+
+
+  def items(self): 
+    return [(node.node_id, node) for node in self.nodes]
+
+
+class EmbeddingTable: 
+  """
+  Dict-like access to the embedding vectors stored in <MemoryIndex.matrix>, 
+  keyed by embedding key (the text that was embedded). 
+  """
+  def __init__(self, index): 
+    self.index = index
+
+
+  def __contains__(self, key): 
+    return key in self.index.key_to_row
+
+
+  def __getitem__(self, key): 
+    return self.index.matrix[self.index.key_to_row[key]].copy()
+
+
+  def __setitem__(self, key, embedding): 
+    self.index.set_embedding(key, embedding)
+
+
+  def __len__(self): 
+    return len(self.index.key_to_row)
+
+
+  def __iter__(self): 
+    return iter(self.index.key_to_row)
+
+
+  def keys(self): 
+    return self.index.key_to_row.keys()
+
+
+  def items(self): 
+    for key, row in self.index.key_to_row.items(): 
+      yield key, self.index.matrix[row]
+
+
 class AssociativeMemory: 
   def __init__(self, f_saved): 
-    self.id_to_node = dict()
+    # <nodes> is the memory stream in insertion order; node_{i} lives at 
+    # nodes[i-1]. Everything below is a view or an index onto it. 
+    self.nodes = []
+    self.id_to_node = NodeIdMap(self.nodes)
 
-    self.seq_event = []
-    self.seq_thought = []
-    self.seq_chat = []
+    self.seq_event = NodeSeq(self.nodes)
+    self.seq_thought = NodeSeq(self.nodes)
+    self.seq_chat = NodeSeq(self.nodes)
 
     self.kw_to_event = dict()
     self.kw_to_thought = dict()
@@ -62,18 +436,55 @@ class AssociativeMemory:
     self.kw_strength_event = dict()
     self.kw_strength_thought = dict()
 
-    self.embeddings = json.load(open(f_saved + "/embeddings.json"))
+    # <index> holds the array form of the memory stream used by 
+    # <new_retrieve>. It is kept in sync by the add_* functions below. 
+    self.index = MemoryIndex()
+
+    self.embeddings = EmbeddingTable(self.index)
+    # <checkpoint> describes what is already on disk in the folder we loaded
+    # from or last saved to, so that an incremental save only has to write 
+    # what was added since. It is None when that folder is not in the 
+    # binary layout. 
+    self.checkpoint = None
+    if check_if_file_exists(f_saved + "/format.json"): 
+      self.load_binary(f_saved)
+    else: 
+      self.load_json(f_saved)
+
+    kw_strength_load = json.load(open(f_saved + "/kw_strength.json"))
+    if kw_strength_load["kw_strength_event"]: 
+      self.kw_strength_event = kw_strength_load["kw_strength_event"]
+    if kw_strength_load["kw_strength_thought"]: 
+      self.kw_strength_thought = kw_strength_load["kw_strength_thought"]
+
+
+  def add_node(self, node_type, created, expiration, s, p, o, 
+               description, keywords, poignancy, embedding_pair, filling): 
+    if node_type == "event": 
+      return self.add_event(created, expiration, s, p, o, 
+                 description, keywords, poignancy, embedding_pair, filling)
+    elif node_type == "chat": 
+      return self.add_chat(created, expiration, s, p, o, 
+                 description, keywords, poignancy, embedding_pair, filling)
+    elif node_type == "thought": 
+      return self.add_thought(created, expiration, s, p, o, 
+                 description, keywords, poignancy, embedding_pair, filling)
+
+
+  def load_json(self, f_saved): 
+    """
+    Loads the original (format version 1) nodes.json/embeddings.json layout.
+    """
+    embeddings_load = json.load(open(f_saved + "/embeddings.json"))
+    for key, embedding in embeddings_load.items(): 
+      self.embeddings[key] = embedding
+    del embeddings_load
 
     nodes_load = json.load(open(f_saved + "/nodes.json"))
     for count in range(len(nodes_load.keys())): 
       node_id = f"node_{str(count+1)}"
       node_details = nodes_load[node_id]
 
-      node_count = node_details["node_count"]
-      type_count = node_details["type_count"]
-      node_type = node_details["type"]
-      depth = node_details["depth"]
-
       created = datetime.datetime.strptime(node_details["created"], 
                                            '%Y-%m-%d %H:%M:%S')
       expiration = None
@@ -81,80 +492,250 @@ class AssociativeMemory:
         expiration = datetime.datetime.strptime(node_details["expiration"],
                                                 '%Y-%m-%d %H:%M:%S')
 
-      s = node_details["subject"]
-      p = node_details["predicate"]
-      o = node_details["object"]
-
-      description = node_details["description"]
-      embedding_pair = (node_details["embedding_key"], 
-                        self.embeddings[node_details["embedding_key"]])
-      poignancy =node_details["poignancy"]
-      keywords = set(node_details["keywords"])
-      filling = node_details["filling"]
-      
-      if node_type == "event": 
-        self.add_event(created, expiration, s, p, o, 
-                   description, keywords, poignancy, embedding_pair, filling)
-      elif node_type == "chat": 
-        self.add_chat(created, expiration, s, p, o, 
-                   description, keywords, poignancy, embedding_pair, filling)
-      elif node_type == "thought": 
-        self.add_thought(created, expiration, s, p, o, 
-                   description, keywords, poignancy, embedding_pair, filling)
-
-    kw_strength_load = json.load(open(f_saved + "/kw_strength.json"))
-    if kw_strength_load["kw_strength_event"]: 
-      self.kw_strength_event = kw_strength_load["kw_strength_event"]
-    if kw_strength_load["kw_strength_thought"]: 
-      self.kw_strength_thought = kw_strength_load["kw_strength_thought"]
+      # The embedding is already in the index, so we only pass its key. 
+      embedding_pair = (node_details["embedding_key"], None)
+      self.add_node(node_details["type"], created, expiration, 
+                    node_details["subject"], node_details["predicate"], 
+                    node_details["object"], node_details["description"], 
+                    set(node_details["keywords"]), node_details["poignancy"], 
+                    embedding_pair, node_details["filling"])
+
+
+  def load_node_columns(self, cols, text_cols, keys, first_node=0): 
+    """
+    Adds the nodes of a node table (the base files or a segment). Nodes that
+    are already loaded -- positions below len(self.nodes) -- are skipped, so
+    replaying a segment that was already folded into the base is harmless. 
+    """
+    for i in range(max(0, len(self.nodes) - first_node), 
+                   len(cols["node_type"])): 
+      created = seconds_to_datetime(float(cols["created"][i]))
+      expiration = None
+      if not np.isnan(cols["expiration"][i]): 
+        expiration = seconds_to_datetime(float(cols["expiration"][i]))
+
+      poignancy = float(cols["poignancy"][i])
+      if poignancy.is_integer(): 
+        poignancy = int(poignancy)
+
+      embedding_pair = (keys[cols["embedding_row"][i]], None)
+      self.add_node(NODE_TYPES[cols["node_type"][i]], created, expiration, 
+                    text_cols["subject"][i], text_cols["predicate"][i], 
+                    text_cols["object"][i], text_cols["description"][i], 
+                    set(text_cols["keywords"][i]), poignancy, 
+                    embedding_pair, text_cols["filling"][i])
+
+
+  def load_binary(self, f_saved): 
+    """
+    Loads the binary (format version 2 or 3) layout. The embedding matrix is
+    memory-mapped rather than read, the node table is read column by column,
+    and then any incremental segments are replayed on top. 
+    """
+    with open(f_saved + "/format.json") as json_file: 
+      meta = json.load(json_file)
+    if meta["format_version"] > AMEM_FORMAT_VERSION: 
+      raise ValueError(f"{f_saved} uses associative memory format version "
+                       f"{meta['format_version']}; this code only reads up "
+                       f"to version {AMEM_FORMAT_VERSION}.")
+
+    with open(f_saved + "/embedding_keys.json") as json_file: 
+      keys = json.load(json_file)
+    if keys: 
+      matrix = np.load(f_saved + "/embeddings.npy", mmap_mode="r")
+      row_norms = np.load(f_saved + "/embedding_norms.npy")
+      self.index.load_embeddings(keys, matrix, row_norms)
+
+    with np.load(f_saved + "/nodes.npz") as nodes_load: 
+      cols = {name: nodes_load[name] for name in nodes_load.files}
+    with open(f_saved + "/nodes_text.json") as json_file: 
+      text_cols = json.load(json_file)
+    self.load_node_columns(cols, text_cols, keys)
+
+    segments = meta.get("segments", [])
+    for segment in segments: 
+      with np.load(f"{f_saved}/{segment}.npz") as segment_load: 
+        cols = {name: segment_load[name] for name in segment_load.files}
+      with open(f"{f_saved}/{segment}.json") as json_file: 
+        text_cols = json.load(json_file)
+
+      for key, embedding in zip(text_cols["new_keys"], 
+                                cols["new_embeddings"]): 
+        self.embeddings[key] = embedding
+      keys = self.index.row_keys()
+      for row, embedding in zip(cols["updated_rows"], 
+                                cols["updated_embeddings"]): 
+        self.embeddings[keys[row]] = embedding
+      self.load_node_columns(cols, text_cols, keys, text_cols["first_node"])
+
+    self.index.dirty_rows = set()
+    self.checkpoint = {"folder": os.path.realpath(f_saved), 
+                       "n_nodes": len(self.nodes), 
+                       "n_rows": self.index.n_rows, 
+                       "segments": segments, 
+                       "meta": meta}
+
+
+  def node_columns(self, start=0): 
+    """
+    Returns the numeric and the text columns of the node table for the nodes
+    from position <start> on. 
+    """
+    nodes = self.nodes[start:]
+    cols = dict()
+    cols["node_type"] = np.array([NODE_TYPES.index(node.type) 
+                                  for node in nodes], dtype=np.int8)
+    cols["depth"] = np.array([node.depth for node in nodes], dtype=np.int32)
+    cols["created"] = np.array([datetime_to_seconds(node.created) 
+                                for node in nodes], dtype=np.float64)
+    cols["expiration"] = np.array([datetime_to_seconds(node.expiration) 
+                                   if node.expiration else np.nan
+                                   for node in nodes], dtype=np.float64)
+    cols["poignancy"] = np.array([node.poignancy for node in nodes], 
+                                 dtype=np.float64)
+    cols["embedding_row"] = self.index.node_row[start:len(self.nodes)].copy()
+
+    text_cols = {name: [] for name in NODE_TEXT_COLUMNS}
+    for node in nodes: 
+      text_cols["subject"] += [node.subject]
+      text_cols["predicate"] += [node.predicate]
+      text_cols["object"] += [node.object]
+      text_cols["description"] += [node.description]
+      text_cols["keywords"] += [list(node.keywords)]
+      text_cols["filling"] += [node.filling]
+    return cols, text_cols
+
+
+  def save(self, out_json, incremental=False): 
+    """
+    Saves the memory to the <out_json> folder in the binary layout described 
+    at the top of this file. 
+
+    With <incremental>, and if <out_json> is the folder this memory was 
+    loaded from or last saved to, only what changed since then is written, as
+    a new segment. Otherwise (or once there are AMEM_MAX_SEGMENTS segments)
+    the whole memory is written and the segments are folded in. 
+    """
+    if (incremental and self.checkpoint 
+        and self.checkpoint["folder"] == os.path.realpath(out_json)
+        and len(self.checkpoint["segments"]) < AMEM_MAX_SEGMENTS): 
+      self.save_segment(out_json)
+    else: 
+      self.save_full(out_json)
 
-    
-  def save(self, out_json): 
-    r = dict()
-    for count in range(len(self.id_to_node.keys()), 0, -1): 
-      node_id = f"node_{str(count)}"
-      node = self.id_to_node[node_id]
-
-      r[node_id] = dict()
-      r[node_id]["node_count"] = node.node_count
-      r[node_id]["type_count"] = node.type_count
-      r[node_id]["type"] = node.type
-      r[node_id]["depth"] = node.depth
-
-      r[node_id]["created"] = node.created.strftime('%Y-%m-%d %H:%M:%S')
-      r[node_id]["expiration"] = None
-      if node.expiration: 
-        r[node_id]["expiration"] = (node.expiration
-                                        .strftime('%Y-%m-%d %H:%M:%S'))
-
-      r[node_id]["subject"] = node.subject
-      r[node_id]["predicate"] = node.predicate
-      r[node_id]["object"] = node.object
-
-      r[node_id]["description"] = node.description
-      r[node_id]["embedding_key"] = node.embedding_key
-      r[node_id]["poignancy"] = node.poignancy
-      r[node_id]["keywords"] = list(node.keywords)
-      r[node_id]["filling"] = node.filling
-
-    with open(out_json+"/nodes.json", "w") as outfile:
-      json.dump(r, outfile)
 
+  def write_kw_strength(self, out_json): 
     r = dict()
     r["kw_strength_event"] = self.kw_strength_event
     r["kw_strength_thought"] = self.kw_strength_thought
-    with open(out_json+"/kw_strength.json", "w") as outfile:
-      json.dump(r, outfile)
-
-    with open(out_json+"/embeddings.json", "w") as outfile:
-      json.dump(self.embeddings, outfile)
+    write_file_atomic(out_json + "/kw_strength.json", 
+                      lambda f: json.dump(r, f))
+
+
+  def save_full(self, out_json): 
+    """
+    Writes the whole memory as base files, and removes any segments and any
+    version 1 files left in the folder. 
+    """
+    cols, text_cols = self.node_columns()
+    meta = {"format_version": AMEM_FORMAT_VERSION, 
+            "n_nodes": len(self.nodes), 
+            "n_embeddings": self.index.n_rows, 
+            "segments": []}
+    if self.index.matrix is not None: 
+      meta["dim"] = self.index.matrix.shape[1]
+      write_file_atomic(out_json + "/embeddings.npy", 
+        lambda f: np.save(f, self.index.matrix[:self.index.n_rows]), "wb")
+      write_file_atomic(out_json + "/embedding_norms.npy", 
+        lambda f: np.save(f, self.index.row_norms[:self.index.n_rows]), "wb")
+    write_file_atomic(out_json + "/embedding_keys.json", 
+                      lambda f: json.dump(self.index.row_keys(), f))
+    write_file_atomic(out_json + "/nodes.npz", 
+                      lambda f: np.savez(f, **cols), "wb")
+    write_file_atomic(out_json + "/nodes_text.json", 
+                      lambda f: json.dump(text_cols, f))
+    self.write_kw_strength(out_json)
+
+    # format.json goes last: it is what marks the folder as being in the 
+    # binary layout, and it stops listing the old segments only once the 
+    # base files above already contain them. 
+    write_file_atomic(out_json + "/format.json", 
+                      lambda f: json.dump(meta, f))
+    old_segments = []
+    if (self.checkpoint 
+        and self.checkpoint["folder"] == os.path.realpath(out_json)): 
+      old_segments = self.checkpoint["segments"]
+    for segment in old_segments: 
+      for ext in [".npz", ".json"]: 
+        if check_if_file_exists(f"{out_json}/{segment}{ext}"): 
+          os.remove(f"{out_json}/{segment}{ext}")
+    for legacy_file in LEGACY_AMEM_FILES: 
+      if check_if_file_exists(f"{out_json}/{legacy_file}"): 
+        os.remove(f"{out_json}/{legacy_file}")
+
+    self.index.dirty_rows = set()
+    self.checkpoint = {"folder": os.path.realpath(out_json), 
+                       "n_nodes": len(self.nodes), 
+                       "n_rows": self.index.n_rows, 
+                       "segments": [], 
+                       "meta": meta}
+
+
+  def save_segment(self, out_json): 
+    """
+    Appends a segment with the nodes and embeddings added since the last 
+    checkpoint (plus any embedding rows that were overwritten), then lists 
+    it in format.json. Nothing written earlier is touched. 
+    """
+    checkpoint = self.checkpoint
+    first_node = checkpoint["n_nodes"]
+    first_row = checkpoint["n_rows"]
+    n_rows = self.index.n_rows
+    updated_rows = sorted(i for i in self.index.dirty_rows if i < first_row)
+    if (first_node == len(self.nodes) and first_row == n_rows 
+        and not updated_rows): 
+      self.write_kw_strength(out_json)
+      return
+
+    cols, text_cols = self.node_columns(first_node)
+    keys = self.index.row_keys()
+    text_cols["first_node"] = first_node
+    text_cols["new_keys"] = keys[first_row:n_rows]
+    if self.index.matrix is not None: 
+      cols["new_embeddings"] = self.index.matrix[first_row:n_rows]
+      cols["updated_embeddings"] = self.index.matrix[updated_rows]
+    cols["updated_rows"] = np.array(updated_rows, dtype=np.int64)
+
+    segment = f"segment_{len(checkpoint['segments']) + 1:05d}"
+    write_file_atomic(f"{out_json}/{segment}.npz", 
+                      lambda f: np.savez(f, **cols), "wb")
+    write_file_atomic(f"{out_json}/{segment}.json", 
+                      lambda f: json.dump(text_cols, f))
+    self.write_kw_strength(out_json)
+
+    meta = dict(checkpoint["meta"])
+    meta["format_version"] = AMEM_FORMAT_VERSION
+    meta["n_nodes"] = len(self.nodes)
+    meta["n_embeddings"] = n_rows
+    meta["segments"] = checkpoint["segments"] + [segment]
+    if self.index.matrix is not None: 
+      meta["dim"] = self.index.matrix.shape[1]
+    write_file_atomic(out_json + "/format.json", 
+                      lambda f: json.dump(meta, f))
+
+    self.index.dirty_rows = set()
+    self.checkpoint = {"folder": checkpoint["folder"], 
+                       "n_nodes": len(self.nodes), 
+                       "n_rows": n_rows, 
+                       "segments": meta["segments"], 
+                       "meta": meta}
 
 
   def add_event(self, created, expiration, s, p, o, 
                       description, keywords, poignancy, 
                       embedding_pair, filling):
     # Setting up the node ID and counts.
-    node_count = len(self.id_to_node.keys()) + 1
+    node_count = len(self.nodes) + 1
     type_count = len(self.seq_event) + 1
     node_type = "event"
     node_id = f"node_{str(node_count)}"
@@ -174,14 +755,13 @@ class AssociativeMemory:
                        poignancy, keywords, filling)
 
     # Creating various dictionary cache for fast access. 
-    self.seq_event[0:0] = [node]
+    self.nodes.append(node)
+    self.seq_event.append(node_count - 1)
     keywords = [i.lower() for i in keywords]
     for kw in keywords: 
-      if kw in self.kw_to_event: 
-        self.kw_to_event[kw][0:0] = [node]
-      else: 
-        self.kw_to_event[kw] = [node]
-    self.id_to_node[node_id] = node 
+      if kw not in self.kw_to_event: 
+        self.kw_to_event[kw] = NodeSeq(self.nodes)
+      self.kw_to_event[kw].append(node_count - 1)
 
     # Adding in the kw_strength
     if f"{p} {o}" != "is idle":  
@@ -191,7 +771,7 @@ class AssociativeMemory:
         else: 
           self.kw_strength_event[kw] = 1
 
-    self.embeddings[embedding_pair[0]] = embedding_pair[1]
+    self.index.add_node(node, embedding_pair[1])
 
     return node
 
@@ -200,7 +780,7 @@ class AssociativeMemory:
                         description, keywords, poignancy, 
                         embedding_pair, filling):
     # Setting up the node ID and counts.
-    node_count = len(self.id_to_node.keys()) + 1
+    node_count = len(self.nodes) + 1
     type_count = len(self.seq_thought) + 1
     node_type = "thought"
     node_id = f"node_{str(node_count)}"
@@ -218,14 +798,13 @@ class AssociativeMemory:
                        description, embedding_pair[0], poignancy, keywords, filling)
 
     # Creating various dictionary cache for fast access. 
-    self.seq_thought[0:0] = [node]
+    self.nodes.append(node)
+    self.seq_thought.append(node_count - 1)
     keywords = [i.lower() for i in keywords]
     for kw in keywords: 
-      if kw in self.kw_to_thought: 
-        self.kw_to_thought[kw][0:0] = [node]
-      else: 
-        self.kw_to_thought[kw] = [node]
-    self.id_to_node[node_id] = node 
+      if kw not in self.kw_to_thought: 
+        self.kw_to_thought[kw] = NodeSeq(self.nodes)
+      self.kw_to_thought[kw].append(node_count - 1)
 
     # Adding in the kw_strength
     if f"{p} {o}" != "is idle":  
@@ -235,7 +814,7 @@ class AssociativeMemory:
         else: 
           self.kw_strength_thought[kw] = 1
 
-    self.embeddings[embedding_pair[0]] = embedding_pair[1]
+    self.index.add_node(node, embedding_pair[1])
 
     return node
 
@@ -244,7 +823,7 @@ class AssociativeMemory:
                      description, keywords, poignancy, 
                      embedding_pair, filling): 
     # Setting up the node ID and counts.
-    node_count = len(self.id_to_node.keys()) + 1
+    node_count = len(self.nodes) + 1
     type_count = len(self.seq_chat) + 1
     node_type = "chat"
     node_id = f"node_{str(node_count)}"
@@ -257,20 +836,28 @@ class AssociativeMemory:
                        description, embedding_pair[0], poignancy, keywords, filling)
 
     # Creating various dictionary cache for fast access. 
-    self.seq_chat[0:0] = [node]
+    self.nodes.append(node)
+    self.seq_chat.append(node_count - 1)
     keywords = [i.lower() for i in keywords]
     for kw in keywords: 
-      if kw in self.kw_to_chat: 
-        self.kw_to_chat[kw][0:0] = [node]
-      else: 
-        self.kw_to_chat[kw] = [node]
-    self.id_to_node[node_id] = node 
+      if kw not in self.kw_to_chat: 
+        self.kw_to_chat[kw] = NodeSeq(self.nodes)
+      self.kw_to_chat[kw].append(node_count - 1)
 
-    self.embeddings[embedding_pair[0]] = embedding_pair[1]
+    self.index.add_node(node, embedding_pair[1])
         
     return node
 
 
+  def touch_nodes(self, nodes, curr_time): 
+    """
+    Updates the last accessed time of <nodes> (and its mirror in <index>). 
+    """
+    for node in nodes: 
+      node.last_accessed = curr_time
+    self.index.touch([node.node_count - 1 for node in nodes], curr_time)
+
+
   def get_summarized_latest_events(self, retention): 
     ret_set = set()
     for e_node in self.seq_event[:retention]: 
@@ -358,3 +945,20 @@ class AssociativeMemory:
 
 
 
+
+
+def convert_json_memory(f_saved): 
+  """
+  One-shot conversion of an associative memory folder from the original JSON
+  layout (nodes.json, embeddings.json) to the binary layout. Folders that are
+  already converted are left alone. 
+
+  INPUT: 
+    f_saved: Path to the associative_memory folder. 
+  OUTPUT: 
+    True if the folder was converted, False otherwise. 
+  """
+  if check_if_file_exists(f_saved + "/format.json"): 
+    return False
+  AssociativeMemory(f_saved).save(f_saved)
+  return True
@@ -158,6 +158,10 @@ class Scratch:
     # e.g., [(50, 10), (49, 10), (48, 10), ...]
     self.planned_path = []
 
+    # <saved_json> is the (file, text) pair of the last save. Incremental 
+    # saves skip rewriting a scratch that has not changed since then. 
+    self.saved_json = None
+
     if check_if_file_exists(f_saved): 
       # If we have a bootstrap file, load that here. 
       scratch_load = json.load(open(f_saved))
@@ -234,12 +238,14 @@ class Scratch:
       self.planned_path = scratch_load["planned_path"]
 
 
-  def save(self, out_json):
+  def save(self, out_json, incremental=False):
     """
     Save persona's scratch. 
 
     INPUT: 
       out_json: The file where we wil be saving our persona's state. 
+      incremental: If True, the file is not rewritten when the scratch is 
+                   unchanged since the last save to the same file. 
     OUTPUT: 
       None
     """
@@ -302,8 +308,12 @@ class Scratch:
     scratch["act_path_set"] = self.act_path_set
     scratch["planned_path"] = self.planned_path
 
+    scratch_text = json.dumps(scratch, indent=2)
+    if incremental and self.saved_json == (out_json, scratch_text): 
+      return
     with open(out_json, "w") as outfile:
-      json.dump(scratch, outfile, indent=2) 
+      outfile.write(scratch_text)
+    self.saved_json = (out_json, scratch_text)
 
 
   def get_f_daily_schedule_index(self, advance=0):
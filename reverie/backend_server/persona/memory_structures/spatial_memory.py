@@ -15,6 +15,8 @@ from global_methods import *
 class MemoryTree: 
   def __init__(self, f_saved): 
     self.tree = {}
+    # (file, text) pair of the last save; see Scratch.saved_json. 
+    self.saved_json = None
     if check_if_file_exists(f_saved): 
       self.tree = json.load(open(f_saved))
 
@@ -35,9 +37,13 @@ class MemoryTree:
     _print_tree(self.tree, 0)
     
 
-  def save(self, out_json):
+  def save(self, out_json, incremental=False):
+    tree_text = json.dumps(self.tree)
+    if incremental and self.saved_json == (out_json, tree_text): 
+      return
     with open(out_json, "w") as outfile:
-      json.dump(self.tree, outfile) 
+      outfile.write(tree_text)
+    self.saved_json = (out_json, tree_text)
 
 
 
@@ -15,6 +15,7 @@ import random
 sys.path.append('../')
 
 from global_methods import *
+from profiler import PROFILER
 
 from persona.memory_structures.spatial_memory import *
 from persona.memory_structures.associative_memory import *
@@ -33,6 +34,11 @@ class Persona:
     # <name> is the full name of the persona. This is a unique identifier for
     # the persona within Reverie. 
     self.name = name
+    # <rng> is the persona's own random number generator. Every random choice
+    # the persona makes is drawn from it, so that its behavior does not 
+    # depend on the order in which the personas happen to run. The server 
+    # reseeds it at every step (see ReverieServer.seed_personas). 
+    self.rng = random.Random()
 
     # PERSONA MEMORY 
     # If there is already memory in folder_mem_saved, we load that. Otherwise,
@@ -48,12 +54,14 @@ class Persona:
     self.scratch = Scratch(scratch_saved)
 
 
-  def save(self, save_folder): 
+  def save(self, save_folder, incremental=False): 
     """
     Save persona's current state (i.e., memory). 
 
     INPUT: 
       save_folder: The folder where we wil be saving our persona's state. 
+      incremental: If True, only what changed since the last save to the 
+                   same folder is written. 
     OUTPUT: 
       None
     """
@@ -63,19 +71,19 @@ class Persona:
     #           {"bedroom 2": 
     #             ["painting", "easel", "closet", "bed"]}}}
     f_s_mem = f"{save_folder}/spatial_memory.json"
-    self.s_mem.save(f_s_mem)
+    self.s_mem.save(f_s_mem, incremental)
     
     # Associative memory contains a csv with the following rows: 
     # [event.type, event.created, event.expiration, s, p, o]
     # e.g., event,2022-10-23 00:00:00,,Isabella Rodriguez,is,idle
     f_a_mem = f"{save_folder}/associative_memory"
-    self.a_mem.save(f_a_mem)
+    self.a_mem.save(f_a_mem, incremental)
 
     # Scratch contains non-permanent data associated with the persona. When 
     # it is saved, it takes a json form. When we load it, we move the values
     # to Python variables. 
     f_scratch = f"{save_folder}/scratch.json"
-    self.scratch.save(f_scratch)
+    self.scratch.save(f_scratch, incremental)
 
 
   def perceive(self, maze):
@@ -201,6 +209,25 @@ class Persona:
         writing her next novel (editing her novel) 
         @ double studio:double studio:common room:sofa
     """
+    retrieved = self.prepare_move(maze, curr_tile, curr_time)
+    plan = self.react(maze, personas, retrieved)
+    return self.finish_move(maze, personas, plan)
+
+
+  def prepare_move(self, maze, curr_tile, curr_time): 
+    """
+    The first part of move(): perceiving, retrieving, and planning the 
+    persona's own next action. This only writes to the persona's own state, 
+    so it can run for several personas at once. 
+
+    INPUT: 
+      maze: The Maze class of the current world. 
+      curr_tile: A tuple that designates the persona's current tile location 
+                 in (row, col) form. e.g., (58, 39)
+      curr_time: datetime instance that indicates the game's current time. 
+    OUTPUT: 
+      retrieved: the retrieved memories that react() takes. 
+    """
     # Updating persona's scratch memory with <curr_tile>. 
     self.scratch.curr_tile = curr_tile
 
@@ -216,11 +243,49 @@ class Persona:
       new_day = "New day"
     self.scratch.curr_time = curr_time
 
-    # Main cognitive sequence begins here. 
-    perceived = self.perceive(maze)
-    retrieved = self.retrieve(perceived)
-    plan = self.plan(maze, personas, new_day, retrieved)
-    self.reflect()
+    # Main cognitive sequence begins here. Each phase is timed by the step
+    # profiler (see profiler.py). 
+    with PROFILER.timer("phase", "perceive", self.name): 
+      perceived = self.perceive(maze)
+    with PROFILER.timer("phase", "retrieve", self.name): 
+      retrieved = self.retrieve(perceived)
+    with PROFILER.timer("phase", "plan", self.name): 
+      plan_own_action(self, maze, new_day)
+    return retrieved
+
+
+  def react(self, maze, personas, retrieved): 
+    """
+    The second part of move(): reacting to the other personas. A chat writes
+    to both personas' scratch, so this runs for one persona at a time. 
+
+    INPUT: 
+      maze: The Maze class of the current world. 
+      personas: A dictionary that contains all persona names as keys, and the 
+                Persona instance as values. 
+      retrieved: What prepare_move() returned. 
+    OUTPUT: 
+      The target action address of the persona (persona.scratch.act_address).
+    """
+    with PROFILER.timer("phase", "react", self.name): 
+      return plan_reaction(self, maze, personas, retrieved)
+
+
+  def finish_move(self, maze, personas, plan): 
+    """
+    The last part of move(): reflecting and executing the plan. Like 
+    prepare_move(), it only writes to the persona's own state. 
+
+    INPUT: 
+      maze: The Maze class of the current world. 
+      personas: A dictionary that contains all persona names as keys, and the 
+                Persona instance as values. 
+      plan: What react() returned. 
+    OUTPUT: 
+      execution: See move(). 
+    """
+    with PROFILER.timer("phase", "reflect", self.name): 
+      self.reflect()
 
     # <execution> is a triple set that contains the following components: 
     # <next_tile> is a x,y coordinate. e.g., (58, 9)
@@ -228,7 +293,8 @@ class Persona:
     # <description> is a string description of the movement. e.g., 
     #   writing her next novel (editing her novel) 
     #   @ double studio:double studio:common room:sofa
-    return self.execute(maze, personas, plan)
+    with PROFILER.timer("phase", "execute", self.name): 
+      return self.execute(maze, personas, plan)
 
 
   def open_convo_session(self, convo_mode): 
@@ -0,0 +1,171 @@
+"""
+File: embedding_store.py
+Description: A process-wide, persistent store of text embeddings, shared by
+all personas. get_embedding in gpt_structure.py looks texts up here first, so
+a description is embedded once per model rather than once per persona, per
+retrieval or per run.
+
+Each model has three files in the store folder:
+  <slug>.json     -- {"model": .., "dim": ..}
+  <slug>.vectors  -- float32 rows of <dim> values, appended
+  <slug>.index    -- one 16-byte hash of the text per row, appended
+The index is read into a dictionary from text hash to row on open, and the
+vectors are memory-mapped. Appends are locked across processes, so several
+simulations can share the store.
+"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+EMBEDDING_STORE_DTYPE = np.float32
+TEXT_HASH_SIZE = 16
+
+
+def normalize_embedding_text(text):
+    """
+    The text that actually gets embedded for <text> (and so its key in the
+    store).
+    """
+    text = text.replace("\n", " ")
+    if not text:
+        text = "this is blank"
+    return text
+
+
+def text_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"),
+                           digest_size=TEXT_HASH_SIZE).digest()
+
+
+class ModelVectors:
+    """
+    The vectors of one model: the hash index and the memory-mapped vector
+    file.
+    """
+    def __init__(self, folder, model):
+        slug = hashlib.sha1(model.encode("utf-8")).hexdigest()[:16]
+        self.model = model
+        self.meta_path = f"{folder}/{slug}.json"
+        self.vectors_path = f"{folder}/{slug}.vectors"
+        self.index_path = f"{folder}/{slug}.index"
+        self.dim = None
+        self.rows = dict()
+        self.vectors = None
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as json_file:
+                self.dim = json.load(json_file)["dim"]
+            self.load_index()
+
+    def load_index(self):
+        """
+        Reads the rows that are complete in both files.
+        """
+        hashes = b""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as index_file:
+                hashes = index_file.read()
+        n_rows = min(len(hashes) // TEXT_HASH_SIZE, self.n_vector_rows())
+        for row in range(n_rows):
+            self.rows[hashes[row * TEXT_HASH_SIZE:
+                             (row + 1) * TEXT_HASH_SIZE]] = row
+        self.map_vectors()
+
+    def n_vector_rows(self):
+        if not os.path.exists(self.vectors_path):
+            return 0
+        row_size = self.dim * np.dtype(EMBEDDING_STORE_DTYPE).itemsize
+        return os.path.getsize(self.vectors_path) // row_size
+
+    def map_vectors(self):
+        self.vectors = None
+        n_rows = self.n_vector_rows()
+        if n_rows:
+            self.vectors = np.memmap(self.vectors_path,
+                                     dtype=EMBEDDING_STORE_DTYPE, mode="r",
+                                     shape=(n_rows, self.dim))
+
+    def get(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        if self.vectors is None or row >= self.vectors.shape[0]:
+            # The row was appended after the file was mapped.
+            self.map_vectors()
+        return np.array(self.vectors[row])
+
+    def put(self, key, vector):
+        vector = np.asarray(vector, dtype=EMBEDDING_STORE_DTYPE)
+        if self.dim is None:
+            self.dim = vector.shape[0]
+            with open(self.meta_path, "w") as json_file:
+                json.dump({"model": self.model, "dim": self.dim}, json_file)
+        if vector.shape != (self.dim,):
+            raise ValueError(f"embedding of size {vector.shape[0]} for a "
+                             f"model with size {self.dim}")
+
+        with open(self.index_path, "ab") as index_file:
+            if fcntl:
+                fcntl.flock(index_file, fcntl.LOCK_EX)
+            try:
+                # Another process may have appended since we last looked, so
+                # the row is wherever the end of the index file is now.
+                row = index_file.seek(0, os.SEEK_END) // TEXT_HASH_SIZE
+                with open(self.vectors_path, "ab") as vectors_file:
+                    vectors_file.truncate(row * vector.nbytes)
+                    vectors_file.write(vector.tobytes())
+                index_file.write(key)
+            finally:
+                if fcntl:
+                    fcntl.flock(index_file, fcntl.LOCK_UN)
+        self.rows[key] = row
+
+
+class EmbeddingStore:
+    """
+    Maps (model, normalized text) to an embedding vector.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.models = dict()
+        self.lock = threading.Lock()
+
+    def model_vectors(self, model):
+        if model not in self.models:
+            self.models[model] = ModelVectors(self.folder, model)
+        return self.models[model]
+
+    def get(self, text, model):
+        """
+        Returns the stored embedding of <text> under <model>, or None.
+        """
+        return self.get_many([text], model)[0]
+
+    def get_many(self, texts, model):
+        """
+        Returns the stored embeddings of <texts> under <model>, with None for
+        the texts that are not in the store.
+        """
+        with self.lock:
+            vectors = self.model_vectors(model)
+            return [vectors.get(text_hash(normalize_embedding_text(text)))
+                    for text in texts]
+
+    def put(self, text, model, vector):
+        """
+        Stores the embedding of <text> under <model>.
+        """
+        key = text_hash(normalize_embedding_text(text))
+        with self.lock:
+            vectors = self.model_vectors(model)
+            if key not in vectors.rows:
+                vectors.put(key, vector)
@@ -4,10 +4,10 @@ Author: Joon Sung Park (joonspk@stanford.edu)
 File: gpt_structure.py
 Description: Wrapper functions for calling OpenAI and Ollama APIs.
 """
+import asyncio
 import json
 import random
 import time
-import requests
 import sys
 import os
 import numpy as np
@@ -21,6 +21,13 @@ except ImportError:
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 from utils import *
+import utils
+from persona.prompt_template.llm_client import LLMClient
+from persona.prompt_template.llm_cache import LLMResponseCache, LLMCacheMiss
+from persona.prompt_template.embedding_store import (
+    EmbeddingStore, EMBEDDING_STORE_DTYPE, normalize_embedding_text)
+from persona.prompt_template.llm_trace import LLMTracer
+from profiler import profiled
 
 # Configuration
 USE_OLLAMA = use_ollama  # Use the setting from utils.py
@@ -29,60 +36,98 @@ OLLAMA_MODEL = ollama_model  # Use the model from utils.py
 if not USE_OLLAMA:
     openai.api_key = openai_api_key
 
-def temp_sleep(seconds=0.1):
-  time.sleep(seconds)
+# Optional connection settings in utils.py: the size of the HTTP connection
+# pool, and per-backend ("ollama"/"openai") limits on requests in flight and
+# on requests started per second.
+LLM_MAX_CONNECTIONS = getattr(utils, "llm_max_connections", 16)
+LLM_MAX_CONCURRENCY = getattr(utils, "llm_max_concurrency", {})
+LLM_RATE_LIMITS = getattr(utils, "llm_rate_limits", {})
+
+# All requests go through this client, which keeps the HTTP connections
+# open between requests. Each request function below has an awaitable
+# *_async variant, so that callers can fan out several requests at once
+# (see gather_requests).
+LLM_CLIENT = LLMClient(LLM_MAX_CONNECTIONS, LLM_MAX_CONCURRENCY,
+                       LLM_RATE_LIMITS)
+
+
+# Optional response cache settings in utils.py. Setting llm_cache_path to
+# None turns the cache off; in replay-only mode, a prompt that is not in the
+# cache raises LLMCacheMiss instead of reaching the LLM.
+LLM_CACHE_PATH = getattr(utils, "llm_cache_path",
+                         f"{os.path.dirname(fs_storage)}/llm_cache.sqlite3")
+LLM_CACHE_MAX_ENTRIES = getattr(utils, "llm_cache_max_entries", 1000000)
+LLM_CACHE_TTL = getattr(utils, "llm_cache_ttl", None)
+LLM_CACHE_REPLAY_ONLY = getattr(utils, "llm_cache_replay_only", False)
+
+LLM_CACHE = None
+if LLM_CACHE_PATH:
+    LLM_CACHE = LLMResponseCache(LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES,
+                                 LLM_CACHE_TTL, LLM_CACHE_REPLAY_ONLY)
+
+# Optional embedding store setting in utils.py; None turns the store off.
+EMBEDDING_STORE_PATH = getattr(
+    utils, "embedding_store_path",
+    f"{os.path.dirname(fs_storage)}/embedding_store")
+
+EMBEDDING_STORE = None
+if EMBEDDING_STORE_PATH:
+    EMBEDDING_STORE = EmbeddingStore(EMBEDDING_STORE_PATH)
+
+# Optional LLM trace setting in utils.py: a file to append a line to for
+# every attempt of every LLM call (see llm_trace.py); None leaves it off.
+LLM_TRACE_PATH = getattr(utils, "llm_trace_path", None)
+LLM_TRACER = LLMTracer(LLM_TRACE_PATH)
+
+# Responses that mean the request failed; these are never cached.
+LLM_ERROR_RESPONSES = {"Ollama Error", "ChatGPT ERROR", "GPT Error"}
+
+
+def gather_requests(coros):
+    """
+    Runs several *_async requests at the same time (within the configured
+    limits) and returns their results in the same order.
+    """
+    async def _gather():
+        return await asyncio.gather(*coros)
+    return LLM_CLIENT.call(_gather())
 
 def ollama_chat_request(prompt, model=None):
     """
     Make a request to Ollama API with proper streaming response handling
     """
+    return LLM_CLIENT.call(_ollama_chat(prompt, model))
+
+async def ollama_chat_request_async(prompt, model=None):
+    return await LLM_CLIENT.acall(_ollama_chat(prompt, model))
+
+async def _ollama_chat(prompt, model=None):
     # Use the model from utils.py if not specified
     if model is None:
         model = OLLAMA_MODEL
     try:
-        response = requests.post(
-            f"{OLLAMA_BASE_URL}/api/chat",
-            json={
-                "model": model,
-                "messages": [{"role": "user", "content": prompt}],
-                "stream": True
-            },
-            stream=True
-        )
-
-        if response.status_code != 200:
-            print(f"Ollama Error: {response.status_code}")
-            return "Ollama Error"
-
-        # Initialize an empty string to store the complete response
-        full_response = ""
-
-        # Process the streaming response
-        for line in response.iter_lines():
-            if line:
-                try:
-                    json_response = json.loads(line)
-                    if 'message' in json_response and 'content' in json_response['message']:
-                        content = json_response['message']['content']
-                        full_response += content
-                except json.JSONDecodeError:
-                    continue
-
-        return full_response.strip()
-
+        return await LLM_CLIENT.ollama_chat(OLLAMA_BASE_URL, model, prompt)
     except Exception as e:
         print(f"Ollama Error: {str(e)}")
         return "Ollama Error"
 
 def ChatGPT_single_request(prompt):
+    with LLM_TRACER.call("ChatGPT_single_request", prompt) as call:
+        with call.attempt(0) as attempt:
+            response = LLM_CLIENT.call(_ChatGPT_single_request(prompt))
+            attempt.response(response, LLM_ERROR_RESPONSES)
+        call.fail_safe = False
+    return response
+
+async def ChatGPT_single_request_async(prompt):
+    return await LLM_CLIENT.acall(_ChatGPT_single_request(prompt))
+
+async def _ChatGPT_single_request(prompt):
     if USE_OLLAMA:
-        return ollama_chat_request(prompt)
+        return await _ollama_chat(prompt)
 
-    temp_sleep()
-    completion = openai.ChatCompletion.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}]
-    )
+    completion = await LLM_CLIENT.openai_chat(
+        [{"role": "user", "content": prompt}], model="gpt-4o-mini")
     return completion["choices"][0]["message"]["content"]
 
 def GPT4_request(prompt):
@@ -90,15 +135,18 @@ def GPT4_request(prompt):
     Given a prompt and a dictionary of GPT parameters, make a request to OpenAI
     or Ollama server and returns the response.
     """
+    return LLM_CLIENT.call(_GPT4_request(prompt))
+
+async def GPT4_request_async(prompt):
+    return await LLM_CLIENT.acall(_GPT4_request(prompt))
+
+async def _GPT4_request(prompt):
     if USE_OLLAMA:
-        return ollama_chat_request(prompt)
+        return await _ollama_chat(prompt)
 
-    temp_sleep()
     try:
-        completion = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}]
-        )
+        completion = await LLM_CLIENT.openai_chat(
+            [{"role": "user", "content": prompt}], model="gpt-4")
         return completion["choices"][0]["message"]["content"]
     except:
         print("ChatGPT ERROR")
@@ -109,14 +157,18 @@ def ChatGPT_request(prompt):
     Given a prompt and a dictionary of GPT parameters, make a request to OpenAI
     or Ollama server and returns the response.
     """
+    return LLM_CLIENT.call(_ChatGPT_request(prompt))
+
+async def ChatGPT_request_async(prompt):
+    return await LLM_CLIENT.acall(_ChatGPT_request(prompt))
+
+async def _ChatGPT_request(prompt):
     if USE_OLLAMA:
-        return ollama_chat_request(prompt)
+        return await _ollama_chat(prompt)
 
     try:
-        completion = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}]
-        )
+        completion = await LLM_CLIENT.openai_chat(
+            [{"role": "user", "content": prompt}], model="gpt-4o-mini")
         return completion["choices"][0]["message"]["content"]
     except:
         print("ChatGPT ERROR")
@@ -126,17 +178,22 @@ def GPT_request(prompt, gpt_parameter):
     """
     Legacy GPT-3 request function, modified to support both OpenAI and Ollama
     """
+    return LLM_CLIENT.call(_GPT_request(prompt, gpt_parameter))
+
+async def GPT_request_async(prompt, gpt_parameter):
+    return await LLM_CLIENT.acall(_GPT_request(prompt, gpt_parameter))
+
+async def _GPT_request(prompt, gpt_parameter):
     if USE_OLLAMA:
-        return ollama_chat_request(prompt)
+        return await _ollama_chat(prompt)
 
-    temp_sleep()
     try:
         # Convert legacy parameters to chat completion format
         messages = [{"role": "user", "content": prompt}]
 
-        response = openai.ChatCompletion.create(
+        response = await LLM_CLIENT.openai_chat(
+            messages,
             model=gpt_parameter.get("model", "gpt-4o-mini"),
-            messages=messages,
             max_tokens=gpt_parameter.get("max_tokens", 50),
             temperature=gpt_parameter.get("temperature", 0),
             top_p=gpt_parameter.get("top_p", 1),
@@ -147,6 +204,35 @@ def GPT_request(prompt, gpt_parameter):
         print(f"GPT Error: {str(e)}")
         return "GPT Error"
 
+def cached_request(request, prompt, attempt, gpt_parameter=None):
+    """
+    Makes <request> (GPT_request, ChatGPT_request or GPT4_request) through
+    the response cache. <attempt> is the retry count of the caller's loop.
+    """
+    if LLM_CACHE is None:
+        if gpt_parameter is None:
+            return request(prompt)
+        return request(prompt, gpt_parameter)
+
+    if USE_OLLAMA:
+        backend, model = "ollama", OLLAMA_MODEL
+    else:
+        backend, model = "openai", (gpt_parameter or {}).get("model")
+    key = LLM_CACHE.key(backend, model, request.__name__, gpt_parameter,
+                        prompt, attempt)
+    response = LLM_CACHE.get(key)
+    if response is not None:
+        LLM_TRACER.note_cached()
+    else:
+        if gpt_parameter is None:
+            response = request(prompt)
+        else:
+            response = request(prompt, gpt_parameter)
+        if response not in LLM_ERROR_RESPONSES:
+            LLM_CACHE.put(key, response)
+    return response
+
+
 def GPT4_safe_generate_response(prompt,
                                    example_output,
                                    special_instruction,
@@ -164,24 +250,37 @@ def GPT4_safe_generate_response(prompt,
         print("CHAT GPT PROMPT")
         print(prompt)
 
-    for i in range(repeat):
-
-        try:
-            curr_gpt_response = GPT4_request(prompt).strip()
-            end_index = curr_gpt_response.rfind('}') + 1
-            curr_gpt_response = curr_gpt_response[:end_index]
-            curr_gpt_response = json.loads(curr_gpt_response)["output"]
-
-            if func_validate(curr_gpt_response, prompt=prompt):
-                return func_clean_up(curr_gpt_response, prompt=prompt)
-
-            if verbose:
-                print("---- repeat count: \n", i, curr_gpt_response)
-                print(curr_gpt_response)
-                print("~~~~")
-
-        except:
-            pass
+    with LLM_TRACER.call("GPT4_safe_generate_response", prompt) as call:
+        for i in range(repeat):
+
+            try:
+                with call.attempt(i) as attempt:
+                    curr_gpt_response = cached_request(GPT4_request, prompt,
+                                                       i).strip()
+                    attempt.response(curr_gpt_response, LLM_ERROR_RESPONSES)
+                    end_index = curr_gpt_response.rfind('}') + 1
+                    curr_gpt_response = curr_gpt_response[:end_index]
+                    curr_gpt_response = json.loads(curr_gpt_response)["output"]
+
+                    valid = func_validate(curr_gpt_response, prompt=prompt)
+                    attempt.validated(valid)
+                    if valid:
+                        output = func_clean_up(curr_gpt_response,
+                                               prompt=prompt)
+                if valid:
+                    call.fail_safe = False
+                    return output
+
+                if verbose:
+                    print("---- repeat count: \n", i, curr_gpt_response)
+                    print(curr_gpt_response)
+                    print("~~~~")
+
+            except LLMCacheMiss:
+                raise
+            except:
+                pass
+        call.fail_safe = True
 
     return False
 
@@ -204,28 +303,41 @@ def ChatGPT_safe_generate_response(prompt,
         print("CHAT GPT PROMPT")
         print(prompt)
 
-    for i in range(repeat):
-
-        try:
-            curr_gpt_response = ChatGPT_request(prompt).strip()
-            end_index = curr_gpt_response.rfind('}') + 1
-            curr_gpt_response = curr_gpt_response[:end_index]
-            curr_gpt_response = json.loads(curr_gpt_response)["output"]
-
-            # print("---ashdfaf")
-            # print(curr_gpt_response)
-            # print("000asdfhia")
-
-            if func_validate(curr_gpt_response, prompt=prompt):
-                return func_clean_up(curr_gpt_response, prompt=prompt)
-
-            if verbose:
-                print("---- repeat count: \n", i, curr_gpt_response)
-                print(curr_gpt_response)
-                print("~~~~")
-
-        except:
-            pass
+    with LLM_TRACER.call("ChatGPT_safe_generate_response", prompt) as call:
+        for i in range(repeat):
+
+            try:
+                with call.attempt(i) as attempt:
+                    curr_gpt_response = cached_request(ChatGPT_request, prompt,
+                                                       i).strip()
+                    attempt.response(curr_gpt_response, LLM_ERROR_RESPONSES)
+                    end_index = curr_gpt_response.rfind('}') + 1
+                    curr_gpt_response = curr_gpt_response[:end_index]
+                    curr_gpt_response = json.loads(curr_gpt_response)["output"]
+
+                    # print("---ashdfaf")
+                    # print(curr_gpt_response)
+                    # print("000asdfhia")
+
+                    valid = func_validate(curr_gpt_response, prompt=prompt)
+                    attempt.validated(valid)
+                    if valid:
+                        output = func_clean_up(curr_gpt_response,
+                                               prompt=prompt)
+                if valid:
+                    call.fail_safe = False
+                    return output
+
+                if verbose:
+                    print("---- repeat count: \n", i, curr_gpt_response)
+                    print(curr_gpt_response)
+                    print("~~~~")
+
+            except LLMCacheMiss:
+                raise
+            except:
+                pass
+        call.fail_safe = True
 
     return False
 
@@ -240,18 +352,31 @@ def ChatGPT_safe_generate_response_OLD(prompt,
         print("CHAT GPT PROMPT")
         print(prompt)
 
-    for i in range(repeat):
-        try:
-            curr_gpt_response = ChatGPT_request(prompt).strip()
-            if func_validate(curr_gpt_response, prompt=prompt):
-                return func_clean_up(curr_gpt_response, prompt=prompt)
-            if verbose:
-                print(f"---- repeat count: {i}")
-                print(curr_gpt_response)
-                print("~~~~")
-
-        except:
-            pass
+    with LLM_TRACER.call("ChatGPT_safe_generate_response_OLD", prompt) as call:
+        for i in range(repeat):
+            try:
+                with call.attempt(i) as attempt:
+                    curr_gpt_response = cached_request(ChatGPT_request, prompt,
+                                                       i).strip()
+                    attempt.response(curr_gpt_response, LLM_ERROR_RESPONSES)
+                    valid = func_validate(curr_gpt_response, prompt=prompt)
+                    attempt.validated(valid)
+                    if valid:
+                        output = func_clean_up(curr_gpt_response,
+                                               prompt=prompt)
+                if valid:
+                    call.fail_safe = False
+                    return output
+                if verbose:
+                    print(f"---- repeat count: {i}")
+                    print(curr_gpt_response)
+                    print("~~~~")
+
+            except LLMCacheMiss:
+                raise
+            except:
+                pass
+        call.fail_safe = True
     print("FAIL SAFE TRIGGERED")
     return fail_safe_response
 
@@ -278,6 +403,7 @@ def generate_prompt(curr_input, prompt_lib_file):
         curr_input = [curr_input]
     curr_input = [str(i) for i in curr_input]
 
+    LLM_TRACER.note_template(prompt_lib_file)
     f = open(prompt_lib_file, "r")
     prompt = f.read()
     f.close()
@@ -298,50 +424,131 @@ def safe_generate_response(prompt,
     if verbose:
         print(prompt)
 
-    for i in range(repeat):
-        curr_gpt_response = GPT_request(prompt, gpt_parameter)
-        if func_validate(curr_gpt_response, prompt=prompt):
-            return func_clean_up(curr_gpt_response, prompt=prompt)
-        if verbose:
-            print("---- repeat count: ", i, curr_gpt_response)
-            print(curr_gpt_response)
-            print("~~~~")
+    with LLM_TRACER.call("safe_generate_response", prompt) as call:
+        for i in range(repeat):
+            with call.attempt(i) as attempt:
+                curr_gpt_response = cached_request(GPT_request, prompt, i,
+                                                   gpt_parameter)
+                attempt.response(curr_gpt_response, LLM_ERROR_RESPONSES)
+                valid = func_validate(curr_gpt_response, prompt=prompt)
+                attempt.validated(valid)
+            if valid:
+                call.fail_safe = False
+                return func_clean_up(curr_gpt_response, prompt=prompt)
+            if verbose:
+                print("---- repeat count: ", i, curr_gpt_response)
+                print(curr_gpt_response)
+                print("~~~~")
+        call.fail_safe = True
     return fail_safe_response
 
 
+@profiled("operation", "embeddings")
 def get_embedding(text, model=None):
     """
     Get embeddings for text using either OpenAI or Ollama
     """
-    text = text.replace("\n", " ")
-    if not text:
-        text = "this is blank"
+    return _get_embeddings([text], model)[0]
+
+async def get_embedding_async(text, model=None):
+    return (await get_embeddings_async([text], model))[0]
 
+@profiled("operation", "embeddings")
+def get_embeddings(texts, model=None):
+    """
+    Get the embeddings of a list of texts, in the same order. Each distinct
+    text is embedded once: texts in the embedding store are not sent at all,
+    and the rest go out in one request to OpenAI, or as concurrent requests
+    on the pooled connections to Ollama.
+    """
+    return _get_embeddings(texts, model)
+
+async def get_embeddings_async(texts, model=None):
+    # The store reads and writes files (under a lock shared with other
+    # processes), so they run in a worker thread rather than on the loop.
+    loop = asyncio.get_running_loop()
+    texts, model, store_model = _embedding_request(texts, model)
+    embeddings, missing = await loop.run_in_executor(
+        None, _stored_embeddings, texts, store_model)
+    if missing:
+        results = await LLM_CLIENT.acall(_request_embeddings(missing, model))
+        await loop.run_in_executor(None, _add_embeddings, embeddings,
+                                   missing, results, store_model)
+    return [embeddings[text] for text in texts]
+
+def _get_embeddings(texts, model=None):
+    texts, model, store_model = _embedding_request(texts, model)
+    embeddings, missing = _stored_embeddings(texts, store_model)
+    if missing:
+        results = LLM_CLIENT.call(_request_embeddings(missing, model))
+        _add_embeddings(embeddings, missing, results, store_model)
+    return [embeddings[text] for text in texts]
+
+def _embedding_request(texts, model):
+    """
+    Returns the normalized <texts>, the model to request and the model name
+    the embeddings are stored under.
+    """
+    texts = [normalize_embedding_text(text) for text in texts]
     if USE_OLLAMA:
-        try:
-            # Use Ollama for embeddings
-            response = requests.post(
-                f"{OLLAMA_BASE_URL}/api/embeddings",
-                json={
-                    "model": OLLAMA_MODEL,
-                    "prompt": text
-                }
-            )
-
-            if response.status_code == 200:
-                return response.json().get('embedding', [])
-            else:
-                print(f"Ollama Embedding Error: {response.status_code}")
-                # Return a simple random embedding as fallback
-                return list(np.random.normal(0, 1, 1536))
-        except Exception as e:
-            print(f"Ollama Embedding Error: {str(e)}")
-            # Return a simple random embedding as fallback
-            return list(np.random.normal(0, 1, 1536))
-    else:
-        # Use OpenAI for embeddings
-        return openai.Embedding.create(
-                input=[text], model=model or "text-embedding-ada-002")['data'][0]['embedding']
+        return texts, OLLAMA_MODEL, f"ollama:{OLLAMA_MODEL}"
+    model = model or "text-embedding-ada-002"
+    return texts, model, f"openai:{model}"
+
+def _stored_embeddings(texts, store_model):
+    """
+    Returns a dictionary from each distinct text to its stored embedding
+    (None if it is not in the store), and the texts that are not stored.
+    This runs outside the LLM client's loop, so that the store's file locks
+    never hold up the requests in flight.
+    """
+    embeddings = dict.fromkeys(texts)
+    if EMBEDDING_STORE:
+        stored = EMBEDDING_STORE.get_many(list(embeddings), store_model)
+        for text, embedding in zip(list(embeddings), stored):
+            if embedding is not None:
+                embeddings[text] = embedding.tolist()
+    missing = [text for text, embedding in embeddings.items()
+               if embedding is None]
+    return embeddings, missing
+
+async def _request_embeddings(texts, model):
+    """
+    Requests the embeddings of <texts> from Ollama or OpenAI. Returns them
+    in the same order, with None for the texts whose request failed.
+    """
+    if USE_OLLAMA:
+        results = await asyncio.gather(
+            *[LLM_CLIENT.ollama_embedding(OLLAMA_BASE_URL, model, text)
+              for text in texts],
+            return_exceptions=True)
+        for count, embedding in enumerate(results):
+            if isinstance(embedding, Exception):
+                print(f"Ollama Embedding Error: {str(embedding)}")
+                results[count] = None
+        return results
+    return await LLM_CLIENT.openai_embeddings(texts, model)
+
+def _add_embeddings(embeddings, texts, results, store_model):
+    """
+    Puts the requested embeddings <results> of <texts> in <embeddings> and
+    in the store. They are rounded to the store's float32 first, so that a
+    text gets the same numbers whether it was just requested or read back
+    from the store.
+    """
+    for text, embedding in zip(texts, results):
+        if embedding is None:
+            # Return a simple random embedding as fallback (which is not
+            # stored)
+            embeddings[text] = list(np.random.normal(0, 1, 1536))
+            continue
+        if not len(embedding):
+            embeddings[text] = embedding
+            continue
+        embedding = np.asarray(embedding, dtype=EMBEDDING_STORE_DTYPE)
+        embeddings[text] = embedding.tolist()
+        if EMBEDDING_STORE:
+            EMBEDDING_STORE.put(text, store_model, embedding)
 
 
 if __name__ == '__main__':
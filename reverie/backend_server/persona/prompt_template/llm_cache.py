@@ -0,0 +1,132 @@
+"""
+File: llm_cache.py
+Description: A persistent, content-addressed cache of LLM responses, stored
+in SQLite. The request functions in gpt_structure.py look responses up here
+before calling the backend, so that replaying or forking a simulation does
+not pay again for prompts that were already answered.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class LLMCacheMiss(Exception):
+    """
+    Raised in replay-only mode when a response is not in the cache.
+    """
+    pass
+
+
+class LLMResponseCache:
+    """
+    Maps a hash of (backend, model, request, parameters, prompt, attempt) to
+    the response text. Entries are evicted least recently used first once
+    there are more than <max_entries>, and are ignored once they are older
+    than <ttl> seconds.
+    """
+    def __init__(self, path, max_entries=None, ttl=None, replay_only=False):
+        """
+        INPUT:
+          path: the SQLite database file.
+          max_entries: the most entries to keep; None for no limit.
+          ttl: the age in seconds after which an entry expires; None for
+               entries that never expire.
+          replay_only: if True, a miss raises LLMCacheMiss instead of letting
+                       the request go to the backend.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.replay_only = replay_only
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        # WAL lets several simulations share the cache file.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                        " key TEXT PRIMARY KEY,"
+                        " response TEXT NOT NULL,"
+                        " created REAL NOT NULL,"
+                        " last_used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_used"
+                        " ON responses (last_used)")
+        self.n_entries = self.db.execute(
+            "SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(backend, model, request, params, prompt, attempt):
+        """
+        Returns the cache key of a request. <attempt> is the retry count
+        within safe_generate_response and friends, so that a replay sees the
+        same sequence of answers, including the ones that failed validation.
+        """
+        key_parts = [backend, model, request, params, prompt, attempt]
+        key_str = json.dumps(key_parts, sort_keys=True, default=str)
+        return hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached response for <key>, or None on a miss (raising
+        LLMCacheMiss instead in replay-only mode).
+        """
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT response, created FROM responses WHERE key = ?",
+                (key,)).fetchone()
+            if row and self.ttl is not None and row[1] + self.ttl < now:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.n_entries -= 1
+                row = None
+            if row:
+                self.db.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?",
+                    (now, key))
+                self.hits += 1
+                return row[0]
+            self.misses += 1
+        if self.replay_only:
+            raise LLMCacheMiss(f"no cached response for {key}")
+        return None
+
+    def put(self, key, response):
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, response, now, now))
+            self.n_entries += cursor.rowcount
+            if self.max_entries and self.n_entries > self.max_entries:
+                self.evict()
+
+    def evict(self):
+        """
+        Drops the least recently used entries, down to nine tenths of
+        <max_entries> so that eviction does not run on every insert.
+        """
+        self.n_entries = self.db.execute(
+            "SELECT COUNT(*) FROM responses").fetchone()[0]
+        excess = self.n_entries - int(self.max_entries * 0.9)
+        if excess > 0:
+            self.db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses"
+                " ORDER BY last_used LIMIT ?)", (excess,))
+            self.n_entries -= excess
+
+    def stats(self):
+        """
+        Returns the hit and miss counts of this process and the number of
+        entries in the cache.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "entries": self.n_entries}
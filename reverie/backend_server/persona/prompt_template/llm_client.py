@@ -0,0 +1,216 @@
+"""
+File: llm_client.py
+Description: An asyncio client for the Ollama and OpenAI backends that keeps
+a pool of persistent HTTP connections and limits how many requests are in
+flight (and how many start per second) for each backend.
+
+The client runs its own event loop on a background thread. That lets plain
+synchronous code (the request functions in gpt_structure.py, called from any
+thread) and asynchronous code (which can fan out several requests at once)
+share the same connection pool and the same limits.
+"""
+import asyncio
+import atexit
+import contextlib
+import json
+import threading
+import time
+
+import aiohttp
+
+# Only import OpenAI if needed
+try:
+    import openai
+except ImportError:
+    openai = None
+
+
+class RateLimiter:
+    """
+    Spaces out the start of requests so that at most <rate> of them start per
+    second. A rate of None means no limit.
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.next_start = 0.0
+        self.lock = None
+
+    async def wait(self):
+        if not self.rate:
+            return
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            now = time.monotonic()
+            if self.next_start > now:
+                await asyncio.sleep(self.next_start - now)
+                now = self.next_start
+            self.next_start = now + 1.0 / self.rate
+
+
+class LLMClient:
+    """
+    Owns the event loop thread, the pooled aiohttp session and the per-backend
+    limits. Request coroutines (ollama_chat, ollama_embedding, openai_chat,
+    openai_embeddings) must run on the client's loop: from synchronous code,
+    pass them to call(); from a coroutine running on another loop, await
+    acall().
+    """
+    def __init__(self, max_connections=16, max_concurrency=None,
+                 rate_limits=None):
+        """
+        INPUT:
+          max_connections: size of the HTTP connection pool.
+          max_concurrency: a dictionary from backend name ("ollama" or
+                           "openai") to the number of requests that may be
+                           in flight at once. Missing backends get
+                           <max_connections>.
+          rate_limits: a dictionary from backend name to the number of
+                       requests that may start per second. Missing backends
+                       are not rate limited.
+        """
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency or dict()
+        self.rate_limits = rate_limits or dict()
+
+        self.loop = None
+        self.thread = None
+        self.session = None
+        self.semaphores = dict()
+        self.rate_limiters = dict()
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the event loop thread if it is not running yet.
+        """
+        with self.start_lock:
+            if self.loop is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever,
+                                           name="llm-client", daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        """
+        Closes the connection pool and stops the event loop thread.
+        """
+        with self.start_lock:
+            if self.loop is None:
+                return
+            if self.session is not None:
+                asyncio.run_coroutine_threadsafe(self.session.close(),
+                                                 self.loop).result()
+                self.session = None
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            self.thread = None
+            self.semaphores = dict()
+            self.rate_limiters = dict()
+
+    def call(self, coro):
+        """
+        Runs a request coroutine on the client's loop and blocks until it is
+        done. Safe to call from any thread except the loop thread itself.
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def acall(self, coro):
+        """
+        Awaitable version of call() for coroutines running on another event
+        loop.
+        """
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return await asyncio.wrap_future(future)
+
+    def get_session(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    @contextlib.asynccontextmanager
+    async def slot(self, backend):
+        """
+        Holds one of <backend>'s request slots for the duration of the block,
+        after waiting for its rate limit.
+        """
+        if backend not in self.semaphores:
+            self.semaphores[backend] = asyncio.Semaphore(
+                self.max_concurrency.get(backend, self.max_connections))
+            self.rate_limiters[backend] = RateLimiter(
+                self.rate_limits.get(backend))
+        async with self.semaphores[backend]:
+            await self.rate_limiters[backend].wait()
+            yield
+
+    async def ollama_chat(self, base_url, model, prompt):
+        """
+        Sends one chat message to Ollama and returns the streamed response as
+        a single string.
+        """
+        async with self.slot("ollama"):
+            async with self.get_session().post(
+                    f"{base_url}/api/chat",
+                    json={"model": model,
+                          "messages": [{"role": "user", "content": prompt}],
+                          "stream": True}) as response:
+                if response.status != 200:
+                    print(f"Ollama Error: {response.status}")
+                    return "Ollama Error"
+
+                # Process the streaming response line by line.
+                full_response = ""
+                async for line in response.content:
+                    if not line.strip():
+                        continue
+                    try:
+                        json_response = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if ("message" in json_response
+                            and "content" in json_response["message"]):
+                        full_response += json_response["message"]["content"]
+                return full_response.strip()
+
+    async def ollama_embedding(self, base_url, model, text):
+        """
+        Returns Ollama's embedding of <text>. Raises RuntimeError if Ollama
+        answers with an error status.
+        """
+        async with self.slot("ollama"):
+            async with self.get_session().post(
+                    f"{base_url}/api/embeddings",
+                    json={"model": model, "prompt": text}) as response:
+                if response.status != 200:
+                    raise RuntimeError(f"status {response.status}")
+                # Ollama does not always send a JSON content type.
+                body = await response.json(content_type=None)
+                return body.get("embedding", [])
+
+    async def openai_chat(self, messages, **params):
+        """
+        Returns the raw ChatCompletion response for <messages>. <params> are
+        passed on to openai.ChatCompletion.acreate.
+        """
+        async with self.slot("openai"):
+            openai.aiosession.set(self.get_session())
+            return await openai.ChatCompletion.acreate(messages=messages,
+                                                       **params)
+
+    async def openai_embeddings(self, texts, model):
+        """
+        Returns OpenAI's embeddings of <texts>, from a single request.
+        """
+        async with self.slot("openai"):
+            openai.aiosession.set(self.get_session())
+            response = await openai.Embedding.acreate(input=texts,
+                                                      model=model)
+            data = sorted(response["data"], key=lambda d: d["index"])
+            return [d["embedding"] for d in data]
@@ -0,0 +1,241 @@
+"""
+File: llm_trace.py
+Description: A trace of every LLM request, for finding out which prompts
+cost the most. The request functions in gpt_structure.py report each attempt
+of a call (safe_generate_response and friends retry a prompt until a
+response passes validation, and fall back to a fail-safe if none does) and
+the trace appends one JSON line per attempt:
+  {"time": .., "call_id": .., "function": "run_gpt_prompt_wake_up_hour",
+   "persona": "Isabella Rodriguez",
+   "template": "persona/prompt_template/v2/wake_up_hour_v1.txt",
+   "wrapper": "safe_generate_response", "attempt": 0, "prompt_chars": ..,
+   "response_chars": .., "latency_sec": .., "cached": false,
+   "error": null, "valid": true, "fail_safe": false}
+<function> is the run_gpt_prompt_* function the call was made in (or, for
+calls made elsewhere, the function that made it), <error> is the error
+response ("GPT Error", etc.) or the exception the attempt failed with, and
+<fail_safe> is whether no attempt of the call passed validation. The lines
+of a call are written together when the call ends.
+
+llm_trace_report.py ranks the prompt functions of a trace by total time and
+by the time spent on attempts that were thrown away.
+"""
+import datetime
+import functools
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+
+class TracedAttempt:
+    def __init__(self, call, attempt):
+        self.call = call
+        self.record = {"attempt": attempt,
+                       "prompt_chars": len(call.prompt),
+                       "response_chars": None,
+                       "latency_sec": None,
+                       "cached": False,
+                       "error": None,
+                       "valid": None}
+
+    def __enter__(self):
+        self.call.tracer.local.cached = False
+        self.start = time.perf_counter()
+        return self
+
+    def response(self, response, error_responses=()):
+        """
+        Records the response of the attempt's request, as soon as it is back.
+        """
+        self.record["latency_sec"] = round(time.perf_counter() - self.start,
+                                           6)
+        self.record["cached"] = self.call.tracer.local.cached
+        self.record["response_chars"] = len(response or "")
+        if response in error_responses:
+            self.record["error"] = response
+
+    def validated(self, valid):
+        self.record["valid"] = bool(valid)
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.record["latency_sec"] is None:
+            self.record["latency_sec"] = round(time.perf_counter()
+                                               - self.start, 6)
+        if exc_type is not None:
+            self.record["error"] = self.record["error"] or exc_type.__name__
+            self.record["valid"] = False
+        self.call.attempts += [self.record]
+        return False
+
+
+class TracedCall:
+    def __init__(self, tracer, wrapper, prompt, caller):
+        self.tracer = tracer
+        self.wrapper = wrapper
+        self.prompt = prompt
+        self.function = getattr(tracer.local, "function", None) or caller
+        self.persona = getattr(tracer.local, "persona", None)
+        self.template = getattr(tracer.local, "template", None)
+        self.attempts = []
+        # The caller sets <fail_safe> to whether the call gave up on the
+        # LLM's responses; it stays None if the call ends in an exception.
+        self.fail_safe = None
+
+    def attempt(self, attempt):
+        """
+        Returns a context manager around one attempt of the call.
+        """
+        return TracedAttempt(self, attempt)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        """
+        Writes the attempts of the call to the trace.
+        """
+        now = datetime.datetime.now().isoformat(timespec="milliseconds")
+        call_id = f"{self.tracer.run_id}-{next(self.tracer.call_ids)}"
+        lines = []
+        for record in self.attempts:
+            line = {"time": now,
+                    "call_id": call_id,
+                    "function": self.function,
+                    "persona": self.persona,
+                    "template": self.template,
+                    "wrapper": self.wrapper}
+            line.update(record)
+            line["fail_safe"] = self.fail_safe
+            lines += [json.dumps(line) + "\n"]
+        self.tracer.write(lines)
+        return False
+
+
+class NullCall:
+    """
+    Stands in for a TracedCall while the trace is off.
+    """
+    fail_safe = None
+
+    def attempt(self, attempt):
+        return NULL_ATTEMPT
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class NullAttempt:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def response(self, response, error_responses=()):
+        pass
+
+    def validated(self, valid):
+        pass
+
+
+NULL_CALL = NullCall()
+NULL_ATTEMPT = NullAttempt()
+
+
+class LLMTracer:
+    def __init__(self, path=None):
+        """
+        INPUT:
+          path: the trace file (JSON lines) to append to, or None to leave
+                the trace off until start() is called.
+        """
+        self.enabled = False
+        self.lock = threading.Lock()
+        # <local> holds, for each thread, the run_gpt_prompt_* function (and
+        # its persona and prompt template) that the thread is in.
+        self.local = threading.local()
+        # Call ids are "<run>-<count>", so that the calls of several runs
+        # that append to the same file stay apart.
+        self.run_id = f"{int(time.time())}.{os.getpid()}"
+        self.call_ids = itertools.count()
+        self.file = None
+        if path:
+            self.start(path)
+
+    def start(self, path):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.file = open(path, "a")
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def write(self, lines):
+        with self.lock:
+            if self.file:
+                self.file.writelines(lines)
+                self.file.flush()
+
+    def prompt_function(self, name):
+        """
+        Decorates a run_gpt_prompt_* function so that the calls it makes are
+        traced under its name (and the name of the persona it is given).
+        """
+        def decorate(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                local = self.local
+                saved = (getattr(local, "function", None),
+                         getattr(local, "persona", None),
+                         getattr(local, "template", None))
+                local.function = name
+                local.persona = getattr(args[0], "name", None) if args else None
+                local.template = None
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    local.function, local.persona, local.template = saved
+            return wrapper
+        return decorate
+
+    def note_template(self, template):
+        """
+        Records the prompt template the current prompt function uses.
+        """
+        if self.enabled:
+            self.local.template = template
+
+    def note_cached(self):
+        """
+        Records that the current attempt was answered from the cache.
+        """
+        if self.enabled:
+            self.local.cached = True
+
+    def call(self, wrapper, prompt):
+        """
+        Returns the TracedCall of a new call made by <wrapper> (e.g.,
+        "safe_generate_response") with <prompt>, or a stand-in that does
+        nothing if the trace is off. The call is written to the trace when
+        its context exits.
+        """
+        if not self.enabled:
+            return NULL_CALL
+        # The function that called <wrapper>, for calls not made in a
+        # run_gpt_prompt_* function.
+        caller = sys._getframe(2).f_code.co_name
+        return TracedCall(self, wrapper, prompt, caller)
@@ -16,8 +16,9 @@ sys.path.append('../../')
 from global_methods import *
 from persona.prompt_template.gpt_structure import *
 from persona.prompt_template.print_prompt import *
+from profiler import profiled
 
-def get_random_alphanumeric(i=6, j=6):
+def get_random_alphanumeric(i=6, j=6, rng=random):
   """
   Returns a random alpha numeric strength that has the length of somewhere
   between i and j.
@@ -25,11 +26,12 @@ def get_random_alphanumeric(i=6, j=6):
   INPUT:
     i: min_range for the length
     j: max_range for the length
+    rng: the random number generator to draw from (e.g., persona.rng)
   OUTPUT:
     an alpha numeric str with the length of somewhere between i and j.
   """
-  k = random.randint(i, j)
-  x = ''.join(random.choices(string.ascii_letters + string.digits, k=k))
+  k = rng.randint(i, j)
+  x = ''.join(rng.choices(string.ascii_letters + string.digits, k=k))
   return x
 
 
@@ -189,13 +191,13 @@ def run_gpt_prompt_generate_hourly_schedule(persona,
     if p_f_ds_hourly_org:
       prior_schedule = "\n"
       for count, i in enumerate(p_f_ds_hourly_org):
-        prior_schedule += f"[(ID:{get_random_alphanumeric()})"
+        prior_schedule += f"[(ID:{get_random_alphanumeric(rng=persona.rng)})"
         prior_schedule += f" {persona.scratch.get_str_curr_date_str()} --"
         prior_schedule += f" {hour_str[count]}] Activity:"
         prior_schedule += f" {persona.scratch.get_str_firstname()}"
         prior_schedule += f" is {i}\n"
 
-    prompt_ending = f"[(ID:{get_random_alphanumeric()})"
+    prompt_ending = f"[(ID:{get_random_alphanumeric(rng=persona.rng)})"
     prompt_ending += f" {persona.scratch.get_str_curr_date_str()}"
     prompt_ending += f" -- {curr_hour_str}] Activity:"
     prompt_ending += f" {persona.scratch.get_str_firstname()} is"
@@ -606,7 +608,7 @@ def run_gpt_prompt_action_sector(action_description,
     # output = random.choice(x)
     output = persona.scratch.living_area.split(":")[1]
 
-  print ("DEBUG", random.choice(x), "------", output)
+  print ("DEBUG", persona.rng.choice(x), "------", output)
 
   if debug or verbose:
     print_run_prompts(prompt_template, persona, gpt_param,
@@ -759,7 +761,7 @@ def run_gpt_prompt_action_game_object(action_description,
 
   x = [i.strip() for i in persona.s_mem.get_str_accessible_arena_game_objects(temp_address).split(",")]
   if output not in x:
-    output = random.choice(x)
+    output = persona.rng.choice(x)
 
   if debug or verbose:
     print_run_prompts(prompt_template, persona, gpt_param,
@@ -1707,4 +1709,14 @@ Provide exactly {n} focal points as a JSON list of strings. These should be the
     print(f"Focal Points Prompt: {prompt}")
     print(f"Focal Points Output: {output}")
 
-  return output, [output, prompt, gpt_param, prompt_input, fail_safe]
\ No newline at end of file
+  return output, [output, prompt, gpt_param, prompt_input, fail_safe]
+
+
+# Every run_gpt_prompt_* call is timed by the step profiler (see 
+# profiler.py), and the LLM calls it makes are traced under its name (see 
+# llm_trace.py). The functions are wrapped here, before any other module 
+# imports them. 
+for _name, _fn in list(globals().items()): 
+  if _name.startswith("run_gpt_prompt_") and callable(_fn): 
+    globals()[_name] = profiled("prompt", _name)(
+                         LLM_TRACER.prompt_function(_name)(_fn))
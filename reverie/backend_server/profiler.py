@@ -0,0 +1,249 @@
+"""
+Author: Joon Sung Park (joonspk@stanford.edu)
+
+File: profiler.py
+Description: Times where each step of a simulation goes. The profiler keeps
+timers of four kinds:
+  phase      -- the cognitive phases of each persona's move (perceive,
+                retrieve, plan, react, reflect, execute)
+  prompt     -- every run_gpt_prompt_* call
+  operation  -- CPU-bound work inside the phases (path finding, retrieval
+                scoring) and the embedding requests
+  storage    -- the reads and writes of environment, movement and memory
+                files
+Timers nest (a prompt runs inside a phase, and an embedding request inside
+new_retrieve), so the kinds do not add up to the time of the step.
+
+The timers are added up over a step, and when the step ends the profiler
+appends one JSON line with the step's totals to its metrics file, and
+rewrites a file in the Prometheus text exposition format next to it (e.g.,
+profile.jsonl and profile.prom) with the running totals since the start, for
+a node exporter textfile collector to pick up. A save between steps gets a
+line of its own.
+
+Each line of the metrics file looks like:
+  {"sim_code": .., "step": .., "event": "step", "save" or "error", "time": ..,
+   "wall_sec": .., "phase": {"perceive": {"count", "sec", "max_sec"}, ..},
+   "prompt": {..}, "operation": {..}, "storage": {..},
+   "personas": {"Isabella Rodriguez": {"perceive": <sec>, ..}, ..}}
+
+The profiler is off unless profile_path is set in utils.py (e.g.,
+profile_path = "profile.jsonl") or reverie.py is given --profile. While it
+is off, a timer is one attribute check.
+"""
+import collections
+import contextlib
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+
+import utils
+
+KINDS = ["phase", "prompt", "operation", "storage"]
+PROMETHEUS_PREFIX = "reverie"
+# The label that names the timer in the Prometheus metrics of each kind.
+PROMETHEUS_LABELS = {"phase": "phase", "prompt": "function",
+                     "operation": "operation", "storage": "operation"}
+
+NULL_TIMER = contextlib.nullcontext()
+
+
+def prometheus_label(value):
+  return (str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+          .replace("\n", "\\n"))
+
+
+class Timer:
+  __slots__ = ["profiler", "kind", "name", "persona", "start"]
+
+  def __init__(self, profiler, kind, name, persona):
+    self.profiler = profiler
+    self.kind = kind
+    self.name = name
+    self.persona = persona
+
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+
+  def __exit__(self, *exc):
+    self.profiler.record(self.kind, self.name,
+                         time.perf_counter() - self.start, self.persona)
+    return False
+
+
+class StepProfiler:
+  def __init__(self, path=None):
+    """
+    INPUT
+      path: the metrics file (JSON lines) to append to, or None to leave the
+            profiler off. The Prometheus file is the same path with the
+            extension .prom.
+    """
+    self.enabled = False
+    self.lock = threading.Lock()
+    # <timers> maps (kind, name) to the [count, seconds, max seconds] of the
+    # current step, and <persona_phases> maps (persona, phase) to seconds.
+    self.timers = dict()
+    self.persona_phases = collections.Counter()
+    # <totals> and <persona_totals> are the same, since the start.
+    self.totals = dict()
+    self.persona_totals = collections.Counter()
+    self.steps = collections.Counter()
+    self.step_seconds = collections.Counter()
+    self.last_step_seconds = dict()
+    if path:
+      self.start(path)
+
+
+  def start(self, path):
+    self.path = path
+    self.prometheus_path = os.path.splitext(path)[0] + ".prom"
+    folder = os.path.dirname(path)
+    if folder:
+      os.makedirs(folder, exist_ok=True)
+    self.enabled = True
+
+
+  def stop(self):
+    self.enabled = False
+
+
+  def timer(self, kind, name, persona=None):
+    """
+    Returns a context manager that times its block as <name> of <kind>. A
+    phase timer given a <persona> also counts towards that persona's
+    breakdown of phases.
+    """
+    if not self.enabled:
+      return NULL_TIMER
+    return Timer(self, kind, name, persona)
+
+
+  def record(self, kind, name, seconds, persona=None):
+    with self.lock:
+      entry = self.timers.get((kind, name))
+      if entry is None:
+        entry = self.timers[(kind, name)] = [0, 0.0, 0.0]
+      entry[0] += 1
+      entry[1] += seconds
+      entry[2] = max(entry[2], seconds)
+      if persona is not None and kind == "phase":
+        self.persona_phases[(persona, name)] += seconds
+
+
+  def end_step(self, sim_code, step, wall_sec, event="step"):
+    """
+    Writes the timers since the last call as one line of the metrics file,
+    adds them to the running totals and rewrites the Prometheus file.
+
+    INPUT
+      sim_code: the simulation the step belongs to.
+      step: the step that just ended (or that was saved).
+      wall_sec: the wall time of the step.
+      event: "step", "save" for a save between steps, or "error" for the
+             part of a step that failed.
+    """
+    if not self.enabled:
+      return
+    with self.lock:
+      timers, self.timers = self.timers, dict()
+      persona_phases, self.persona_phases = (self.persona_phases,
+                                             collections.Counter())
+      for key, (count, seconds, max_seconds) in timers.items():
+        total = self.totals.setdefault(key, [0, 0.0])
+        total[0] += count
+        total[1] += seconds
+      self.persona_totals.update(persona_phases)
+      if event == "step":
+        self.steps[sim_code] += 1
+        self.step_seconds[sim_code] += wall_sec
+        self.last_step_seconds[sim_code] = wall_sec
+      prometheus = self.prometheus_text()
+
+    line = {"sim_code": sim_code,
+            "step": step,
+            "event": event,
+            "time": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            "wall_sec": round(wall_sec, 6)}
+    for kind in KINDS:
+      line[kind] = dict()
+    for (kind, name), (count, seconds, max_seconds) in sorted(timers.items()):
+      line[kind][name] = {"count": count,
+                          "sec": round(seconds, 6),
+                          "max_sec": round(max_seconds, 6)}
+    line["personas"] = dict()
+    for (persona, phase), seconds in sorted(persona_phases.items()):
+      line["personas"].setdefault(persona, dict())[phase] = round(seconds, 6)
+
+    with open(self.path, "a") as outfile:
+      outfile.write(json.dumps(line) + "\n")
+    with open(f"{self.prometheus_path}.tmp", "w") as outfile:
+      outfile.write(prometheus)
+    os.replace(f"{self.prometheus_path}.tmp", self.prometheus_path)
+
+
+  def prometheus_text(self):
+    """
+    Returns the running totals in the Prometheus text exposition format.
+    """
+    lines = []
+    def metric(name, metric_type, help_text, samples):
+      name = f"{PROMETHEUS_PREFIX}_{name}"
+      lines.extend([f"# HELP {name} {help_text}",
+                    f"# TYPE {name} {metric_type}"])
+      for labels, value in samples:
+        label_text = ",".join(f"{key}=\"{prometheus_label(val)}\""
+                              for key, val in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}")
+
+    metric("steps_total", "counter", "Steps run.",
+           [({"sim_code": sim_code}, count)
+            for sim_code, count in sorted(self.steps.items())])
+    metric("step_seconds_total", "counter", "Wall time of all steps.",
+           [({"sim_code": sim_code}, seconds)
+            for sim_code, seconds in sorted(self.step_seconds.items())])
+    metric("last_step_seconds", "gauge", "Wall time of the last step.",
+           [({"sim_code": sim_code}, seconds)
+            for sim_code, seconds in sorted(self.last_step_seconds.items())])
+    for kind in KINDS:
+      label = PROMETHEUS_LABELS[kind]
+      entries = sorted((name, total) for (entry_kind, name), total
+                       in self.totals.items() if entry_kind == kind)
+      metric(f"{kind}_seconds_total", "counter",
+             f"Time spent in each {label} ({kind} timers).",
+             [({label: name}, total[1]) for name, total in entries])
+      metric(f"{kind}_calls_total", "counter",
+             f"Calls of each {label} ({kind} timers).",
+             [({label: name}, total[0]) for name, total in entries])
+    metric("persona_phase_seconds_total", "counter",
+           "Time spent in each phase, per persona.",
+           [({"persona": persona, "phase": phase}, seconds)
+            for (persona, phase), seconds
+            in sorted(self.persona_totals.items())])
+    return "\n".join(lines) + "\n"
+
+
+PROFILER = StepProfiler(getattr(utils, "profile_path", None))
+
+
+def profiled(kind, name=None):
+  """
+  Decorates a function so that every call is timed as <name> (by default,
+  the function's name) of <kind>.
+  """
+  def decorate(fn):
+    timer_name = name or fn.__name__
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      if not PROFILER.enabled:
+        return fn(*args, **kwargs)
+      with Timer(PROFILER, kind, timer_name, None):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorate
@@ -17,7 +17,24 @@ generative agents and their cognitive modules here. Most notably, I use the
 term "personas" to refer to generative agents, "associative memory" to refer
 to the memory stream, and "reverie" to refer to the overarching simulation
 framework.
+
+Usage (from reverie/backend_server):
+  python reverie.py
+      Asks for the simulation to fork and the new simulation's name, then
+      opens the interactive prompt.
+  python reverie.py --fork <fork_sim_code> --sim <sim_code> --steps 1000
+      Runs 1000 steps headless (no frontend server or browser needed),
+      saving every --save-every steps and at the end.
+  python reverie.py ... --profile profile.jsonl
+      Also writes where the time of every step went (see profiler.py).
+  python reverie.py ... --trace llm_trace.jsonl
+      Also traces every LLM call (see llm_trace_report.py).
+  python reverie.py ... --step-workers 4 --seed 0
+      Lets up to 4 personas wait on the LLM at the same time during a step,
+      with their random choices seeded from 0 so that runs repeat (see
+      ReverieServer.move_personas).
 """
+import argparse
 import json
 import numpy
 import datetime
@@ -25,15 +42,20 @@ import pickle
 import time
 import math
 import os
+import random
 import shutil
 import traceback
 
-from selenium import webdriver
+import utils
+from concurrent.futures import ThreadPoolExecutor
 
 from global_methods import *
 from utils import *
 from maze import *
+from frontend_channel import *
+from profiler import PROFILER
 from persona.persona import *
+from persona.prompt_template.gpt_structure import LLM_TRACER
 
 ##############################################################################
 #                                  REVERIE                                   #
@@ -42,7 +64,8 @@ from persona.persona import *
 class ReverieServer:
   def __init__(self,
                fork_sim_code,
-               sim_code):
+               sim_code,
+               copy_on_write=True):
     # FORKING FROM A PRIOR SIMULATION:
     # <fork_sim_code> indicates the simulation we are forking from.
     # Interestingly, all simulations must be forked from some initial
@@ -53,9 +76,15 @@ class ReverieServer:
     # <sim_code> indicates our current simulation. The first step here is to
     # copy everything that's in <fork_sim_code>, but edit its
     # reverie/meta/json's fork variable.
+    # With <copy_on_write>, the environment and movement histories are not
+    # copied; they are read from <fork_sim_code> (and its own parents) as
+    # needed. See fork_sim_folder in global_methods.py.
     self.sim_code = sim_code
     sim_folder = f"{fs_storage}/{self.sim_code}"
-    copyanything(fork_folder, sim_folder)
+    if copy_on_write:
+      fork_sim_folder(fork_folder, sim_folder)
+    else:
+      copyanything(fork_folder, sim_folder)
 
     with open(f"{sim_folder}/reverie/meta.json") as json_file:
       reverie_meta = json.load(json_file)
@@ -119,7 +148,7 @@ class ReverieServer:
     # self.persona_convo = dict()
 
     # Loading in all personas.
-    init_env_file = f"{sim_folder}/environment/{str(self.step)}.json"
+    init_env_file = sim_step_file(sim_folder, "environment", self.step)
     init_env = json.load(open(init_env_file))
     for persona_name in reverie_meta['persona_names']:
       persona_folder = f"{sim_folder}/personas/{persona_name}"
@@ -129,13 +158,32 @@ class ReverieServer:
 
       self.personas[persona_name] = curr_persona
       self.personas_tile[persona_name] = (p_x, p_y)
-      self.maze.tiles[p_y][p_x]["events"].add(curr_persona.scratch
-                                              .get_curr_event_and_desc())
+      self.maze.add_event_from_tile(curr_persona.scratch
+                                    .get_curr_event_and_desc(), (p_x, p_y))
 
     # REVERIE SETTINGS PARAMETERS:
     # <server_sleep> denotes the amount of time that our while loop rests each
     # cycle; this is to not kill our machine.
     self.server_sleep = 0.1
+    # <incremental_save> makes save() append only the persona state that 
+    # changed since the last save instead of rewriting every memory file. 
+    self.incremental_save = True
+    # <step_workers> is the number of personas that may wait on the LLM at
+    # the same time during a step (see move_personas). 1 runs the personas
+    # one after another, exactly as before. It can be set with step_workers
+    # in utils.py or with --step-workers. 
+    self.step_workers = getattr(utils, "step_workers", 1)
+    # <seed> makes the personas' random choices reproducible. The personas'
+    # random number generators are reseeded from it at every step; if it is
+    # None, they are reseeded from the global random module instead. It can
+    # be set with step_seed in utils.py or with --seed. 
+    self.seed = getattr(utils, "step_seed", None)
+    # <use_channel> lets the frontend server push environments to us and 
+    # receive movements from us through a local socket (see 
+    # frontend_channel.py) instead of both sides polling files. The 
+    # environment and movement files are written either way. 
+    self.use_channel = True
+    self.channel = None
 
     # SIGNALING THE FRONTEND SERVER:
     # curr_sim_code.json contains the current simulation code, and
@@ -167,6 +215,7 @@ class ReverieServer:
     """
     # <sim_folder> points to the current simulation folder.
     sim_folder = f"{fs_storage}/{self.sim_code}"
+    start = time.perf_counter()
 
     # Save Reverie meta information.
     reverie_meta = dict()
@@ -178,13 +227,102 @@ class ReverieServer:
     reverie_meta["persona_names"] = list(self.personas.keys())
     reverie_meta["step"] = self.step
     reverie_meta_f = f"{sim_folder}/reverie/meta.json"
-    with open(reverie_meta_f, "w") as outfile:
-      outfile.write(json.dumps(reverie_meta, indent=2))
+    with PROFILER.timer("storage", "save_meta"):
+      with open(reverie_meta_f, "w") as outfile:
+        outfile.write(json.dumps(reverie_meta, indent=2))
 
     # Save the personas.
     for persona_name, persona in self.personas.items():
       save_folder = f"{sim_folder}/personas/{persona_name}/bootstrap_memory"
-      persona.save(save_folder)
+      with PROFILER.timer("storage", "save_persona"):
+        persona.save(save_folder, self.incremental_save)
+    PROFILER.end_step(self.sim_code, self.step, time.perf_counter() - start,
+                      "save")
+
+
+  def seed_personas(self):
+    """
+    Reseeds every persona's random number generator for the current step. 
+    The seeds do not depend on how the personas' work is scheduled, so a 
+    step makes the same random choices whether the personas run one after 
+    another or at the same time. 
+
+    INPUT
+      None
+    OUTPUT
+      None
+    """
+    for persona_name, persona in self.personas.items():
+      if self.seed is None:
+        persona.rng.seed(random.getrandbits(64))
+      else:
+        persona.rng.seed(f"{self.seed}:{self.step}:{persona_name}")
+
+
+  def move_personas(self):
+    """
+    Has every persona perceive, plan, reflect and decide on its next tile for
+    the current step. 
+
+    With <step_workers> above 1, a step runs in three phases. First, all
+    personas perceive, retrieve and plan their own next action at the same 
+    time; this is where most of the LLM and embedding calls are. Then each
+    persona, one at a time and in a fixed order, reacts to the others. This 
+    is the commit phase: starting a chat writes to both personas, so it must
+    not race. Finally, all personas reflect and execute their plans at the 
+    same time. Given the same seed and the same LLM responses, a step 
+    always produces the same movements. 
+
+    INPUT
+      None
+    OUTPUT
+      A dictionary from persona name to the persona's movement, pronunciatio,
+      description and chat, as written to the movement file. 
+    """
+    self.seed_personas()
+    persona_movements = dict()
+
+    def record_movement(persona, execution):
+      # <next_tile> is a x,y coordinate. e.g., (58, 9)
+      # <pronunciatio> is an emoji. e.g., "\ud83d\udca4"
+      # <description> is a string description of the movement. e.g.,
+      #   writing her next novel (editing her novel)
+      #   @ double studio:double studio:common room:sofa
+      next_tile, pronunciatio, description = execution
+      persona_movements[persona.name] = {}
+      persona_movements[persona.name]["movement"] = next_tile
+      persona_movements[persona.name]["pronunciatio"] = pronunciatio
+      persona_movements[persona.name]["description"] = description
+      persona_movements[persona.name]["chat"] = persona.scratch.chat
+
+    if self.step_workers <= 1:
+      for persona_name, persona in self.personas.items():
+        record_movement(persona, persona.move(
+          self.maze, self.personas, self.personas_tile[persona_name],
+          self.curr_time))
+      return persona_movements
+
+    with ThreadPoolExecutor(max_workers=self.step_workers) as pool:
+      futures = dict()
+      for persona_name, persona in self.personas.items():
+        futures[persona_name] = pool.submit(
+          persona.prepare_move, self.maze, self.personas_tile[persona_name],
+          self.curr_time)
+      retrieved = {persona_name: future.result()
+                   for persona_name, future in futures.items()}
+
+      plans = dict()
+      for persona_name, persona in self.personas.items():
+        plans[persona_name] = persona.react(self.maze, self.personas,
+                                            retrieved[persona_name])
+
+      futures = dict()
+      for persona_name, persona in self.personas.items():
+        futures[persona_name] = pool.submit(
+          persona.finish_move, self.maze, self.personas, plans[persona_name])
+      for persona_name, persona in self.personas.items():
+        record_movement(persona, futures[persona_name].result())
+    return persona_movements
 
 
   def start_path_tester_server(self):
@@ -276,7 +414,30 @@ class ReverieServer:
       time.sleep(self.server_sleep * 10)
 
 
-  def start_server(self, int_counter):
+  def headless_environment(self, movements=None):
+    """
+    Builds the environment the frontend would report back after playing
+    <movements>: the frontend walks every persona onto the tile it was told
+    to move to, so that is where each persona stands. Personas without a
+    movement stay on their current tile.
+
+    INPUT
+      movements: The movements dictionary of the previous step, or None.
+    OUTPUT
+      The environment dictionary, in the form of the environment files.
+      e.g., {"Isabella Rodriguez": {"maze": "the_ville", "x": 72, "y": 14}}
+    """
+    environment = dict()
+    for persona_name, tile in self.personas_tile.items():
+      if movements and persona_name in movements["persona"]:
+        tile = movements["persona"][persona_name]["movement"]
+      environment[persona_name] = {"maze": self.maze.maze_name,
+                                   "x": tile[0],
+                                   "y": tile[1]}
+    return environment
+
+
+  def start_server(self, int_counter, headless=False):
     """
     The main backend server of Reverie.
     This function retrieves the environment file from the frontend to
@@ -286,6 +447,10 @@ class ReverieServer:
     INPUT
       int_counter: Integer value for the number of steps left for us to take
                    in this iteration.
+      headless: If True, there is no frontend. Instead of waiting for the
+                frontend to report the environment, we move the personas
+                onto the tiles of our own previous movements (see
+                headless_environment) and run the steps back to back.
     OUTPUT
       None
     """
@@ -302,6 +467,12 @@ class ReverieServer:
     # <game_obj_cleanup> is used for that.
     game_obj_cleanup = dict()
 
+    if self.use_channel and not headless and self.channel is None:
+      self.channel = FrontendChannel(f"{fs_temp_storage}/{CHANNEL_FILE_NAME}",
+                                     fs_storage)
+    channel_open = (not headless
+                    and self.channel is not None and self.channel.is_open())
+
     # The main while loop of Reverie.
     while (True):
       # Done with this iteration if <int_counter> reaches 0.
@@ -312,17 +483,41 @@ class ReverieServer:
       # frontend has done its job and moved the personas, then it will put a
       # new environment file that matches our step count. That's when we run
       # the content of this for loop. Otherwise, we just wait.
+      # If the frontend is connected to our channel, it pushes the
+      # environment to us instead, and we wait for it here (rather than
+      # sleeping); the channel has written the file by then.
+      # <step_env_file> is where that file is, which may be in the
+      # simulation we forked from.
       curr_env_file = f"{sim_folder}/environment/{self.step}.json"
-      if check_if_file_exists(curr_env_file):
-        # If we have an environment file, it means we have a new perception
-        # input to our personas. So we first retrieve it.
-        try:
-          # Try and save block for robustness of the while loop.
-          with open(curr_env_file) as json_file:
-            new_env = json.load(json_file)
+      step_env_file = sim_step_file(sim_folder, "environment", self.step)
+      env_retrieved = False
+      new_env = None
+      write_env = False
+      if headless and step_env_file is None:
+        new_env = self.headless_environment()
+        write_env = True
+      elif channel_open:
+        new_env = self.channel.wait_environment(self.sim_code, self.step,
+                                                self.server_sleep)
+      if new_env is not None or step_env_file is not None:
+        step_start = time.perf_counter()
+        if new_env is not None:
+          env_retrieved = True
+          if write_env:
+            with PROFILER.timer("storage", "write_environment"):
+              with open(curr_env_file, "w") as outfile:
+                outfile.write(json.dumps(new_env))
+        else:
+          # If we have an environment file, it means we have a new perception
+          # input to our personas. So we first retrieve it.
+          try:
+            # Try and save block for robustness of the while loop.
+            with PROFILER.timer("storage", "read_environment"):
+              with open(step_env_file) as json_file:
+                new_env = json.load(json_file)
             env_retrieved = True
-        except:
-          pass
+          except:
+            pass
 
         if env_retrieved:
           # This is where we go through <game_obj_cleanup> to clean up all
@@ -345,9 +540,8 @@ class ReverieServer:
 
             # We actually move the persona on the backend tile map here.
             self.personas_tile[persona_name] = new_tile
-            self.maze.remove_subject_events_from_tile(persona.name, curr_tile)
-            self.maze.add_event_from_tile(persona.scratch
-                                         .get_curr_event_and_desc(), new_tile)
+            self.maze.move_subject(persona.name, curr_tile, new_tile, 
+                                   persona.scratch.get_curr_event_and_desc())
 
             # Now, the persona will travel to get to their destination. *Once*
             # the persona gets there, we activate the object action.
@@ -370,21 +564,7 @@ class ReverieServer:
           # This is where the core brains of the personas are invoked.
           movements = {"persona": dict(),
                        "meta": dict()}
-          for persona_name, persona in self.personas.items():
-            # <next_tile> is a x,y coordinate. e.g., (58, 9)
-            # <pronunciatio> is an emoji. e.g., "\ud83d\udca4"
-            # <description> is a string description of the movement. e.g.,
-            #   writing her next novel (editing her novel)
-            #   @ double studio:double studio:common room:sofa
-            next_tile, pronunciatio, description = persona.move(
-              self.maze, self.personas, self.personas_tile[persona_name],
-              self.curr_time)
-            movements["persona"][persona_name] = {}
-            movements["persona"][persona_name]["movement"] = next_tile
-            movements["persona"][persona_name]["pronunciatio"] = pronunciatio
-            movements["persona"][persona_name]["description"] = description
-            movements["persona"][persona_name]["chat"] = (persona
-                                                          .scratch.chat)
+          movements["persona"] = self.move_personas()
 
           # Include the meta information about the current stage in the
           # movements dictionary.
@@ -397,16 +577,38 @@ class ReverieServer:
           # {"persona": {"Maria Lopez": {"movement": [58, 9]}},
           #  "persona": {"Klaus Mueller": {"movement": [38, 12]}},
           #  "meta": {curr_time: <datetime>}}
+          # A connected frontend gets them through the channel first, so it
+          # does not wait on the file.
+          if channel_open:
+            self.channel.send_movement(self.sim_code, self.step, movements)
+
           curr_move_file = f"{sim_folder}/movement/{self.step}.json"
-          print(f"Writing movement file to: {curr_move_file}")
-          print(f"sim_folder: {sim_folder}")
-          print(f"step: {self.step}")
+          if debug:
+            print(f"Writing movement file to: {curr_move_file}")
 
           # Create the directory if it doesn't exist
           os.makedirs(os.path.dirname(curr_move_file), exist_ok=True)
 
-          with open(curr_move_file, "w") as outfile:
-            outfile.write(json.dumps(movements, indent=2))
+          # The frontend serves the file as soon as it appears, so we write
+          # it under a temporary name first.
+          with PROFILER.timer("storage", "write_movement"):
+            with open(f"{curr_move_file}.tmp", "w") as outfile:
+              outfile.write(json.dumps(movements))
+            os.replace(f"{curr_move_file}.tmp", curr_move_file)
+
+          # In headless mode, we also write the environment the frontend
+          # would have reported after playing these movements; the next step
+          # starts from it.
+          if headless:
+            next_env_file = f"{sim_folder}/environment/{self.step + 1}.json"
+            with PROFILER.timer("storage", "write_environment"):
+              with open(next_env_file, "w") as outfile:
+                outfile.write(json.dumps(
+                  self.headless_environment(movements)))
+
+          # The step profiler (if it is on) writes out the step's timings.
+          PROFILER.end_step(self.sim_code, self.step,
+                            time.perf_counter() - step_start)
 
           # After this cycle, the world takes one step forward, and the
           # current time moves by <sec_per_step> amount.
@@ -415,8 +617,10 @@ class ReverieServer:
 
           int_counter -= 1
 
-      # Sleep so we don't burn our machines.
-      time.sleep(self.server_sleep)
+      # Sleep so we don't burn our machines. (With the channel open, waiting
+      # for the environment above already does.)
+      if not (channel_open or headless):
+        time.sleep(self.server_sleep)
 
 
   def open_server(self):
@@ -604,6 +808,32 @@ class ReverieServer:
         print ("Error.")
         pass
 
+    if self.channel:
+      self.channel.close()
+
+
+  def run_headless(self, steps, save_every=None):
+    """
+    Runs <steps> steps without a frontend and saves the simulation every
+    <save_every> steps and at the end.
+
+    INPUT
+      steps: The number of steps to run.
+      save_every: The number of steps between saves, or None to only save
+                  at the end.
+    OUTPUT
+      None
+    """
+    start = time.time()
+    while steps > 0:
+      chunk = min(steps, save_every) if save_every else steps
+      self.start_server(chunk, headless=True)
+      self.save()
+      steps -= chunk
+      curr_time = self.curr_time.strftime("%B %d, %Y, %H:%M:%S")
+      print (f"Saved at step {self.step} ({curr_time}), "
+             f"{time.time() - start:.1f} s elapsed.")
+
 
 if __name__ == '__main__':
   # rs = ReverieServer("base_the_ville_isabella_maria_klaus",
@@ -612,11 +842,48 @@ if __name__ == '__main__':
   #                    "July1_the_ville_isabella_maria_klaus-step-3-21")
   # rs.open_server()
 
-  origin = input("Enter the name of the forked simulation: ").strip()
-  target = input("Enter the name of the new simulation: ").strip()
+  parser = argparse.ArgumentParser(
+    description="Run a generative agent simulation.")
+  parser.add_argument("--fork", help="the simulation to fork from")
+  parser.add_argument("--sim", help="the name of the new simulation")
+  parser.add_argument("--steps", type=int, 
+                      help="run this many steps headless, then exit")
+  parser.add_argument("--save-every", type=int, 
+                      help="in headless mode, save every this many steps")
+  parser.add_argument("--profile", 
+                      help="write per-step timings to this file (JSON lines)"
+                           " and a .prom file next to it (see profiler.py)")
+  parser.add_argument("--trace", 
+                      help="append every LLM call to this file (JSON lines);"
+                           " see llm_trace_report.py")
+  parser.add_argument("--step-workers", type=int, 
+                      help="the number of personas that may wait on the LLM"
+                           " at the same time during a step")
+  parser.add_argument("--seed", type=int, 
+                      help="seed the personas' random choices, so that runs"
+                           " with the same LLM responses repeat")
+  args = parser.parse_args()
+  if args.profile: 
+    PROFILER.start(args.profile)
+  if args.trace: 
+    LLM_TRACER.start(args.trace)
+
+  origin = args.fork
+  if origin is None: 
+    origin = input("Enter the name of the forked simulation: ").strip()
+  target = args.sim
+  if target is None: 
+    target = input("Enter the name of the new simulation: ").strip()
 
   rs = ReverieServer(origin, target)
-  rs.open_server()
+  if args.step_workers is not None: 
+    rs.step_workers = args.step_workers
+  if args.seed is not None: 
+    rs.seed = args.seed
+  if args.steps is None: 
+    rs.open_server()
+  else: 
+    rs.run_headless(args.steps, args.save_every)
 
 
 
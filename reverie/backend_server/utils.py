@@ -0,0 +1,12 @@
+ollama_base_url = "http://localhost:11434"
+ollama_model = "llama3.2:1b"
+use_ollama = True
+openai_api_key = ""
+key_owner = "user"
+maze_assets_loc = "../../environment/frontend_server/static_dirs/assets"
+env_matrix = f"{maze_assets_loc}/the_ville/matrix"
+env_visuals = f"{maze_assets_loc}/the_ville/visuals"
+fs_storage = "../../environment/frontend_server/storage"
+fs_temp_storage = "../../environment/frontend_server/temp_storage"
+collision_block_id = "32125"
+debug = True
@@ -2,83 +2,324 @@
 Author: Joon Sung Park (joonspk@stanford.edu)
 
 File: compress_sim_storage.py
-Description: Compresses a simulation for replay demos. 
+Description: Compresses a simulation for replay demos.
+
+compress writes the keyframed replay format that the demo page seeks in, to
+compressed_storage/<sim_code>/replay:
+  format.json      -- {"version", "keyframe_interval", "n_steps",
+                       "persona_names"}; replaced last, once the rest is done
+  partial.json     -- the same without "n_steps", while compress is running
+  deltas.jsonl     -- one line per step: the personas whose movement,
+                      pronunciatio, description or chat changed at that step
+  deltas.idx       -- the byte offset of every line of deltas.jsonl, and the
+                      file's size, as little-endian uint64
+  keyframes.jsonl  -- one line every <keyframe_interval> steps: the latest
+                      state of every persona as of that step
+  keyframes.idx    -- the offsets of keyframes.jsonl, as above
+The state at step s is keyframe s // K merged with the deltas of steps
+(s // K) * K + 1 through s, so seeking reads one keyframe and fewer than K
+deltas. The reader is environment/frontend_server/translator/
+movement_store.py.
+
+The movement files are read by a pool of threads and diffed and written one
+step at a time, so memory does not grow with the length of the simulation.
+The lines are appended as they are made, so an interrupted compress (or one
+run on a simulation that has since run further) picks up where the last one
+stopped.
+
+Usage (from reverie):
+  python compress_sim_storage.py <sim_code> [<sim_code> ...]
+  python compress_sim_storage.py <sim_code> --restart   # ignore earlier work
+  python compress_sim_storage.py <sim_code> ... --jobs 4  # 4 sims at a time
 """
+import argparse
+import collections
+import os
 import shutil
 import json
+import numpy
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from global_methods import *
 
-def compress(sim_code):
-  sim_storage = f"../environment/frontend_server/storage/{sim_code}"
-  compressed_storage = f"../environment/frontend_server/compressed_storage/{sim_code}"
-  persona_folder = sim_storage + "/personas"
-  move_folder = sim_storage + "/movement"
-  meta_file = sim_storage + "/reverie/meta.json"
+REPLAY_FORMAT_VERSION = 1
+KEYFRAME_INTERVAL = 100
+# The steps between two flushes of the replay files to disk. A resumed
+# compress starts after the last step that reached the disk.
+FLUSH_INTERVAL = 1000
+MOVEMENT_FIELDS = ["movement", "pronunciatio", "description", "chat"]
 
-  persona_names = []
-  for i in find_filenames(persona_folder, ""): 
-    x = i.split("/")[-1].strip()
-    if x[0] != ".": 
-      persona_names += [x]
 
-  max_move_count = max([int(i.split("/")[-1].split(".")[0]) 
-                 for i in find_filenames(move_folder, "json")])
-  
-  persona_last_move = dict()
-  master_move = dict()  
-  for i in range(max_move_count+1): 
-    master_move[i] = dict()
-    with open(f"{move_folder}/{str(i)}.json") as json_file:  
-      i_move_dict = json.load(json_file)["persona"]
-      for p in persona_names: 
-        move = False
-        if i == 0: 
-          move = True
-        elif (i_move_dict[p]["movement"] != persona_last_move[p]["movement"]
-          or i_move_dict[p]["pronunciatio"] != persona_last_move[p]["pronunciatio"]
-          or i_move_dict[p]["description"] != persona_last_move[p]["description"]
-          or i_move_dict[p]["chat"] != persona_last_move[p]["chat"]): 
-          move = True
-
-        if move: 
-          persona_last_move[p] = {"movement": i_move_dict[p]["movement"],
-                                  "pronunciatio": i_move_dict[p]["pronunciatio"], 
-                                  "description": i_move_dict[p]["description"], 
-                                  "chat": i_move_dict[p]["chat"]}
-          master_move[i][p] = {"movement": i_move_dict[p]["movement"],
-                               "pronunciatio": i_move_dict[p]["pronunciatio"], 
-                               "description": i_move_dict[p]["description"], 
-                               "chat": i_move_dict[p]["chat"]}
-
-
-  create_folder_if_not_there(compressed_storage)
-  with open(f"{compressed_storage}/master_movement.json", "w") as outfile:
-    outfile.write(json.dumps(master_move, indent=2))
+def line_offsets(path):
+  """
+  Returns the offset of the start of every complete line of <path>, followed
+  by the offset of the end of the last one.
+  """
+  offsets = [numpy.zeros(1, dtype="<u8")]
+  position = 0
+  with open(path, "rb") as data_file:
+    while True:
+      block = data_file.read(1 << 24)
+      if not block:
+        break
+      ends = numpy.flatnonzero(numpy.frombuffer(block, dtype=numpy.uint8)
+                               == ord("\n"))
+      offsets += [(ends + position + 1).astype("<u8")]
+      position += len(block)
+  return numpy.concatenate(offsets)
 
-  shutil.copyfile(meta_file, f"{compressed_storage}/meta.json")
-  shutil.copytree(persona_folder, f"{compressed_storage}/personas/")
 
+class ReplayWriter:
+  def __init__(self, folder, persona_names,
+               keyframe_interval=KEYFRAME_INTERVAL, resume=True):
+    """
+    Starts or resumes writing the keyframed replay format to <folder>. Steps
+    are added in order, starting at <n_steps> (0 unless resumed).
 
-if __name__ == '__main__':
-  compress("July1_the_ville_isabella_maria_klaus-step-3-9")
+    INPUT
+      folder: the replay folder, e.g., compressed_storage/<sim_code>/replay
+      persona_names: the names of all personas in the simulation.
+      keyframe_interval: the number of steps between two keyframes.
+      resume: if True, keep the steps an earlier writer already wrote to
+              <folder> with the same personas and keyframe interval.
+    """
+    self.folder = folder
+    self.persona_names = persona_names
+    self.keyframe_interval = keyframe_interval
+    self.n_steps = 0
+    # <state> is the latest record of every persona so far.
+    self.state = dict()
+    self.delta_offsets = [0]
+    self.keyframe_offsets = [0]
+
+    os.makedirs(folder, exist_ok=True)
+    header = {"version": REPLAY_FORMAT_VERSION,
+              "keyframe_interval": keyframe_interval,
+              "persona_names": persona_names}
+    earlier = None
+    earlier_steps = None
+    for name in ["format", "partial"]:
+      if earlier is None and os.path.exists(f"{folder}/{name}.json"):
+        with open(f"{folder}/{name}.json") as json_file:
+          earlier = json.load(json_file)
+        earlier_steps = earlier.pop("n_steps", None)
+
+    if resume and earlier == header:
+      self.load_earlier_steps()
+      # The steps are only appended to, so the earlier format.json (and the
+      # index files) keep describing a valid prefix, and a frontend can go
+      # on serving it until close() replaces them; unless some of those 
+      # steps were lost.
+      if earlier_steps is not None and earlier_steps > self.n_steps:
+        os.remove(f"{folder}/format.json")
+    else:
+      # We unlink rather than truncate the old files, so a frontend that has
+      # them mapped keeps reading them intact.
+      for name in ["format.json", "deltas.jsonl", "keyframes.jsonl"]:
+        if os.path.exists(f"{folder}/{name}"):
+          os.remove(f"{folder}/{name}")
+
+    with open(f"{folder}/partial.json", "w") as outfile:
+      outfile.write(json.dumps(header, indent=2))
+    self.deltas = open(f"{folder}/deltas.jsonl", "ab")
+    self.keyframes = open(f"{folder}/keyframes.jsonl", "ab")
+
+
+  def load_earlier_steps(self):
+    """
+    Picks up the steps that are complete on disk: the complete lines of
+    deltas.jsonl whose keyframe is also there. Anything after them (e.g., a
+    half-written line) is cut off.
+    """
+    deltas_path = f"{self.folder}/deltas.jsonl"
+    keyframes_path = f"{self.folder}/keyframes.jsonl"
+    if not (os.path.exists(deltas_path) and os.path.exists(keyframes_path)):
+      for path in [deltas_path, keyframes_path]:
+        if os.path.exists(path):
+          os.remove(path)
+      return
+    delta_offsets = line_offsets(deltas_path)
+    keyframe_offsets = line_offsets(keyframes_path)
+    n_keyframes = len(keyframe_offsets) - 1
+    n_steps = min(len(delta_offsets) - 1,
+                  n_keyframes * self.keyframe_interval)
+    n_keyframes = -(-n_steps // self.keyframe_interval)
+    delta_offsets = delta_offsets[:n_steps + 1]
+    keyframe_offsets = keyframe_offsets[:n_keyframes + 1]
 
+    with open(deltas_path, "r+b") as data_file:
+      data_file.truncate(int(delta_offsets[-1]))
+    with open(keyframes_path, "r+b") as data_file:
+      data_file.truncate(int(keyframe_offsets[-1]))
 
+    if n_steps:
+      last_keyframe = n_keyframes - 1
+      with open(keyframes_path, "rb") as data_file:
+        data_file.seek(int(keyframe_offsets[last_keyframe]))
+        self.state = json.loads(data_file.readline())
+      with open(deltas_path, "rb") as data_file:
+        data_file.seek(int(delta_offsets[last_keyframe
+                                         * self.keyframe_interval + 1]))
+        for line in data_file:
+          self.state.update(json.loads(line))
 
+    self.n_steps = n_steps
+    self.delta_offsets = delta_offsets.tolist()
+    self.keyframe_offsets = keyframe_offsets.tolist()
 
 
+  def add(self, delta):
+    """
+    Adds the next step.
 
+    INPUT
+      delta: a dictionary from persona name to the persona's record
+             ({"movement", "pronunciatio", "description", "chat"}), for the
+             personas that changed at this step.
+    """
+    self.state.update(delta)
+    line = json.dumps(delta, separators=(",", ":")).encode("utf-8") + b"\n"
+    self.deltas.write(line)
+    self.delta_offsets += [self.delta_offsets[-1] + len(line)]
 
+    if self.n_steps % self.keyframe_interval == 0:
+      line = (json.dumps(self.state, separators=(",", ":")).encode("utf-8")
+              + b"\n")
+      self.keyframes.write(line)
+      self.keyframe_offsets += [self.keyframe_offsets[-1] + len(line)]
+    self.n_steps += 1
 
+    if self.n_steps % FLUSH_INTERVAL == 0:
+      self.deltas.flush()
+      self.keyframes.flush()
 
-  
 
+  def close(self):
+    self.deltas.close()
+    self.keyframes.close()
+    for name, offsets in [("deltas", self.delta_offsets),
+                          ("keyframes", self.keyframe_offsets)]:
+      numpy.array(offsets, dtype="<u8").tofile(f"{self.folder}/{name}.idx.tmp")
+      os.replace(f"{self.folder}/{name}.idx.tmp", f"{self.folder}/{name}.idx")
+    replay_format = {"version": REPLAY_FORMAT_VERSION,
+                     "keyframe_interval": self.keyframe_interval,
+                     "n_steps": self.n_steps,
+                     "persona_names": self.persona_names}
+    with open(f"{self.folder}/format.json.tmp", "w") as outfile:
+      outfile.write(json.dumps(replay_format, indent=2))
+    os.replace(f"{self.folder}/format.json.tmp", f"{self.folder}/format.json")
+    os.remove(f"{self.folder}/partial.json")
 
 
+def read_movement(move_file):
+  with open(move_file) as json_file:
+    return json.load(json_file)["persona"]
 
 
+def read_movements(move_files, first, last, workers):
+  """
+  Yields the "persona" part of the movement files of steps <first> through
+  <last>, in order. <workers> threads read ahead of the caller, a bounded
+  number of steps at a time.
 
+  INPUT
+    move_files: a dictionary from step to the address of its movement file.
+  """
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    pending = collections.deque()
+    step = first
+    while step <= last or pending:
+      while step <= last and len(pending) < workers * 4:
+        pending += [pool.submit(read_movement, move_files[step])]
+        step += 1
+      yield pending.popleft().result()
 
 
+def compress(sim_code, workers=8, resume=True,
+             keyframe_interval=KEYFRAME_INTERVAL):
+  """
+  Compresses the simulation <sim_code> into compressed_storage/<sim_code>.
 
+  INPUT
+    sim_code: the simulation to compress.
+    workers: the number of threads reading movement files.
+    resume: if True, keep the steps an earlier compress already wrote.
+    keyframe_interval: the number of steps between two keyframes.
+  OUTPUT
+    The number of steps in the compressed simulation.
+  """
+  sim_storage = f"../environment/frontend_server/storage/{sim_code}"
+  compressed_storage = f"../environment/frontend_server/compressed_storage/{sim_code}"
+  persona_folder = sim_storage + "/personas"
+  meta_file = sim_storage + "/reverie/meta.json"
+
+  persona_names = []
+  for i in find_filenames(persona_folder, ""):
+    x = i.split("/")[-1].strip()
+    if x[0] != ".":
+      persona_names += [x]
+
+  # The movement files of a copy-on-write fork may be in the simulation it
+  # was forked from.
+  move_files = sim_step_files(sim_storage, "movement")
+  max_move_count = max(move_files)
 
+  replay = ReplayWriter(f"{compressed_storage}/replay", persona_names,
+                        keyframe_interval, resume)
+  # <replay.state> holds every persona's last recorded move, which is what
+  # each step is diffed against.
+  persona_last_move = replay.state
+  for i_move_dict in read_movements(move_files, replay.n_steps,
+                                    max_move_count, workers):
+    delta = dict()
+    for p in persona_names:
+      move = {field: i_move_dict[p][field] for field in MOVEMENT_FIELDS}
+      if move != persona_last_move.get(p):
+        delta[p] = move
+    replay.add(delta)
+  replay.close()
+
+  shutil.copyfile(meta_file, f"{compressed_storage}/meta.json")
+  shutil.copytree(persona_folder, f"{compressed_storage}/personas/",
+                  dirs_exist_ok=True)
+  return replay.n_steps
+
+
+def compress_all(sim_codes, jobs=2, workers=8, resume=True,
+                 keyframe_interval=KEYFRAME_INTERVAL):
+  """
+  Compresses several simulations, <jobs> of them at a time, each in its own
+  process.
+
+  OUTPUT
+    A dictionary from sim code to the number of steps compressed.
+  """
+  if jobs <= 1 or len(sim_codes) <= 1:
+    return {sim_code: compress(sim_code, workers, resume, keyframe_interval)
+            for sim_code in sim_codes}
+  with ProcessPoolExecutor(max_workers=jobs) as pool:
+    futures = {sim_code: pool.submit(compress, sim_code, workers, resume,
+                                     keyframe_interval)
+               for sim_code in sim_codes}
+    return {sim_code: future.result() for sim_code, future in futures.items()}
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description="Compress simulations for replay demos.")
+  parser.add_argument("sim_codes", nargs="+",
+                      help="the simulations to compress")
+  parser.add_argument("--jobs", type=int, default=2,
+                      help="the number of simulations compressed at a time")
+  parser.add_argument("--workers", type=int, default=8,
+                      help="the number of threads reading movement files")
+  parser.add_argument("--restart", action="store_true",
+                      help="start over instead of resuming earlier work")
+  parser.add_argument("--keyframe-interval", type=int,
+                      default=KEYFRAME_INTERVAL,
+                      help="the number of steps between two keyframes")
+  args = parser.parse_args()
 
+  n_steps = compress_all(args.sim_codes, args.jobs, args.workers,
+                         not args.restart, args.keyframe_interval)
+  for sim_code, count in n_steps.items():
+    print (f"{sim_code}: {count} steps")